@@ -1,4 +1,6 @@
+import os
 import json
+import threading
 from functools import partial
 from types import MappingProxyType
 from typing import Mapping, Iterable
@@ -35,6 +37,27 @@ def harden(data):
     return data
 
 
+def write_atomic(path, data):
+    """
+    Write `data` (bytes) to a temporary file alongside `path` and rename it into place -
+    readers (e.g. the viewers) see the old file or the new one, never a half written file
+
+    >>> import tempfile
+    >>> from pathlib import Path
+    >>> path = Path(tempfile.mkdtemp()).joinpath('data.json')
+    >>> write_atomic(path, b'{}')
+    >>> path.read_bytes(), tuple(p.name for p in path.parent.iterdir())
+    (b'{}', ('data.json',))
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')  # concurrent writers of one path each rename their own file
+    path_tmp.write_bytes(data)
+    os.replace(path_tmp, path)
+
+def write_json_atomic(path, data):
+    write_atomic(path, json.dumps(data, cls=JSONObjectEncoder).encode('utf8'))
+
+
 class JSONObjectEncoder(json.JSONEncoder):
     def default(self, obj):
         """
@@ -0,0 +1,178 @@
+"""
+Offline benchmark of the whole marking pipeline
+
+A synthetic cohort (`github_stub.synthetic_cohort`) is served locally and `GitHubForkData` is run against it twice
+- `cold` with empty caches/indexes, then `warm` reusing them (as the next scheduled run would).
+Each pass is a fresh process (the in-process memory caches don't flatter the warm numbers)
+and records the seconds and the number of requests per pipeline stage.
+
+    python benchmark.py --forks 30 --weeks 10 --save   # record a baseline
+    python benchmark.py --forks 30 --weeks 10          # compare against it (exit code 1 on regression)
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+from pathlib import Path
+from collections import Counter
+
+from metrics import endpoint
+
+import logging
+log = logging.getLogger(__name__)
+
+
+BASELINE_PATH = Path('benchmark_baseline.json')
+TOLERANCE = 0.25  # seconds may grow by this fraction before being flagged
+PASSES = ('cold', 'warm')
+
+
+def count_endpoints(requests):
+    counts = Counter()
+    for path, count in requests.items():
+        counts[endpoint(path)] += count
+    return dict(sorted(counts.items()))
+
+
+def run_pass(path, port, cohort, workers=1, artifacts_concurrency=16):
+    """
+    One pipeline run against a freshly served cohort - `path` holds the caches/indexes that persist between passes.
+    Must be a fresh process (the in-process memory caches would flatter the numbers) with `CACHE_PATH` pointing inside `path`.
+    """
+    import github
+    import github_requests
+    from github_stub import StubGithub, synthetic_cohort
+    from github_fork_data import GitHubForkData, summary_matrix
+    from cache_tools import cache_infos
+
+    with StubGithub(port=port) as stub:
+        settings = synthetic_cohort(stub, **cohort)
+        settings.update(index_path=str(path.joinpath('index')), workers=workers, artifacts_concurrency=artifacts_concurrency)
+        session = github_requests.github_session()  # ETags are stored under `CACHE_PATH`, with everything else
+        github_requests.use_github_session(session)
+        # PyGithub's own throttle (0.25s per request) would swamp everything measured here - pacing is `github_requests`' job
+        gg = GitHubForkData(github.Github(base_url=stub.url, retry=None, seconds_between_requests=0), settings, session=session)
+
+        stages = {
+            'forks': lambda: gg.forks,
+            'workflow_runs': lambda: gg.workflow_run_artifacts_url_lookup,
+            'commits': lambda: gg._map_forks(lambda fork: fork._commits_grouped_by_week()),
+            'tests': lambda: gg.fork_test_data,  # artifacts (prefetched when `artifacts_concurrency`) + markdown grading
+            'summary': lambda: summary_matrix(gg.fork_test_data),
+        }
+        results = {}
+        for stage, func in stages.items():
+            requests_before = sum(stub.requests.values())
+            time_start = time.perf_counter()
+            func()
+            results[stage] = {
+                'seconds': round(time.perf_counter() - time_start, 4),
+                'requests': sum(stub.requests.values()) - requests_before,
+            }
+        return {'stages': results, 'endpoints': count_endpoints(stub.requests), 'caches': cache_infos()}
+
+
+def benchmark(cohort, workers=1, artifacts_concurrency=16, path=None):
+    """
+    `{pass: run_pass(...)}` for each of `PASSES` - every pass in its own process, all sharing one cache folder
+    (a temporary folder unless `path` is given)
+    """
+    if not path:
+        with tempfile.TemporaryDirectory(prefix='benchmark_') as path:
+            return benchmark(cohort, workers, artifacts_concurrency, path)
+    path = Path(path)
+    with socket.socket() as _socket:  # every pass serves on the same port, so urls recorded in the indexes stay valid
+        _socket.bind(('127.0.0.1', 0))
+        port = _socket.getsockname()[1]
+    env = {**os.environ, 'CACHE_PATH': str(path.joinpath('cache')), 'GITHUB_TOKEN': os.environ.get('GITHUB_TOKEN', 'benchmark')}
+    results = {}
+    for _pass in PASSES:
+        log.info(f'{_pass} pass - {path}')
+        process = subprocess.run(
+            (sys.executable, __file__, '--_pass', json.dumps({'path': str(path), 'port': port, 'cohort': cohort, 'workers': workers, 'artifacts_concurrency': artifacts_concurrency})),
+            env=env, capture_output=True, text=True, cwd=Path(__file__).parent,
+        )
+        if process.returncode:
+            raise RuntimeError(f'{_pass} pass failed\n{process.stderr}')
+        results[_pass] = json.loads(process.stdout.splitlines()[-1])
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Lines describing each stage that got slower (beyond `tolerance`) or made more requests than `baseline`
+
+    >>> baseline = {'cold': {'stages': {'tests': {'seconds': 1.0, 'requests': 10}}}}
+    >>> compare({'cold': {'stages': {'tests': {'seconds': 1.1, 'requests': 12}}}}, baseline)
+    ['cold/tests requests 10 -> 12']
+    >>> compare({'cold': {'stages': {'tests': {'seconds': 2.0, 'requests': 10}}}}, baseline)
+    ['cold/tests seconds 1.0 -> 2.0']
+    """
+    regressions = []
+    for _pass, result in results.items():
+        for stage, now in result['stages'].items():
+            before = baseline.get(_pass, {}).get('stages', {}).get(stage)
+            if not before:
+                continue
+            if now['seconds'] > before['seconds'] * (1 + tolerance):
+                regressions.append(f'{_pass}/{stage} seconds {before["seconds"]} -> {now["seconds"]}')
+            if now['requests'] > before['requests']:
+                regressions.append(f'{_pass}/{stage} requests {before["requests"]} -> {now["requests"]}')
+    return regressions
+
+def baseline_key(cohort, workers, artifacts_concurrency):
+    return json.dumps({**cohort, 'workers': workers, 'artifacts_concurrency': artifacts_concurrency}, sort_keys=True)
+
+
+def report(results):
+    lines = [f'{"pass":<6}{"stage":<16}{"seconds":>10}{"requests":>10}']
+    for _pass, result in results.items():
+        for stage, values in result['stages'].items():
+            lines.append(f'{_pass:<6}{stage:<16}{values["seconds"]:>10.3f}{values["requests"]:>10}')
+        lines.append(f'{_pass:<6}{"endpoints":<16}{json.dumps(result["endpoints"])}')
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Time cold and warm runs of GitHubForkData against a synthetic cohort served by a local stub GitHub')
+    parser.add_argument('--forks', type=int, default=10)
+    parser.add_argument('--weeks', type=int, default=6)
+    parser.add_argument('--commits_per_week', type=int, default=3)
+    parser.add_argument('--tests_per_suite', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--artifacts_concurrency', type=int, default=16)
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='record these results as the baseline for this cohort')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--_pass', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args._pass:
+        kwargs = json.loads(args._pass)
+        logging.basicConfig(level=logging.WARNING)
+        print(json.dumps(run_pass(Path(kwargs.pop('path')), **kwargs)))
+        sys.exit()
+
+    logging.basicConfig(level=logging.INFO)
+    cohort = {k: getattr(args, k) for k in ('forks', 'weeks', 'commits_per_week', 'tests_per_suite', 'seed')}
+    results = benchmark(cohort, workers=args.workers, artifacts_concurrency=args.artifacts_concurrency)
+    print(report(results))
+
+    key = baseline_key(cohort, args.workers, args.artifacts_concurrency)
+    baselines = json.loads(args.baseline.read_text()) if args.baseline.is_file() else {}
+    if args.save:
+        baselines[key] = results
+        args.baseline.write_text(json.dumps(baselines, indent=2))
+        log.info(f'baseline saved to {args.baseline}')
+    elif key in baselines:
+        regressions = compare(results, baselines[key], args.tolerance)
+        for regression in regressions:
+            log.warning(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
+    else:
+        log.info(f'no baseline for this cohort in {args.baseline} - run with --save to record one')
@@ -1,34 +1,335 @@
 import datetime
 from pathlib import Path
+from os import environ
+import json
 import pickle
 import hashlib
-from functools import wraps
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+from functools import wraps, cache
+
+from _utils import write_atomic, write_json_atomic
 
 import logging
 log = logging.getLogger(__name__)
 
 
+DEFAULT_CACHE_PATH = Path(environ.get('CACHE_PATH', '__cache'))  # e.g. `CACHE_PATH=__cache.sqlite` to use SqliteCacheBackend
+
+
 class DoNotPersistCacheException(Exception):
     pass
+class CacheExpired(KeyError):
+    """The key is stored, but older than the ttl"""
+    pass
+
+
+class FileCacheBackend():
+    """
+    One pickle file per key in a flat folder. Expiry is from the file's mtime.
+    Files are written atomically - an unreadable file (e.g. from an interrupted older run) is a miss
+
+    >>> import tempfile
+    >>> backend = FileCacheBackend(Path(tempfile.mkdtemp()))
+    >>> backend.set('a', 'value', datetime.timedelta(days=1))
+    >>> _ = backend.path.joinpath('b').write_bytes(pickle.dumps('value')[:5])
+    >>> backend.get('a', datetime.timedelta(days=1)), sorted(p.name for p in backend.path.iterdir())
+    ('value', ['a', 'b'])
+    >>> backend.get('b', datetime.timedelta(days=1))
+    Traceback (most recent call last):
+    KeyError: 'b'
+    """
+    def __init__(self, path):
+        assert isinstance(path, Path)
+        self.path = path
+    def get(self, key, ttl):
+        return self.get_timestamped(key, ttl)[1]
+    def get_timestamped(self, key, ttl):
+        """`(stored_datetime, value)`"""
+        cache = self.path.joinpath(key)
+        if not cache.is_file():
+            raise KeyError(key)
+        timestamp = datetime.datetime.fromtimestamp(cache.stat().st_mtime)
+        if timestamp <= datetime.datetime.now() - ttl:
+            raise CacheExpired(key)
+        try:
+            with cache.open(mode='rb') as filehandle:
+                return timestamp, pickle.load(filehandle)
+        except (EOFError, pickle.UnpicklingError):
+            raise KeyError(key)
+    def set(self, key, value, ttl):
+        write_atomic(self.path.joinpath(key), pickle.dumps(value))
 
 
-def cache_disk(original_function=None, cache_path=Path('__cache'), ttl=datetime.timedelta(days=1), cache_only=False, args_to_bytes_func=lambda *args, **kwargs: pickle.dumps((args, kwargs))):
+class SqliteCacheBackend():
     """
-    TODO: doctests with tempfile.tempdir
+    All entries in a single indexed sqlite file, with size-bounded least-recently-used eviction.
+    The total size is kept up to date by triggers - once it is over `max_bytes`, the least recently used entries
+    are removed in one batch down to `EVICT_TO` of `max_bytes`.
+    `accessed` is only rewritten on a read when it is older than `touch_after` (reads are not all writes).
+
+    >>> import tempfile
+    >>> backend = SqliteCacheBackend(Path(tempfile.mkdtemp()).joinpath('cache.sqlite'), max_bytes=150, touch_after=datetime.timedelta(0))
+    >>> ttl = datetime.timedelta(days=1)
+    >>> backend.set('a', 'a'*40, ttl)
+    >>> backend.set('b', 'b'*40, ttl)
+    >>> backend.get('a', ttl) == 'a'*40
+    True
+    >>> backend.set('c', 'c'*40, ttl)  # over max_bytes - evicts 'b' as it is the least recently used
+    >>> backend.get('b', ttl)
+    Traceback (most recent call last):
+    KeyError: 'b'
+    >>> backend.get('a', datetime.timedelta(0))  # stored, but too old for this ttl
+    Traceback (most recent call last):
+    cache_tools.CacheExpired: 'a'
+    >>> backend.set('d', 'd', datetime.timedelta(days=-1))
+    >>> backend.get('d', ttl)  # read expiry is from creation time
+    'd'
+    >>> backend.compact()  # ... but compaction drops entries past the ttl they were stored with
+    1
+    >>> sorted(key for key, in backend.db.execute('SELECT key FROM cache'))
+    ['a', 'c']
+    >>> backend.total_bytes == sum(size for size, in backend.db.execute('SELECT size FROM cache'))
+    True
     """
-    assert isinstance(cache_path, Path)
+    EVICT_TO = 0.9
+
+    def __init__(self, path, max_bytes=None, touch_after=datetime.timedelta(minutes=10)):
+        assert isinstance(path, Path)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_after = touch_after
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if not self._db:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, expires REAL, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+            self._db.execute('PRAGMA recursive_triggers=ON')  # `INSERT OR REPLACE` fires the delete trigger for the replaced row
+            with self._db:
+                self._db.execute('BEGIN IMMEDIATE')
+                if not self._db.execute("SELECT 1 FROM sqlite_master WHERE name='cache_size'").fetchone():
+                    self._db.execute('CREATE TABLE cache_size (total INTEGER)')
+                    self._db.execute('INSERT INTO cache_size SELECT COALESCE(SUM(size), 0) FROM cache')
+                self._db.execute('CREATE TRIGGER IF NOT EXISTS cache_size_insert AFTER INSERT ON cache BEGIN UPDATE cache_size SET total = total + NEW.size; END')
+                self._db.execute('CREATE TRIGGER IF NOT EXISTS cache_size_delete AFTER DELETE ON cache BEGIN UPDATE cache_size SET total = total - OLD.size; END')
+        return self._db
+    @property
+    def total_bytes(self):
+        return self.db.execute('SELECT total FROM cache_size').fetchone()[0]
+
+    def get(self, key, ttl):
+        return self.get_timestamped(key, ttl)[1]
+    def get_timestamped(self, key, ttl):
+        """`(stored_datetime, value)`"""
+        now = datetime.datetime.now().timestamp()
+        with self._lock:
+            row = self.db.execute('SELECT value, created, accessed FROM cache WHERE key=?', (key, )).fetchone()
+            if not row:
+                raise KeyError(key)
+            if row[1] <= now - ttl.total_seconds():
+                raise CacheExpired(key)
+            if row[2] <= now - self.touch_after.total_seconds():
+                self.db.execute('UPDATE cache SET accessed=? WHERE key=?', (now, key))
+        return datetime.datetime.fromtimestamp(row[1]), pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = datetime.datetime.now().timestamp()
+        value = pickle.dumps(value)
+        with self._lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, created, expires, accessed) VALUES (?,?,?,?,?,?)',
+                (key, value, len(value), now, now + ttl.total_seconds(), now),
+            )
+            if self.max_bytes and self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Caller holds `self._lock`"""
+        excess = self.total_bytes - int(self.max_bytes * self.EVICT_TO)
+        keys = []
+        for key, size in self.db.execute('SELECT key, size FROM cache ORDER BY accessed'):
+            if excess <= 0:
+                break
+            keys.append((key, ))
+            excess -= size
+        with self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('DELETE FROM cache WHERE key=?', keys)
+        log.debug(f'evicted {len(keys)} cache entries from {self.path}')
+
+    def compact(self):
+        """
+        Remove expired entries and reclaim their space. Returns the number of entries removed.
+        """
+        with self._lock:
+            removed = self.db.execute('DELETE FROM cache WHERE expires<?', (datetime.datetime.now().timestamp(), )).rowcount
+            self.db.execute('VACUUM')
+        return removed
+
+
+class MemoryCache():
+    """
+    Bounded least-recently-used in-process tier - hot keys are deserialized once per process
+
+    >>> memory = MemoryCache(maxsize=2)
+    >>> ttl = datetime.timedelta(days=1)
+    >>> memory.set('a', 1); memory.set('b', 2)
+    >>> memory.get('a', ttl)
+    1
+    >>> memory.set('c', 3)  # evicts 'b' as 'a' was used more recently
+    >>> memory.get('b', ttl)
+    Traceback (most recent call last):
+    KeyError: 'b'
+    >>> tuple(memory.data.keys())
+    ('a', 'c')
+    >>> memory.set('d', 4, timestamp=datetime.datetime.now() - ttl)  # a disk hit keeps the disk entry's age
+    >>> memory.get('d', ttl)
+    Traceback (most recent call last):
+    cache_tools.CacheExpired: 'd'
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key, ttl):
+        with self._lock:
+            timestamp, value = self.data[key]
+            if timestamp <= datetime.datetime.now() - ttl:
+                del self.data[key]
+                raise CacheExpired(key)
+            self.data.move_to_end(key)
+            return value
+    def set(self, key, value, timestamp=None):
+        with self._lock:
+            self.data[key] = (timestamp or datetime.datetime.now(), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+
+class CacheInfo(NamedTuple):
+    memory_hits: int
+    disk_hits: int
+    misses: int
+    expired: int
+    memory_size: int
+    memory_maxsize: int
+
+
+class JsonIndex(dict):
+    """
+    A dict persisted as a json file - for incrementally maintained indexes (rather than expiring cache entries)
+
+    >>> import tempfile
+    >>> path = Path(tempfile.mkdtemp()).joinpath('index', 'test.json')
+    >>> index = JsonIndex(path)
+    >>> index['a'] = {'b': [1, 2]}
+    >>> index.save()
+    >>> JsonIndex(path)
+    {'a': {'b': [1, 2]}}
+    """
+    def __init__(self, path):
+        assert isinstance(path, Path)
+        self.path = path
+        if path.is_file():
+            with path.open('rt') as filehandle:
+                super().__init__(json.load(filehandle))
+    def save(self):
+        """Write atomically - a crashed run never leaves a half written index"""
+        write_json_atomic(self.path, self)
+
+
+CACHE_FUNCTIONS = {}  # 'module.qualname' -> every function decorated with `cache_disk` (for `cache_infos`)
+def cache_infos():
+    return {name: function.cache_info()._asdict() for name, function in sorted(CACHE_FUNCTIONS.items())}
+
+
+@cache
+def cache_backend(cache_path):
+    """
+    Backends are shared per path (sqlite connections in particular)
+    """
+    if cache_path.suffix in ('.sqlite', '.sqlite3', '.db'):
+        return SqliteCacheBackend(cache_path, max_bytes=int(environ.get('CACHE_MAX_BYTES', 0)) or None)
+    return FileCacheBackend(cache_path)
+
+def default_cache_backend():
+    """
+    The backend for `CACHE_PATH` as it is now - looked up on use (not at import), so a test/benchmark can point `CACHE_PATH` elsewhere
+    """
+    return cache_backend(Path(environ.get('CACHE_PATH', DEFAULT_CACHE_PATH)))
+
+def cache_disk(original_function=None, cache_path=None, ttl=datetime.timedelta(days=1), cache_only=False, args_to_bytes_func=lambda *args, **kwargs: pickle.dumps((args, kwargs)), backend=None, memory_size=None):
+    """
+    `memory_size` adds a bounded in-process LRU tier in front of the backend (values are shared, not copied - don't mutate them)
+    Without a `cache_path`/`backend` the `default_cache_backend()` is used - whichever `CACHE_PATH` is set when called
+
+    >>> import tempfile
+    >>> calls = []
+    >>> @cache_disk(cache_path=Path(tempfile.mkdtemp()).joinpath('cache.sqlite'), memory_size=8)
+    ... def double(a):
+    ...     calls.append(a)
+    ...     if a < 0:
+    ...         raise DoNotPersistCacheException()
+    ...     return a * 2
+    >>> double(2), double(2), double(-1), double(-1)
+    (4, 4, None, None)
+    >>> calls
+    [2, -1, -1]
+    >>> double.cache_info()
+    CacheInfo(memory_hits=1, disk_hits=0, misses=3, expired=0, memory_size=1, memory_maxsize=8)
+    >>> 'cache_tools.double' in CACHE_FUNCTIONS
+    True
+    >>> double.cache_set(6, 3)
+    >>> double(3), double.cache_get(3), calls
+    (6, 6, [2, -1, -1])
+    """
+    assert cache_path is None or isinstance(cache_path, Path)
     assert isinstance(ttl, datetime.timedelta)
-    cache_path.mkdir(exist_ok=True)
+    if backend or cache_path:
+        backend = backend or cache_backend(cache_path)
+        get_backend = lambda: backend
+    else:
+        get_backend = default_cache_backend
 
     def _decorate(function):
+        memory = MemoryCache(memory_size) if memory_size else None
+        stats = dict(memory_hits=0, disk_hits=0, misses=0, expired=0)
+        stats_lock = threading.Lock()  # cached functions are called from worker threads
+        def _count(stat):
+            with stats_lock:
+                stats[stat] += 1
         @wraps(function)
         def wrapped_function(*args, **kwargs):
-            cache = cache_path.joinpath(hashlib.sha1(args_to_bytes_func(*args, **kwargs)).hexdigest())
-            if cache.is_file() and (
-                datetime.datetime.fromtimestamp(cache.stat().st_mtime) > datetime.datetime.now() - ttl
-            ):
+            key = hashlib.sha1(args_to_bytes_func(*args, **kwargs)).hexdigest()
+            if memory:
+                try:
+                    _return = memory.get(key, ttl)
+                    _count('memory_hits')
+                    return _return
+                except KeyError:
+                    pass
+            try:
+                timestamp, _return = get_backend().get_timestamped(key, ttl)
                 log.debug(f'loading from cache {args=} {kwargs=}')
-                return pickle.load(cache.open(mode='rb'))
+                _count('disk_hits')
+                if memory:
+                    memory.set(key, _return, timestamp)  # expires with the disk entry, not `ttl` from now
+                return _return
+            except CacheExpired:
+                _count('expired')
+            except KeyError:
+                pass
+            _count('misses')
             if cache_only:
                 log.debug(f'cache_only - refusing to run original function')
                 return
@@ -39,7 +340,46 @@ def cache_disk(original_function=None, cache_path=Path('__cache'), ttl=datetime.
                 return
 
             log.debug(f'persisting to cache {args=} {kwargs=}')
-            pickle.dump(_return, cache.open(mode='wb'))
+            get_backend().set(key, _return, ttl)
+            if memory:
+                memory.set(key, _return)
+            return _return
+        def cache_info():
+            with stats_lock:
+                return CacheInfo(**stats, memory_size=len(memory.data) if memory else 0, memory_maxsize=memory_size or 0)
+        def cache_get(*args, **kwargs):
+            """Cached value for these args (without calling the function) - raises KeyError"""
+            key = hashlib.sha1(args_to_bytes_func(*args, **kwargs)).hexdigest()
+            if memory:
+                try:
+                    return memory.get(key, ttl)
+                except KeyError:
+                    pass
+            timestamp, _return = get_backend().get_timestamped(key, ttl)
+            if memory:
+                memory.set(key, _return, timestamp)
             return _return
+        def cache_set(_return, *args, **kwargs):
+            """Populate the cache for these args from elsewhere (e.g. a bulk/concurrent fetch)"""
+            key = hashlib.sha1(args_to_bytes_func(*args, **kwargs)).hexdigest()
+            get_backend().set(key, _return, ttl)
+            if memory:
+                memory.set(key, _return)
+        wrapped_function.cache_info = cache_info
+        wrapped_function.cache_get = cache_get
+        wrapped_function.cache_set = cache_set
+        CACHE_FUNCTIONS[f'{function.__module__}.{function.__qualname__}'] = wrapped_function
         return wrapped_function
     return _decorate(original_function) if callable(original_function) else _decorate
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Remove expired entries from a sqlite cache')
+    parser.add_argument('cache_path', type=Path, nargs='?', default=DEFAULT_CACHE_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    backend = cache_backend(args.cache_path)
+    if not hasattr(backend, 'compact'):
+        parser.error(f'{args.cache_path} is not a sqlite cache')
+    log.info(f'compacted {backend.compact()} entries from {args.cache_path}')
@@ -6,11 +6,14 @@ https://github.com/calaldees/frameworks_and_languages_module/network/members
 """
 
 import os
+import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import NamedTuple
 import logging
 
-import requests
+from github_requests import session
 
 log = logging.getLogger(__name__)
 
@@ -46,13 +49,18 @@ RobertBlackwell01
 from pathlib import Path
 path = Path(PATH_CLONE)
 path.mkdir(exist_ok=True)
+path_mirror = path.joinpath('.upstream.git')  # bare mirror of the upstream repo - student clones borrow its objects via alternates
+
+WORKERS = 8
+TIMEOUT_SECONDS = 600
+WARN_REPO_SIZE_BYTES = 100 * 1024 * 1024
 
 def run_shell(cmd, _TIMEOUT_SECONDS=120):
     return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=_TIMEOUT_SECONDS)
 
 def get_github_forks(username, repo):
     URL_forks = f"https://api.github.com/repos/{username}/{repo}/forks"
-    return requests.get(URL_forks).json()
+    return session.get(URL_forks).json()
 
 class ForkData(NamedTuple):
     login: str
@@ -62,7 +70,196 @@ class ForkData(NamedTuple):
         return ForkData(data['owner']['login'], data['clone_url'])
 
 
-def do():
+class SyncResult(NamedTuple):
+    login: str
+    action: str  # 'clone' or 'fetch'
+    ok: bool
+    seconds: float
+    size_bytes: int
+    error: str = ''
+
+
+def path_size_bytes(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames
+        if not os.path.islink(os.path.join(dirpath, filename))
+    )
+
+def _git_commands(fork, path_target, clone_filter=None, depth=None, reference=None):
+    """
+    `fetch` + fast-forward for an existing clone (never a merge - a diverged clone is reported, not 'fixed'), otherwise a (partial) clone
+    `reference` is a repo (the upstream mirror) whose objects new clones borrow instead of storing their own copy
+    `clone_filter`/`depth` only apply to the clone - a fetch keeps the clone's own filter (`remote.origin.partialclonefilter`)
+    and a `--depth` fetch would re-truncate history that later fetches have filled in
+
+    >>> fork = ForkData('student1', 'https://github.com/student1/repo.git')
+    >>> _git_commands(fork, Path('clones/student1'), clone_filter='blob:none', depth=1)
+    ('clone', (['git', 'clone', '--quiet', '--filter=blob:none', '--depth=1', 'https://github.com/student1/repo.git', 'clones/student1'],))
+    >>> _git_commands(fork, Path('clones/student1'), reference=Path('/clones/.upstream.git'))
+    ('clone', (['git', 'clone', '--quiet', '--reference-if-able', '/clones/.upstream.git', 'https://github.com/student1/repo.git', 'clones/student1'],))
+    >>> _git_commands(fork, Path('.'), clone_filter='blob:none', depth=1)[1][0]
+    ['git', '-C', '.', 'fetch', '--quiet', '--prune', 'origin']
+    """
+    if path_target.is_dir():
+        return 'fetch', (
+            ['git', '-C', str(path_target), 'fetch', '--quiet', '--prune', 'origin'],
+            ['git', '-C', str(path_target), 'merge', '--quiet', '--ff-only', '@{upstream}'],
+        )
+    options = ([f'--filter={clone_filter}'] if clone_filter else []) + ([f'--depth={depth}'] if depth else [])
+    reference = ['--reference-if-able', str(reference)] if reference else []
+    return 'clone', (['git', 'clone', '--quiet', *reference, *options, fork.clone_url, str(path_target)], )
+
+def sync_mirror(clone_url, path_mirror=path_mirror, timeout=TIMEOUT_SECONDS):
+    """
+    Create/update the bare upstream mirror.
+    Objects are never pruned from it (`gc.pruneExpire=never`) - clones reference them via alternates
+    """
+    path_mirror = Path(path_mirror)
+    if path_mirror.is_dir():
+        action, commands = 'fetch', (['git', '-C', str(path_mirror), 'fetch', '--quiet', '--prune'], )
+    else:
+        action, commands = 'clone', (
+            ['git', 'clone', '--quiet', '--mirror', clone_url, str(path_mirror)],
+            ['git', '-C', str(path_mirror), 'config', 'gc.pruneExpire', 'never'],
+        )
+    return _run_commands('(upstream)', action, commands, path_mirror, timeout)
+
+def _run_commands(login, action, commands, path_target, timeout):
+    start = time.monotonic()
+    error = ''
+    try:
+        for cmd in commands:
+            cmd_result = run_shell(cmd, _TIMEOUT_SECONDS=timeout)
+            if cmd_result.returncode != 0:
+                error = cmd_result.stderr.decode('utf8', errors='replace').strip()
+                break
+    except subprocess.TimeoutExpired:
+        error = f'timeout after {timeout} seconds'
+    return SyncResult(
+        login=login,
+        action=action,
+        ok=not error,
+        seconds=time.monotonic() - start,
+        size_bytes=path_size_bytes(path_target) if path_target.is_dir() else 0,
+        error=error,
+    )
+
+def sync_fork(fork, path_clone=path, clone_filter=None, depth=None, timeout=TIMEOUT_SECONDS, reference=None):
+    """
+    Never raises - failures/timeouts are reported in the `SyncResult`
+
+    >>> import tempfile, datetime
+    >>> from github_stub import git_test_repo
+    >>> tempdir = Path(tempfile.mkdtemp())
+    >>> _ = git_test_repo(tempdir.joinpath('origin'), ((datetime.datetime(2023, 10, 1), {'a.md': 'A'}), ))
+    >>> fork = ForkData('student1', str(tempdir.joinpath('origin')))
+    >>> sync_fork(fork, tempdir.joinpath('clones')).action, sync_fork(fork, tempdir.joinpath('clones'))[:3]
+    ('clone', ('student1', 'fetch', True))
+    >>> sync_fork(ForkData('student2', str(tempdir.joinpath('nope'))), tempdir.joinpath('clones'))[:3]
+    ('student2', 'clone', False)
+    """
+    path_target = Path(path_clone).joinpath(fork.login)
+    action, commands = _git_commands(fork, path_target, clone_filter=clone_filter, depth=depth, reference=reference)
+    return _run_commands(fork.login, action, commands, path_target, timeout)
+
+def sync(forks, path_clone=path, workers=WORKERS, **kwargs):
+    """
+    Sync forks concurrently - returns a `SyncResult` per fork (in fork order)
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return tuple(executor.map(lambda fork: sync_fork(fork, path_clone, **kwargs), forks))
+
+# Alternates -------------------------------------------------------------------
+
+def _alternates_file(path_target):
+    return Path(path_target).joinpath('.git', 'objects', 'info', 'alternates')
+
+def alternates(path_target):
+    """Object directories a clone borrows from"""
+    try:
+        return tuple(Path(line) for line in _alternates_file(path_target).read_text().splitlines() if line.strip() and not line.startswith('#'))
+    except FileNotFoundError:
+        return ()
+
+def check_clone(path_target, timeout=TIMEOUT_SECONDS):
+    """
+    Returns an error description for a broken clone, '' when healthy
+    """
+    missing = tuple(str(path) for path in alternates(path_target) if not path.is_dir())
+    if missing:
+        return f'alternates missing: {", ".join(missing)}'
+    try:
+        cmd_result = run_shell(['git', '-C', str(path_target), 'fsck', '--connectivity-only', '--no-progress'], _TIMEOUT_SECONDS=timeout)
+    except subprocess.TimeoutExpired:
+        return f'fsck timeout after {timeout} seconds'
+    return cmd_result.stderr.decode('utf8', errors='replace').strip() if cmd_result.returncode != 0 else ''
+
+def repair_clone(fork, path_clone=path, path_mirror=path_mirror, timeout=TIMEOUT_SECONDS, **kwargs):
+    """
+    Clones whose alternates have gone stale (mirror moved/deleted/pruned) are
+    1. re-pointed at the current mirror, if that makes them whole
+    2. otherwise deleted and cloned again
+
+    >>> import tempfile, datetime
+    >>> from github_stub import git_test_repo
+    >>> tempdir = Path(tempfile.mkdtemp())
+    >>> _ = git_test_repo(tempdir.joinpath('upstream'), ((datetime.datetime(2023, 9, 26), {'a.md': 'template'}), ))
+    >>> sync_mirror(str(tempdir.joinpath('upstream')), tempdir.joinpath('mirror.git')).ok
+    True
+    >>> fork = ForkData('student1', str(tempdir.joinpath('upstream')))
+    >>> sync_fork(fork, tempdir.joinpath('clones'), reference=tempdir.joinpath('mirror.git')).ok
+    True
+    >>> alternates(tempdir.joinpath('clones', 'student1')) == (tempdir.joinpath('mirror.git', 'objects'), )
+    True
+    >>> _ = tempdir.joinpath('mirror.git').rename(tempdir.joinpath('moved.git'))
+    >>> check_clone(tempdir.joinpath('clones', 'student1')).startswith('alternates missing')
+    True
+    >>> repair_clone(fork, tempdir.joinpath('clones'), tempdir.joinpath('moved.git'))[:3], check_clone(tempdir.joinpath('clones', 'student1'))
+    (('student1', 'repair', True), '')
+    >>> _ = shutil.rmtree(tempdir.joinpath('moved.git'))
+    >>> repair_clone(fork, tempdir.joinpath('clones'), tempdir.joinpath('moved.git'))[:3], alternates(tempdir.joinpath('clones', 'student1'))
+    (('student1', 'clone', True), ())
+    """
+    path_target = Path(path_clone).joinpath(fork.login)
+    start = time.monotonic()
+    error = check_clone(path_target, timeout)
+    if error and alternates(path_target) and Path(path_mirror).is_dir():
+        log.info(f'repair: {path_target} re-pointing alternates to {path_mirror}')
+        _alternates_file(path_target).write_text(f'{Path(path_mirror).resolve().joinpath("objects")}\n')
+        error = check_clone(path_target, timeout)
+    if error:
+        log.warning(f'repair: {path_target} {error} - cloning again')
+        shutil.rmtree(path_target)
+        return sync_fork(fork, path_clone, timeout=timeout, reference=path_mirror if Path(path_mirror).is_dir() else None, **kwargs)
+    return SyncResult(fork.login, 'repair', True, time.monotonic() - start, path_size_bytes(path_target))
+
+
+def summary(results, warn_size_bytes=WARN_REPO_SIZE_BYTES):
+    """
+    >>> print(summary((
+    ...     SyncResult('student1', 'fetch', True, 1.5, 2 * 1024 * 1024),
+    ...     SyncResult('student2', 'clone', False, 120.0, 0, 'fatal: repository not found'),
+    ...     SyncResult('student3', 'clone', True, 30.0, 300 * 1024 * 1024),
+    ... )))
+    student1   fetch ok         1.5s       2.0MB
+    student2   clone FAILED   120.0s       0.0MB fatal: repository not found
+    student3   clone ok        30.0s     300.0MB WARNING: larger than 100.0MB
+    3 repos: 2 ok, 1 failed, 302.0MB, 151.5s
+    """
+    lines = []
+    for result in results:
+        note = result.error.splitlines()[-1] if result.error else ''
+        if result.size_bytes > warn_size_bytes:
+            note = f'WARNING: larger than {warn_size_bytes/1024/1024:.1f}MB'
+        lines.append(f'{result.login:10} {result.action:5} {"ok" if result.ok else "FAILED":6} {result.seconds:7.1f}s {result.size_bytes/1024/1024:9.1f}MB {note}'.rstrip())
+    ok = sum(result.ok for result in results)
+    lines.append(f'{len(results)} repos: {ok} ok, {len(results) - ok} failed, {sum(result.size_bytes for result in results)/1024/1024:.1f}MB, {sum(result.seconds for result in results):.1f}s')
+    return '\n'.join(lines)
+
+
+def do(workers=WORKERS, clone_filter=None, depth=None, timeout=TIMEOUT_SECONDS, warn_size_bytes=WARN_REPO_SIZE_BYTES, mirror=True, repair=False):
 
     #from pprint import pprint
     #pprint(forks)
@@ -72,28 +269,35 @@ def do():
     log.info(f'found {len(forks)}')
 
     if GITHUB_LOGINS_FILTER:
-        forks = filter(lambda fork: fork.login in GITHUB_LOGINS_FILTER, forks)
-
-    for fork in forks:
-        path_target = path.joinpath(fork.login)
-        if path_target.is_dir():  # pull existing folder
-            # https://stackoverflow.com/a/48566525/3356840
-            log.info(f'pull: {path_target}')
-            cmd_result = run_shell(['git', '-C', path_target, 'pull']) #f'git -C {path_target} pull'
-            assert cmd_result.returncode == 0, cmd_result
-            #print(cmd_result)   # debug to see which files have changed
-        else:  # clone if not exist
-            log.info(f'clone: {path_target}')
-            cmd_result = run_shell(['git', 'clone', fork.clone_url, path_target])  # f'git clone {fork.clone_url} {path_target}'
-            assert cmd_result.returncode == 0, cmd_result
-            assert path_target.is_dir()
+        forks = tuple(filter(lambda fork: fork.login in GITHUB_LOGINS_FILTER, forks))
+
+    results = ()
+    reference = None
+    if mirror:
+        log.info(f'mirror: {path_mirror}')
+        results += (sync_mirror(f'https://github.com/{GITHUB_USERNAME}/{GITHUB_REPO}.git', path_mirror, timeout=timeout), )
+        reference = path_mirror.resolve() if results[-1].ok else None
+    if repair:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results += tuple(executor.map(lambda fork: repair_clone(fork, path, path_mirror, timeout=timeout), (fork for fork in forks if path.joinpath(fork.login).is_dir())))
+    results += sync(forks, path, workers=workers, clone_filter=clone_filter, depth=depth, timeout=timeout, reference=reference)
+    log.info(f'sync summary\n{summary(results, warn_size_bytes)}')
+    return results
 
 # TODO: 
-# Warn if repo size bigger than XX
-# `du -shc *``
 # Exclude from date (only newer?)
 # Collect results somehow (junit?) is this worthwhile?
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=f'Clone/update the forks of {GITHUB_USERNAME}/{GITHUB_REPO} into {PATH_CLONE}')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--filter', help='partial clone filter e.g. `blob:none` (new clones only)')
+    parser.add_argument('--depth', type=int, help='shallow clone depth (new clones only)')
+    parser.add_argument('--timeout', type=int, default=TIMEOUT_SECONDS, help='seconds per git command')
+    parser.add_argument('--warn_size_mb', type=float, default=WARN_REPO_SIZE_BYTES/1024/1024)
+    parser.add_argument('--no_mirror', action='store_true', help=f'full clones - without the shared upstream object store {path_mirror}')
+    parser.add_argument('--repair', action='store_true', help='fix clones whose alternates have gone stale (re-point at the mirror or clone again)')
+    args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    do()
+    do(workers=args.workers, clone_filter=args.filter, depth=args.depth, timeout=args.timeout, warn_size_bytes=args.warn_size_mb*1024*1024, mirror=not args.no_mirror, repair=args.repair)
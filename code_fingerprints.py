@@ -0,0 +1,371 @@
+"""
+MOSS style source code similarity across the `clone.py` clones
+
+Source files are tokenised with names/strings/numbers normalised (renaming variables does not hide a copy),
+k-grams of tokens are hashed and winnowed (the minimum hash of every window is kept - Schleimer, Wilkerson & Aiken 2003
+http://theory.stanford.edu/~aiken/publications/papers/sigmod03.pdf) and stored in a sqlite inverted index (hash -> blob + line range).
+
+Fingerprints are keyed by git blob sha, so after a `git pull` only new blobs are fingerprinted
+(and a file that is identical in many forks is fingerprinted once).
+Every fingerprint found anywhere in the upstream mirror's history is ignored - code inherited from the template repo is not evidence.
+
+    python3 code_fingerprints.py --index
+    python3 code_fingerprints.py
+    python3 code_fingerprints.py student1 student2
+"""
+import re
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path, PurePosixPath
+from itertools import groupby
+from functools import cache
+from typing import NamedTuple
+
+from git_local import GitCatFile, _git
+
+import logging
+log = logging.getLogger(__name__)
+
+
+K = 12  # tokens per k-gram - shorter runs of matching tokens are noise
+WINDOW = 8  # any match of at least K + WINDOW - 1 tokens is guaranteed to share a fingerprint
+MIN_SHARED = 10  # fingerprints two forks must share to be reported
+MAX_FORKS = 8  # a fingerprint in more forks than this is a common idiom/boilerplate, not copying
+MAX_FILE_BYTES = 256 * 1024
+UPSTREAM = ''  # `files.fork` for the upstream repo
+SOURCE_SUFFIXES = frozenset((
+    '.py', '.js', '.mjs', '.cjs', '.jsx', '.ts', '.tsx', '.vue', '.svelte', '.java', '.kt', '.cs', '.go', '.rs',
+    '.rb', '.php', '.c', '.h', '.cpp', '.hpp', '.swift', '.dart', '.scala', '.html', '.css', '.scss', '.sh',
+))
+SKIP_FOLDERS = frozenset(('node_modules', 'vendor', 'dist', 'build', 'target', 'bin', 'obj', '__pycache__', '.venv', 'venv'))
+KEYWORDS = frozenset('''
+    if else elif for while do return function def class import from export const let var new try catch except finally
+    raise throw async await yield switch case break continue public private protected static void int float string bool
+    true false null none self this lambda with in of typeof instanceof interface extends implements package struct fn pub
+    use mut match enum type func go defer select
+'''.split())
+
+FINGERPRINT_VERSION = 2  # bump when tokenising changes - an index built by an older version is re-fingerprinted
+COMMENT_LINE_HASH, COMMENT_LINE_SLASH, COMMENT_BLOCK, COMMENT_HTML = r'\#[^\n]*', r'//[^\n]*', r'/\*.*?\*/', r'<!--.*?-->'
+COMMENTS_C = (COMMENT_LINE_SLASH, COMMENT_BLOCK)  # any suffix not listed below
+COMMENTS = {
+    **dict.fromkeys(('.py', '.rb', '.sh'), (COMMENT_LINE_HASH, )),
+    '.php': (COMMENT_LINE_HASH, ) + COMMENTS_C,
+    '.css': (COMMENT_BLOCK, ),
+    '.html': (COMMENT_HTML, ),
+    **dict.fromkeys(('.vue', '.svelte'), (COMMENT_HTML, ) + COMMENTS_C),
+}
+REGEX_TOKENS = r'''
+     (?P<comment>%s)
+    |(?P<string>"""(?:.|\n)*?"""|"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)
+    |(?P<number>\d[\w.]*)
+    |(?P<name>[^\W\d][\w$]*)
+    |(?P<symbol>[^\s\w])
+'''
+
+@cache
+def _regex_tokens(suffix):
+    """Comment syntax is per language - `#` is a CSS colour/C preprocessor line and `//` is Python's floor division"""
+    return re.compile(REGEX_TOKENS % '|'.join(COMMENTS.get(suffix.lower(), COMMENTS_C)), re.VERBOSE | re.DOTALL)
+
+def _suffix(path):
+    """
+    >>> _suffix('src/App.JSX'), _suffix('server.py@4b825dc6')
+    ('.jsx', '.py')
+    """
+    return PurePosixPath(path).suffix.lower().split('@')[0]  # `history_blobs` keys are `path@blob`
+
+
+def tokenise(text, suffix=''):
+    """
+    `(token, line)` with comments dropped and names/strings/numbers normalised - keywords and symbols are kept
+
+    >>> tuple(token for token, line in tokenise('const total = add(price, 2)  // sum\\nreturn "done"', '.js'))
+    ('const', 'V', '=', 'V', '(', 'V', ',', 'N', ')', 'return', 'S')
+    >>> ' '.join(token for token, line in tokenise('#main { color: #fff; } /* c */', '.css'))
+    '# V { V : # V ; }'
+    >>> ' '.join(token for token, line in tokenise('# comment\\nx = a // b', '.py'))
+    'V = V / / V'
+    """
+    line = 1
+    position = 0
+    for match in _regex_tokens(suffix).finditer(text):
+        line += text.count('\n', position, match.start())
+        position = match.start()
+        kind = match.lastgroup
+        if kind == 'comment':
+            continue
+        elif kind == 'string':
+            yield 'S', line
+        elif kind == 'number':
+            yield 'N', line
+        elif kind == 'name':
+            yield (match.group().lower() if match.group().lower() in KEYWORDS else 'V'), line
+        else:
+            yield match.group(), line
+
+def _hash(tokens):
+    return int.from_bytes(hashlib.blake2b(' '.join(tokens).encode('utf8'), digest_size=8).digest(), 'big', signed=True)  # sqlite INTEGER is signed 64 bit
+
+def fingerprints(text, suffix='', k=K, window=WINDOW):
+    """
+    Winnowed `(hash, line_start, line_end)` for `text` - `suffix` (e.g. `.py`) selects the comment syntax
+
+    >>> a = fingerprints('def total(items):\\n    result = 0\\n    for item in items:\\n        result += item.price * item.count\\n    return result\\n', '.py')
+    >>> b = fingerprints('def sum_up(things):  # renamed\\n    acc = 0\\n    for thing in things:\\n        acc += thing.cost * thing.n\\n    return acc\\n', '.py')
+    >>> {h for h, *_ in a} == {h for h, *_ in b}, a[0][1:]
+    (True, (1, 3))
+    """
+    tokens = tuple(tokenise(text, suffix))
+    hashes = tuple(
+        (_hash(token for token, _ in tokens[i:i+k]), tokens[i][1], tokens[i+k-1][1])
+        for i in range(len(tokens) - k + 1)
+    )
+    selected = []
+    last = None
+    for start in range(max(len(hashes) - window + 1, 1 if hashes else 0)):
+        _window = hashes[start:start+window]
+        index = start + min(range(len(_window)), key=lambda i: (_window[i][0], -i))  # rightmost minimum
+        if index != last:
+            selected.append(hashes[index])
+            last = index
+    return tuple(selected)
+
+
+def source_files(repo_path, rev='HEAD'):
+    """
+    `{path: blob_sha}` of the source files at `rev` (read from git - the working tree is not touched)
+    """
+    _return = {}
+    for line in _git(repo_path, 'ls-tree', '-r', '-z', '--long', rev).split('\0'):
+        if not line:
+            continue
+        meta, path = line.split('\t', 1)
+        mode, _type, blob, size = meta.split()
+        path = PurePosixPath(path)
+        if _type != 'blob' or size == '-' or int(size) > MAX_FILE_BYTES or path.suffix.lower() not in SOURCE_SUFFIXES:
+            continue
+        if SKIP_FOLDERS.intersection(path.parts[:-1]) or path.name.endswith(('.min.js', '.min.css')):
+            continue
+        _return[str(path)] = blob
+    return _return
+
+def history_blobs(repo_path):
+    """
+    Every source blob in the history of every branch and tag - for the upstream repo (students fork at different points).
+    Not `--all` - a mirror also fetches `refs/pull/*`, and student pull requests are not upstream code.
+
+    >>> import tempfile, datetime
+    >>> from github_stub import git_test_repo
+    >>> path = Path(tempfile.mkdtemp())
+    >>> shas = git_test_repo(path, ((datetime.datetime(2023, 9, 25), {'server.py': 'upstream'}), (datetime.datetime(2023, 10, 1), {'client.py': 'student'})))
+    >>> _ = _git(path, 'update-ref', 'refs/pull/1/head', shas[1]), _git(path, 'reset', '--hard', '--quiet', shas[0])
+    >>> tuple(key.split('@')[0] for key in history_blobs(path))
+    ('server.py',)
+    """
+    blobs = {}
+    for line in _git(repo_path, 'rev-list', '--objects', '--branches', '--tags').splitlines():
+        sha, _, path = line.partition(' ')
+        path = PurePosixPath(path)
+        if path.suffix.lower() in SOURCE_SUFFIXES and not SKIP_FOLDERS.intersection(path.parts[:-1]):
+            blobs[str(path) + '@' + sha] = sha
+    return blobs
+
+
+class Pair(NamedTuple):
+    fork_a: str
+    fork_b: str
+    shared: int
+    similarity: float  # shared / fingerprints of the smaller fork
+
+class Overlap(NamedTuple):
+    path_a: str
+    lines_a: tuple  # ((line_start, line_end), ...)
+    path_b: str
+    lines_b: tuple
+    shared: int
+
+def _merge_ranges(ranges):
+    """
+    >>> _merge_ranges(((5, 9), (1, 3), (4, 4), (12, 13)))
+    ((1, 9), (12, 13))
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return tuple(merged)
+
+
+class CodeIndex():
+    r"""
+    >>> import tempfile, datetime
+    >>> from github_stub import git_test_repo
+    >>> tempdir = Path(tempfile.mkdtemp())
+    >>> given = 'from http.server import HTTPServer\n\ndef serve(port):\n    server = HTTPServer(("", port), Handler)\n    server.serve_forever()\n'
+    >>> copied = 'def route(request):\n    if request.method == "GET" and request.path == "/items":\n        return json_response(200, [item.to_dict() for item in ITEMS.values()])\n    if request.method == "POST":\n        ITEMS[request.body["id"]] = Item(**request.body)\n        return json_response(201, request.body)\n    return json_response(404, {})\n'
+    >>> _ = git_test_repo(tempdir.joinpath('upstream'), ((datetime.datetime(2023, 9, 26), {'server.py': given}), ))
+    >>> for login, code in (('alice', copied), ('bob', 'import sys\n\n' + copied.replace('request', 'req')), ('carol', 'print("my own work")\n')):
+    ...     _ = _git(tempdir, 'clone', '--quiet', 'upstream', f'clones/{login}')
+    ...     _ = git_test_repo(tempdir.joinpath('clones', login), ((datetime.datetime(2023, 10, 3), {'routes.py': code}), ))
+    >>> index = CodeIndex(tempdir.joinpath('code.sqlite'))
+    >>> index.index_clones(tempdir.joinpath('clones'), tempdir.joinpath('upstream'))
+    {'alice': 1, 'bob': 1, 'carol': 1}
+    >>> index.index_clones(tempdir.joinpath('clones'), tempdir.joinpath('upstream'))  # nothing changed - nothing fingerprinted
+    {'alice': 0, 'bob': 0, 'carol': 0}
+    >>> index.pairs(min_shared=2)
+    (Pair(fork_a='alice', fork_b='bob', shared=16, similarity=1.0),)
+    >>> index.overlaps('alice', 'bob')
+    (Overlap(path_a='routes.py', lines_a=((2, 7),), path_b='routes.py', lines_b=((4, 9),), shared=16),)
+    """
+    def __init__(self, path=Path('__index/code_fingerprints.sqlite')):
+        assert isinstance(path, Path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if not self._db:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != FINGERPRINT_VERSION:
+                with self._db:
+                    for table in ('blobs', 'fingerprints', 'upstream'):
+                        self._db.execute(f'DROP TABLE IF EXISTS {table}')
+                    self._db.execute(f'PRAGMA user_version={FINGERPRINT_VERSION}')
+            self._db.execute('CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, blob TEXT, line_start INTEGER, line_end INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS fingerprints_blob ON fingerprints (blob)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (fork TEXT, path TEXT, blob TEXT, PRIMARY KEY (fork, path))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_blob ON files (blob)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS upstream (hash INTEGER PRIMARY KEY)')
+        return self._db
+
+    def _fingerprint_blobs(self, repo_path, blobs):
+        """Fingerprint the `blobs` (`{blob: suffix}`) not already in the index - returns how many were new"""
+        with self._lock:
+            known = {blob for blob, in self.db.execute(f'SELECT blob FROM blobs WHERE blob IN ({",".join("?" * len(blobs))})', tuple(blobs))} if blobs else set()
+        new = tuple(sorted(set(blobs) - known))
+        with GitCatFile(repo_path) as cat_file:
+            rows = tuple(
+                (_hash, blob, line_start, line_end)
+                for blob in new
+                for _hash, line_start, line_end in fingerprints((cat_file.read(blob) or b'').decode('utf8', errors='replace'), blobs[blob])
+            )
+        with self._lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO blobs VALUES (?)', ((blob, ) for blob in new))
+            self.db.executemany('INSERT INTO fingerprints VALUES (?,?,?,?)', rows)
+        return len(new)
+
+    def index_repo(self, fork, repo_path, rev='HEAD', files=None):
+        """
+        Bring `fork`'s files in line with `rev` - returns the number of blobs fingerprinted
+        """
+        files = files if files is not None else source_files(repo_path, rev)
+        count = self._fingerprint_blobs(repo_path, {blob: _suffix(path) for path, blob in sorted(files.items(), reverse=True)})  # a blob at several paths - the first path's suffix
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM files WHERE fork=?', (fork, ))
+            self.db.executemany('INSERT INTO files VALUES (?,?,?)', ((fork, path, blob) for path, blob in files.items()))
+        return count
+
+    def index_upstream(self, repo_path):
+        count = self.index_repo(UPSTREAM, repo_path, files=history_blobs(repo_path))
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM upstream')
+            self.db.execute('INSERT OR IGNORE INTO upstream SELECT hash FROM fingerprints JOIN files USING (blob) WHERE files.fork=?', (UPSTREAM, ))
+        return count
+
+    def index_clones(self, path_clone, path_upstream=None):
+        """
+        Index every clone (`path_clone/<login>`) and the upstream repo - `{login: blobs fingerprinted}`
+        """
+        if path_upstream and Path(path_upstream).is_dir():
+            log.info(f'upstream: {self.index_upstream(path_upstream)} new blobs')
+        _return = {}
+        for repo_path in sorted(Path(path_clone).iterdir()):
+            if repo_path.name.startswith('.') or not repo_path.joinpath('.git').exists():
+                continue
+            try:
+                _return[repo_path.name] = self.index_repo(repo_path.name, repo_path)
+            except Exception:
+                log.exception(f'unable to index {repo_path}')
+        return _return
+
+    _FORK_HASHES = '''
+        fork_hashes AS (
+            SELECT DISTINCT files.fork, fingerprints.hash FROM files JOIN fingerprints USING (blob)
+            WHERE files.fork != :upstream AND fingerprints.hash NOT IN (SELECT hash FROM upstream)
+        ),
+        distinctive AS (SELECT hash FROM fork_hashes GROUP BY hash HAVING COUNT(*) BETWEEN 2 AND :max_forks)
+    '''
+    def pairs(self, min_shared=MIN_SHARED, max_forks=MAX_FORKS):
+        """
+        Forks sharing at least `min_shared` distinctive fingerprints - most shared first
+        """
+        with self._lock:
+            rows = self.db.execute(f'''
+                WITH {self._FORK_HASHES},
+                totals AS (SELECT fork, COUNT(*) AS total FROM fork_hashes GROUP BY fork),
+                shared AS (
+                    SELECT a.fork AS fork_a, b.fork AS fork_b, COUNT(*) AS shared
+                    FROM fork_hashes a JOIN fork_hashes b ON a.hash = b.hash AND a.fork < b.fork
+                    WHERE a.hash IN (SELECT hash FROM distinctive)
+                    GROUP BY a.fork, b.fork HAVING COUNT(*) >= :min_shared
+                )
+                SELECT fork_a, fork_b, shared, ROUND(1.0 * shared / MIN(ta.total, tb.total), 2)
+                FROM shared JOIN totals ta ON ta.fork = fork_a JOIN totals tb ON tb.fork = fork_b
+                ORDER BY shared DESC, fork_a, fork_b
+            ''', {'upstream': UPSTREAM, 'max_forks': max_forks, 'min_shared': min_shared}).fetchall()
+        return tuple(Pair(*row) for row in rows)
+
+    def overlaps(self, fork_a, fork_b, max_forks=MAX_FORKS):
+        """
+        The files and line ranges that `fork_a` and `fork_b` share fingerprints in
+        """
+        with self._lock:
+            rows = self.db.execute(f'''
+                WITH {self._FORK_HASHES}
+                SELECT fa.path, pa.line_start, pa.line_end, fb.path, pb.line_start, pb.line_end, pa.hash
+                FROM files fa JOIN fingerprints pa ON pa.blob = fa.blob
+                JOIN fingerprints pb ON pb.hash = pa.hash JOIN files fb ON fb.blob = pb.blob
+                WHERE fa.fork = :fork_a AND fb.fork = :fork_b AND pa.hash IN (SELECT hash FROM distinctive)
+                ORDER BY fa.path, fb.path
+            ''', {'upstream': UPSTREAM, 'max_forks': max_forks, 'fork_a': fork_a, 'fork_b': fork_b}).fetchall()
+        return tuple(sorted((
+            Overlap(
+                path_a, _merge_ranges(row[1:3] for row in _rows),
+                path_b, _merge_ranges(row[4:6] for row in _rows),
+                len({row[6] for row in _rows}),
+            )
+            for (path_a, path_b), _rows in ((key, tuple(group)) for key, group in groupby(rows, key=lambda row: (row[0], row[3])))
+        ), key=lambda overlap: -overlap.shared))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Source code similarity between the fork clones (winnowed fingerprints)')
+    parser.add_argument('forks', nargs='*', help='two forks - list their overlapping files/lines (otherwise list the most similar pairs)')
+    parser.add_argument('--index', action='store_true', help='(re)index the clones first - only changed files are processed')
+    parser.add_argument('--path', type=Path, default=Path('__index/code_fingerprints.sqlite'))
+    parser.add_argument('--min_shared', type=int, default=MIN_SHARED)
+    parser.add_argument('--max_forks', type=int, default=MAX_FORKS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    index = CodeIndex(args.path)
+    if args.index:
+        from clone import path as path_clone, path_mirror
+        log.info(f'indexed {index.index_clones(path_clone, path_mirror)}')
+    if len(args.forks) == 2:
+        for overlap in index.overlaps(*args.forks, max_forks=args.max_forks):
+            ranges = lambda lines: ','.join(f'{start}-{end}' for start, end in lines)
+            print(f'{overlap.shared}\t{overlap.path_a}:{ranges(overlap.lines_a)}\t{overlap.path_b}:{ranges(overlap.lines_b)}')
+    else:
+        for pair in index.pairs(args.min_shared, args.max_forks):
+            print(f'{pair.shared}\t{pair.similarity:.2f}\t{pair.fork_a}\t{pair.fork_b}')
@@ -0,0 +1,226 @@
+"""
+Local git object source for `GitHubForkData`
+
+`clone.py` already mirrors every fork to `PATH_CLONE/<login>`.
+Commit history comes from one `git log` per repo and the `markdown_template_filename` blobs from long-lived
+`git cat-file --batch`/`--batch-check` processes (one per repo - not one subprocess per object).
+The API is then only needed for the fork listing, workflow runs and artifacts.
+
+https://git-scm.com/docs/git-cat-file#_batch_output
+"""
+import atexit
+import weakref
+import datetime
+import subprocess
+import threading
+from functools import cached_property
+from collections import OrderedDict
+from pathlib import Path
+
+import github
+
+import logging
+log = logging.getLogger(__name__)
+
+
+MAX_GIT_CAT_FILES = 32  # repos with open `git cat-file` processes (two each) per data source
+
+
+def _git(path, *args):
+    return subprocess.run(('git', '-C', str(path)) + args, check=True, capture_output=True).stdout.decode('utf8')
+
+def git_log(path, rev='HEAD'):
+    """
+    Yield `(sha, committer_date)` newest first - dates are naive UTC (like the rest of the crawl)
+    """
+    for line in _git(path, 'log', '--format=%H %ct', rev).splitlines():
+        sha, timestamp = line.split()
+        yield sha, datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc).replace(tzinfo=None)
+
+def git_rev_list(path):
+    return _git(path, 'rev-list', '--all').split()
+
+
+class GitCatFileException(Exception):
+    pass
+
+_git_cat_files_open = weakref.WeakSet()
+@atexit.register
+def _close_git_cat_files():
+    for cat_file in tuple(_git_cat_files_open):
+        cat_file.close()
+
+
+class GitCatFile():
+    r"""
+    Long-lived `git cat-file` processes for a repo - objects are requested by name (`sha`, `ref:path`) over stdin
+
+    >>> import tempfile, hashlib
+    >>> from github_stub import git_test_repo
+    >>> path = Path(tempfile.mkdtemp())
+    >>> _ = git_test_repo(path, ((datetime.datetime(2023, 10, 1), {'a.md': '# A'}), (datetime.datetime(2023, 10, 2), {'a.md': '# A\nmore'})))
+    >>> with GitCatFile(path) as cat_file:
+    ...     cat_file.sha('HEAD~1:a.md') == hashlib.sha1(b'blob 3\x00# A').hexdigest(), cat_file.read('HEAD~1:a.md'), cat_file.read('HEAD:a.md')
+    ...     cat_file.sha('HEAD:missing.md'), cat_file.read('HEAD:missing.md'), cat_file.read(cat_file.sha('HEAD~1:a.md'))
+    (True, b'# A', b'# A\nmore')
+    (None, None, b'# A')
+    >>> cat_file = GitCatFile(path.joinpath('not_a_repo'))
+    >>> cat_file.sha('HEAD')
+    Traceback (most recent call last):
+    git_local.GitCatFileException: git cat-file --batch-check exited (128) in .../not_a_repo
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.processes = {}
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+    def close(self):
+        with self.lock:
+            for process in self.processes.values():
+                process.stdin.close()
+                process.wait()
+            self.processes.clear()
+
+    def _request(self, option, name):
+        """Caller holds `self.lock`. Returns the header fields - `None` for a missing object"""
+        if option not in self.processes:
+            self.processes[option] = subprocess.Popen(('git', '-C', str(self.path), 'cat-file', option), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            _git_cat_files_open.add(self)
+        process = self.processes[option]
+        try:
+            process.stdin.write(f'{name}\n'.encode('utf8'))
+            process.stdin.flush()
+            header = process.stdout.readline().decode('utf8').split()
+        except BrokenPipeError:
+            header = None
+        if not header:
+            del self.processes[option]  # the next request starts a fresh process
+            raise GitCatFileException(f'git cat-file {option} exited ({process.wait()}) in {self.path}')
+        if header[-1] in ('missing', 'ambiguous'):
+            return None
+        return process, header
+    def sha(self, name):
+        with self.lock:
+            response = self._request('--batch-check', name)
+        return response[1][0] if response else None
+    def read(self, name):
+        with self.lock:
+            response = self._request('--batch', name)
+            if not response:
+                return None
+            process, (sha, _type, size) = response
+            data = process.stdout.read(int(size) + 1)  # content is followed by a newline
+            if len(data) != int(size) + 1:
+                del self.processes['--batch']
+                raise GitCatFileException(f'git cat-file --batch exited ({process.wait()}) reading {name} in {self.path}')
+            return data[:-1]
+
+
+class GitHubForkData_GitLocalMixin():
+    r"""
+    Reads commit history and `markdown_template_filename` blobs from the `clone.py` clones in `settings['clone_path']`.
+    Commits reachable from a local clone of the upstream repo (`settings['upstream_path']`) are excluded (the REST crawl filters by author).
+    Forks without a local clone fall back to the API.
+
+    >>> import tempfile
+    >>> from types import SimpleNamespace
+    >>> from github_stub import git_test_repo
+    >>> from github_fork_data import DATA_SOURCES
+    >>> tempdir = Path(tempfile.mkdtemp())
+    >>> upstream = git_test_repo(tempdir.joinpath('upstream'), ((datetime.datetime(2023, 9, 26), {'technical_report.md': '# Template'}), ))
+    >>> _ = _git(tempdir, 'clone', '--quiet', 'upstream', 'clones/student1')
+    >>> shas = git_test_repo(tempdir.joinpath('clones', 'student1'), (
+    ...     (datetime.datetime(2023, 10, 3), {'technical_report.md': '# Template\nAnswer'}),
+    ...     (datetime.datetime(2023, 10, 4), {'other.txt': 'unrelated'}),
+    ...     (datetime.datetime(2024, 1, 1), {'technical_report.md': 'Too late'}),
+    ... ))
+    >>> data = DATA_SOURCES['local'](None, {
+    ...     'repo': 'teacher/repo', 'date_start': '2023-09-25', 'date_end': '2023-12-11', 'timedelta_days': '7', 'markdown_template_filename': 'technical_report.md',
+    ...     'clone_path': str(tempdir.joinpath('clones')), 'upstream_path': str(tempdir.joinpath('upstream')), 'index_path': str(tempdir.joinpath('index')),
+    ... })
+    >>> class Fork(SimpleNamespace):
+    ...     __hash__ = object.__hash__
+    >>> fork = Fork(full_name='student1/repo', owner=SimpleNamespace(login='student1'))
+    >>> {week: tuple(commit.sha for commit in commits) for week, commits in data._commits_grouped_by_week(fork).items()} == {1: (shas[1], shas[0])}
+    True
+    >>> index = data._commit_index(fork)
+    >>> index[shas[0]]['blob'] == index[shas[1]]['blob'], data._get_markdown_blob(fork, index[shas[0]]['blob'])
+    (True, '# Template\nAnswer')
+    >>> data._get_markdown_template(fork), data._get_markdown_template(SimpleNamespace(full_name='teacher/repo'), ref=upstream[0])
+    ('Too late', '# Template')
+    """
+    @cached_property
+    def clone_path(self):
+        return Path(self.settings.get('clone_path', './clone2023'))
+    @cached_property
+    def upstream_path(self):
+        return Path(self.settings['upstream_path']) if self.settings.get('upstream_path') else None
+    @cached_property
+    def upstream_shas(self):
+        return frozenset(git_rev_list(self.upstream_path)) if self.upstream_path else frozenset()
+
+    def _local_path(self, repo):
+        if repo.full_name == self.settings['repo']:
+            return self.upstream_path
+        path = self.clone_path.joinpath(repo.owner.login)
+        return path if path.joinpath('.git').exists() else None
+    @cached_property
+    def _git_cat_files(self):
+        return OrderedDict()  # path -> GitCatFile, least recently used first
+    _git_cat_files_lock = threading.Lock()
+    def _git_cat_file(self, path):
+        """
+        Open `git cat-file` processes are bounded by `MAX_GIT_CAT_FILES` - the least recently used repo's are closed
+        """
+        with self._git_cat_files_lock:
+            cat_files = self._git_cat_files
+            if path not in cat_files:
+                cat_files[path] = GitCatFile(path)
+            cat_files.move_to_end(path)
+            evicted = tuple(cat_files.popitem(last=False)[1] for _ in range(len(cat_files) - MAX_GIT_CAT_FILES))
+            cat_file = cat_files[path]
+        for _cat_file in evicted:
+            _cat_file.close()
+        return cat_file
+
+    def _sync_commit_index(self, repo):
+        path = self._local_path(repo)
+        if not path:
+            return super()._sync_commit_index(repo)
+        index = self._commit_index(repo)
+        cat_file = self._git_cat_file(path)
+        for sha, date in git_log(path):
+            if sha in index or sha in self.upstream_shas or not self.date_start <= date <= self.date_end:
+                continue
+            index[sha] = {
+                'date': date.isoformat(),
+                'url': f'https://api.github.com/repos/{repo.full_name}/commits/{sha}',
+                'blob': cat_file.sha(f'{sha}:{self.settings["markdown_template_filename"]}'),
+            }
+        index.save()
+        return index
+
+    def _get_markdown_blob_sha(self, repo, ref):
+        commit = self._commit_index(repo).get(ref)
+        if commit and 'blob' in commit:
+            return commit['blob']
+        path = self._local_path(repo)
+        if path:
+            return self._git_cat_file(path).sha(f'{ref}:{self.settings["markdown_template_filename"]}')
+        return super()._get_markdown_blob_sha(repo, ref)
+    def _get_markdown_blob(self, repo, blob_sha):
+        path = self._local_path(repo)
+        data = self._git_cat_file(path).read(blob_sha) if path else None
+        if data is None:
+            return super()._get_markdown_blob(repo, blob_sha)
+        return data.decode('utf8')
+
+    def _get_markdown_template(self, repo, ref=github.GithubObject.NotSet):
+        path = self._local_path(repo)
+        if not path:
+            return super()._get_markdown_template(repo, ref=ref)
+        data = self._git_cat_file(path).read(f'{ref if isinstance(ref, str) else "HEAD"}:{self.settings["markdown_template_filename"]}')
+        return data.decode('utf8') if data is not None else ''
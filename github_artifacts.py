@@ -1,17 +1,17 @@
 from functools import cached_property
 from types import MappingProxyType
 from zipfile import ZipFile
-import io
+from tempfile import SpooledTemporaryFile
 import re
 from os import environ
 
-import requests
-import xmljson
-
-
 from _utils import _add_methods
+from junit_records import junit_suite
+import github_requests
 class FileNotFoundInZipfileException(Exception):
     pass
+class ArtifactTooLargeException(Exception):
+    pass
 def open_regex(zipfile, regex):
     regex = re.compile(regex) if isinstance(regex, str) else regex
     for filename in zipfile.namelist():
@@ -21,33 +21,47 @@ def open_regex(zipfile, regex):
 
 
 
-def junit_to_json(element):
-    if hasattr(element, 'getroot'):
-        element = element.getroot()
-    if hasattr(element, '_elem'):
-        element = element._elem
-    data = xmljson.BadgerFish().data(element)
-    return data['testsuites']['testsuite']
-
-
 GITHUB_API_HEADERS = {
     "Accept": "application/vnd.github+json",
     "Authorization": f"token {environ['GITHUB_TOKEN']}",
 }
 
 class GithubArtifacts():
-    def __init__(self, url):
+    MAX_ARTIFACT_BYTES = 64 * 1024 * 1024  # Students sometimes upload node_modules/screenshots - we only want the junit xml
+    SPOOL_MEMORY_BYTES = 1024 * 1024  # Downloads larger than this are spooled to a temporary file
+    CHUNK_BYTES = 64 * 1024
+
+    def __init__(self, url, max_artifact_bytes=None, session=None):
         self.url = url
-        self.repo = re.match(r'.*api.github.*/repos/(?P<repo>.*)/actions/runs.*/artifacts', url).group(1)  # I hate this acquisition via regex
+        self.max_artifact_bytes = max_artifact_bytes or self.MAX_ARTIFACT_BYTES
+        self.session = session or github_requests.session
+        self.repo = re.match(r'.*/repos/(?P<repo>.*)/actions/runs.*/artifacts', url).group(1)  # I hate this acquisition via regex
     @cached_property
     def data(self):
-        return requests.get(self.url, headers=GITHUB_API_HEADERS).json()
+        return self.session.get(self.url, headers=GITHUB_API_HEADERS).json()
+    @cached_property
+    def artifacts(self):
+        return MappingProxyType({a["name"]: a for a in self.data["artifacts"]})
     @cached_property
     def artifact_urls(self):
-        return MappingProxyType({a["name"]: a["archive_download_url"] for a in self.data["artifacts"]})
+        return MappingProxyType({name: a["archive_download_url"] for name, a in self.artifacts.items()})
     def get_zipfile(self, name):
-        response = requests.get(self.artifact_urls[name], stream=True, allow_redirects=True, headers=GITHUB_API_HEADERS)
-        return _add_methods(ZipFile(io.BytesIO(response.content)), open_regex)
+        """
+        Stream the archive to a spooled temporary file (capped at `max_artifact_bytes`) so peak memory stays flat.
+        `open_regex` then only decompresses the single member we want.
+        """
+        if self.artifacts[name].get("size_in_bytes", 0) > self.max_artifact_bytes:
+            raise ArtifactTooLargeException(f'{name} {self.artifacts[name]["size_in_bytes"]} bytes')
+        spool = SpooledTemporaryFile(max_size=self.SPOOL_MEMORY_BYTES)
+        with self.session.get(self.artifact_urls[name], stream=True, allow_redirects=True, headers=GITHUB_API_HEADERS) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(self.CHUNK_BYTES):
+                if spool.tell() + len(chunk) > self.max_artifact_bytes:
+                    spool.close()
+                    raise ArtifactTooLargeException(f'{name} exceeded {self.max_artifact_bytes} bytes while downloading')
+                spool.write(chunk)
+        spool.seek(0)
+        return _add_methods(ZipFile(spool), open_regex)
     @property
     def zipfile(self):
         assert self.data["total_count"] == 1
@@ -59,14 +73,15 @@ class GithubArtifacts():
 
 
 class GithubArtifactsJUnit(GithubArtifacts):
+    REGEX_JUNIT_FILENAME = re.compile(r'junit.*\.xml')
     @property
     def junit_minidom(self):
         from xml.dom.minidom import parse as parse_xml
-        return parse_xml(self.zipfile.open_regex("junit.*\.xml"))
+        return parse_xml(self.zipfile.open_regex(self.REGEX_JUNIT_FILENAME))
     @property
     def junit_ElementTree(self):
         from xml.etree import ElementTree
-        return ElementTree.parse(self.zipfile.open_regex("junit.*\.xml"))
+        return ElementTree.parse(self.zipfile.open_regex(self.REGEX_JUNIT_FILENAME))
         # TODO:
         # Maybe add/augment to the suite ElementTree 'properties','property', url:html_url_run
     @property
@@ -74,8 +89,16 @@ class GithubArtifactsJUnit(GithubArtifacts):
         from junitparser import JUnitXml
         return JUnitXml.fromroot(self.junit_ElementTree.getroot())
     @property
+    def junit_suite(self):
+        with self.zipfile.open_regex(self.REGEX_JUNIT_FILENAME) as filehandle:
+            return junit_suite(filehandle)  # streamed straight out of the zip member
+    @property
     def junit_json(self):
-        return junit_to_json(self.junit_ElementTree)
+        return self.junit_suite.to_badgerfish()
+    @property
+    def junit_bytes(self):
+        with self.zipfile.open_regex(self.REGEX_JUNIT_FILENAME) as filehandle:
+            return filehandle.read()
 
     #@property
     #def report_json(self):
@@ -0,0 +1,71 @@
+"""
+asyncio pipeline stage for JUnit artifacts
+
+Listings and zip downloads for many `artifacts_url`s are in flight at once (bounded by `concurrency`),
+XML parsing is handed to a small separate executor.
+The HTTP itself is the shared blocking `github_requests` session run in threads, so pacing/ETags/retries still apply.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from github_artifacts import GithubArtifactsJUnit, FileNotFoundInZipfileException, ArtifactTooLargeException
+from junit_records import junit_suite
+
+import logging
+log = logging.getLogger(__name__)
+
+
+async def _artifacts_junit(artifacts_urls, concurrency, io_executor, parse_executor, **kwargs):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(artifacts_url):
+        github_artifact = GithubArtifactsJUnit(artifacts_url, **kwargs)
+        async with semaphore:
+            try:
+                xml = await loop.run_in_executor(io_executor, lambda: github_artifact.junit_bytes)
+            except FileNotFoundInZipfileException as ex:
+                log.warning(f'Run contains no JUnitXML file - {github_artifact.html_url_run=}')
+                return
+            except ArtifactTooLargeException as ex:
+                log.warning(f'Skipping oversized artifact {ex} - {github_artifact.html_url_run=}')
+                return
+            except Exception:
+                log.exception(f'Unable to get junit_json!? {artifacts_url=}')
+                return
+        try:
+            suite = await loop.run_in_executor(parse_executor, junit_suite, xml)
+        except Exception:
+            log.exception(f'Unable to parse junit xml {artifacts_url=}')
+            return
+        if not suite:
+            log.warning(f'JUnitXML contains no testsuite - {github_artifact.html_url_run=}')
+            return
+        return artifacts_url, (github_artifact.html_url_run, suite)
+
+    return dict(filter(None, await asyncio.gather(*map(fetch, artifacts_urls))))
+
+
+def fetch_artifacts_junit(artifacts_urls, concurrency=16, parse_executor=None, **kwargs):
+    """
+    Returns `{artifacts_url: (html_url_run, junit_records.TestSuite)}` - urls that fail (or have no suite) are logged and omitted
+    `kwargs` are passed to `GithubArtifactsJUnit` (`session`, `max_artifact_bytes`)
+
+    >>> import tempfile
+    >>> from pathlib import Path
+    >>> from github_stub import StubGithub
+    >>> import github_requests
+    >>> session = github_requests.github_session(etag_store=github_requests.ETagStore(Path(tempfile.mkdtemp())))
+    >>> with StubGithub() as stub:
+    ...     urls = tuple(
+    ...         stub.add_artifacts('user/repo', run_id, {'junit.xml': f'<testsuites><testsuite name="run{run_id}" tests="1"><testcase name="a"/></testsuite></testsuites>'})
+    ...         for run_id in range(5)
+    ...     ) + (stub.add_artifacts('user/repo', 99, {'report.txt': 'no junit'}), )
+    ...     results = fetch_artifacts_junit(urls, concurrency=3, session=session)
+    >>> len(results)
+    5
+    >>> results[urls[2]]
+    ('https://github.com/user/repo/actions/runs/2', TestSuite(name='run2', tests=1, failures=0, errors=0, skipped=0, time=None, properties=(), testcases=(TestCase(name='a', classname='', time=None, status='passed', message='', detail='', system_out='', system_err=''),)))
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as io_executor, (parse_executor or ThreadPoolExecutor(max_workers=2)) as parse_executor:
+        return asyncio.run(_artifacts_junit(artifacts_urls, concurrency, io_executor, parse_executor, **kwargs))
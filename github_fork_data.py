@@ -1,15 +1,26 @@
 import re
 import json
+import base64
+import hashlib
+import gzip
 from functools import cache, cached_property
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
 import datetime
 from pathlib import Path
 from collections import defaultdict
-from typing import Sequence
 
-from _utils import harden, _add_methods, JSONObjectEncoder
-from cache_tools import cache_disk, DoNotPersistCacheException
-from github_artifacts import GithubArtifactsJUnit, junit_to_json, FileNotFoundInZipfileException
-from markdown_grade import markdown_grade, load_markdown
+from _utils import harden, _add_methods, JSONObjectEncoder, write_atomic, write_json_atomic
+from cache_tools import cache_disk, DoNotPersistCacheException, JsonIndex
+from github_artifacts import GithubArtifactsJUnit, FileNotFoundInZipfileException, ArtifactTooLargeException
+from github_artifacts_async import fetch_artifacts_junit
+from github_graphql import GitHubForkData_GraphQLMixin
+from git_local import GitHubForkData_GitLocalMixin
+from markdown_grade import markdown_grade, compile_template, load_markdown
+from junit_records import junit_suite
+from results_store import ResultsStore
+from metrics import metrics
+import github_requests
 
 import github
 from tqdm import tqdm
@@ -19,12 +30,104 @@ log = logging.getLogger(__name__)
 
 
 
+def _junit_property(junit_json, name, fallback=''):
+    properties = (junit_json.get('properties') or {}).get('property') or ()
+    for _property in (properties, ) if isinstance(properties, dict) else properties:
+        if _property.get('@name') == name:
+            return _property.get('@value')
+    return fallback
+
+SUMMARY_FIELDS = ('passed', 'failures', 'errors', 'skipped', 'url')
+def suite_summary(junit_json):
+    """
+    `SUMMARY_FIELDS` for a suite - counted from the suite attributes (as the viewer always has)
+
+    >>> suite_summary({'@tests': 5, '@failures': 1, '@errors': 1, '@skipped': 1, 'properties': {'property': {'@name': 'url', '@value': 'http://example.com/'}}})
+    (2, 1, 1, 1, 'http://example.com/')
+    """
+    skipped, failures, errors = (int(junit_json.get(f'@{k}') or 0) for k in ('skipped', 'failures', 'errors'))
+    passed = int(junit_json.get('@tests') or 0) - skipped - failures - errors
+    return (passed, failures, errors, skipped, _junit_property(junit_json, 'url'))
+
+def summary_matrix(fork_test_data):
+    """
+    Compact overview of the cohort - `users[username][week][suite_name]` is a `SUMMARY_FIELDS` row.
+    The viewer renders the overview table straight from this; the testcases are only needed on drill-down.
+
+    >>> summary = summary_matrix({'student1': {10: {'markdown': {'@tests': 2, '@errors': 1}}, 2: {'test_server': {'@tests': 3}}}})
+    >>> summary['weeks'], summary['testsuites'], summary['users']['student1'][10]['markdown']
+    ((2, 10), ('markdown', 'test_server'), (1, 0, 1, 0, ''))
+    """
+    return {
+        'fields': SUMMARY_FIELDS,
+        'weeks': tuple(sorted({week for tests_grouped_by_week in fork_test_data.values() for week in tests_grouped_by_week})),
+        'testsuites': tuple(sorted({name for tests_grouped_by_week in fork_test_data.values() for suites in tests_grouped_by_week.values() for name in suites})),
+        'users': {
+            username: {
+                week: {name: suite_summary(suite) for name, suite in suites.items()}
+                for week, suites in tests_grouped_by_week.items()
+            }
+            for username, tests_grouped_by_week in fork_test_data.items()
+        },
+    }
+
+def write_data_shards(fork_test_data, path=Path('data'), summary=None, usernames=None):
+    """
+    `index.json` (the `summary_matrix` - enough for the overview table)
+    plus a gzipped `<username>.json.gz` shard per user with the full detail, fetched by the viewer on demand.
+    `usernames` limits which shards are rewritten (watch mode) - the index always covers every user.
+
+    >>> import tempfile
+    >>> path = Path(tempfile.mkdtemp())
+    >>> suite = {'@name': 'markdown', '@tests': 1, 'testcase': [{'@name': 'a', 'system-out': 'lots of text'}]}
+    >>> write_data_shards({'student1': {0: {'markdown': suite}}}, path)
+    >>> json.loads(path.joinpath('index.json').read_text())['users']
+    {'student1': {'0': {'markdown': [1, 0, 0, 0, '']}}}
+    >>> json.loads(gzip.decompress(path.joinpath('student1.json.gz').read_bytes()))['0']['markdown']['testcase']
+    [{'@name': 'a', 'system-out': 'lots of text'}]
+    """
+    for username, tests_grouped_by_week in fork_test_data.items():
+        if usernames is not None and username not in usernames:
+            continue
+        write_atomic(path.joinpath(f'{username}.json.gz'), gzip.compress(
+            json.dumps(tests_grouped_by_week, cls=JSONObjectEncoder).encode('utf8'),
+            mtime=0,  # deterministic output - unchanged shards stay byte identical
+        ))
+    write_json_atomic(path.joinpath('index.json'), summary or summary_matrix(fork_test_data))
+
+
+def _naive_utc(date):
+    """
+    PyGithub 2.x returns aware datetimes - the crawl works in naive UTC (to match the `date_start`/`date_end` settings)
+
+    >>> _naive_utc(datetime.datetime(2023, 10, 2, 10, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=1))))
+    datetime.datetime(2023, 10, 2, 9, 30)
+    >>> _naive_utc(datetime.datetime(2023, 10, 2, 9, 30))
+    datetime.datetime(2023, 10, 2, 9, 30)
+    """
+    return date.astimezone(datetime.timezone.utc).replace(tzinfo=None) if date.tzinfo else date
+
+
+class IndexedCommit():
+    """
+    Stand-in for `github.Commit.Commit` rebuilt from the commit index - just the attributes the crawl uses
+    """
+    def __init__(self, sha, url, date):
+        self.sha = sha
+        self.url = url
+        self.date = date
+    def __repr__(self):
+        return f'IndexedCommit(sha="{self.sha}")'
+
 
 class GitHubForkData_MarkdownTemplateMixin():
     """
     In future this will be done as junit tests on the repo itself by a github action.
     Maybe create my own 'github action' to provide the junit results on the repo directly.
     For now we can generate them here.
+
+    Grading is content addressed - keyed by the git blob sha of the report and the hash of the template.
+    Most commits don't touch the report, so they share one download and one grade.
     """
     def _get_markdown_template(self, repo, ref=github.GithubObject.NotSet):
         try:
@@ -36,16 +139,53 @@ class GitHubForkData_MarkdownTemplateMixin():
     @cached_property
     def markdown_template(self):
         return self._get_markdown_template(self.repo)
+    @cached_property
+    def markdown_template_compiled(self):
+        return compile_template(self.markdown_template)
+    @cached_property
+    def markdown_template_hash(self):
+        return hashlib.sha256(self.markdown_template.encode('utf8')).hexdigest()
+
     @cache_disk(
-        args_to_bytes_func=lambda self, commit: commit.sha.encode('utf8')+b'markdown',
+        args_to_bytes_func=lambda self, repo, ref: f'{repo.full_name}:{ref}:{self.settings["markdown_template_filename"]}'.encode('utf8')+b'markdown_blob_sha',
+        ttl=datetime.timedelta(days=365),  # a commit's tree never changes
+    )
+    def _get_markdown_blob_sha(self, repo, ref):
+        """
+        Blob sha of `markdown_template_filename` at `ref` (None when the commit does not have the file)
+        """
+        filename = self.settings["markdown_template_filename"]
+        try:
+            tree = repo.get_git_tree(ref, recursive='/' in filename)
+        except github.GithubException:
+            raise DoNotPersistCacheException()
+        return next((element.sha for element in tree.tree if element.path == filename and element.type == 'blob'), None)
+    @cache_disk(
+        args_to_bytes_func=lambda self, repo, blob_sha: blob_sha.encode('utf8')+b'markdown_blob',
+        ttl=datetime.timedelta(days=365),  # content addressed - can never be stale
+    )
+    def _get_markdown_blob(self, repo, blob_sha):
+        try:
+            return base64.b64decode(repo.get_git_blob(blob_sha).content).decode('utf8')
+        except github.GithubException:
+            raise DoNotPersistCacheException()
+    @cache_disk(
+        args_to_bytes_func=lambda self, repo, blob_sha: f'{blob_sha}:{self.markdown_template_hash}'.encode('utf8')+b'markdown_grade_suite',
         ttl=datetime.timedelta(days=150),
+        memory_size=1024,
     )
-    def markdown_grade_json(self, commit):
-        return junit_to_json(markdown_grade(
-            template=self.markdown_template,
-            target=self._get_markdown_template(repo=commit._get_repo_from_commit(), ref=commit.sha),
-            url=self.markdown_html_url(commit),  # this adds a url 'property' to the testsuite
-        ))
+    def _markdown_grade_blob_suite(self, repo, blob_sha):
+        with metrics.stage('markdown_fetch'):
+            target = (self._get_markdown_blob(repo, blob_sha) or '') if blob_sha else ''
+        with metrics.stage('grading'):
+            return junit_suite(markdown_grade(template=self.markdown_template_compiled, target=target).tostring())
+    def markdown_grade_suite(self, commit):
+        repo = commit._get_repo_from_commit()
+        with metrics.stage('markdown_fetch'):
+            blob_sha = self._get_markdown_blob_sha(repo, commit.sha)
+        return self._markdown_grade_blob_suite(repo, blob_sha).with_property(
+            'url', self.markdown_html_url(commit),  # attached per commit - the graded blob is shared
+        )
     def markdown_html_url(self, commit):
         return f'https://github.com/{commit._get_repo_from_commit().full_name}/tree/{commit.sha}/{self.settings["markdown_template_filename"]}'  # Fragile and perilous!
 
@@ -53,20 +193,51 @@ class GitHubForkData_MarkdownTemplateMixin():
     def fork_markdown_templates(self):
         log.info('generating markdown templates for forks')
         markdown_templates = {
-            fork.owner.login: fork._get_markdown_json()
-            for fork in tqdm(self.forks)
+            fork.owner.login: markdown_json
+            for fork, markdown_json in self._map_forks(lambda fork: fork._get_markdown_json())
         }
         markdown_templates[''] = self._get_markdown_json(self.repo)
         return markdown_templates
 
 
 class GitHubForkData(GitHubForkData_MarkdownTemplateMixin):
-    def __init__(self, github, settings):
+    def __init__(self, github, settings, session=None):
         self.github = github
         self.settings = settings
+        self.session = session or github_requests.session
         self.date_start = datetime.datetime.fromisoformat(self.settings['date_start'])
         self.date_end = datetime.datetime.fromisoformat(self.settings['date_end'])
         self.timedelta = datetime.timedelta(days=int(self.settings['timedelta_days']))
+        self.workers = int(self.settings.get('workers', 1))
+        self.index_path = Path(self.settings.get('index_path', '__index'))
+        self.commit_index_overlap = datetime.timedelta(days=int(self.settings.get('commit_index_overlap_days', 14)))
+
+    def _map_forks(self, func, forks=None):
+        """
+        Yield `(fork, func(fork))` in fork order.
+        Forks are crawled concurrently with `settings['workers']` threads (serially when 1).
+        A fork that raises is logged and omitted, so one bad fork does not kill the whole run.
+        """
+        forks = self.forks if forks is None else forks
+        results = [None] * len(forks)
+        def _call(index):
+            fork = forks[index]
+            try:
+                results[index] = (fork, func(fork))
+            except Exception:
+                log.exception(f'failed to process fork {fork.full_name}')
+            return fork
+        with tqdm(total=len(forks)) as progress:
+            if self.workers <= 1:
+                for index in range(len(forks)):
+                    progress.set_postfix_str(_call(index).owner.login)
+                    progress.update()
+            else:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    for future in as_completed(tuple(executor.submit(_call, index) for index in range(len(forks)))):
+                        progress.set_postfix_str(future.result().owner.login)
+                        progress.update()
+        return tuple(filter(None, results))
 
     @staticmethod
     def _get_workflow_by_name(repo, name):
@@ -79,77 +250,159 @@ class GitHubForkData(GitHubForkData_MarkdownTemplateMixin):
     def get_repo(self, name):
         return self.github.get_repo(name)
     def _get_repo_from_commit(self, commit):
-        return  self.get_repo(re.match(r'https://api.github.com/repos/(.*)/commits/.+', commit.url).group(1))  # hack to backlink to repos
-
+        return  self.get_repo(re.match(r'.*/repos/(.*)/commits/.+', commit.url).group(1))  # hack to backlink to repos
+
+
+    def _commit_index(self, repo):
+        """
+        `{sha: {'date': committer_date, 'url': api_url}}` - one file per term (`date_start`/`date_end`),
+        so moving the term starts a fresh index rather than trusting one that was only synced from the old start.
+        Weeks are not stored - they are computed from the current settings when read.
+        Loaded once per repo - every later lookup (blob shas, templates) shares the synced index.
+
+        >>> from types import SimpleNamespace
+        >>> gg = GitHubForkData(None, {'date_start': '2023-09-25', 'date_end': '2023-12-11', 'timedelta_days': '7'})
+        >>> gg._commit_index(SimpleNamespace(full_name='student1/repo')).path.name, gg._week(datetime.datetime(2023, 10, 9, 12))
+        ('student1__repo__2023-09-25_2023-12-11.json', 2)
+        """
+        return self._load_commit_index(repo.full_name)
+    @cache
+    def _load_commit_index(self, full_name):
+        return JsonIndex(self.index_path.joinpath('commits', f'{full_name.replace("/", "__")}__{self.date_start.date()}_{self.date_end.date()}.json'))
+    def _week(self, date):
+        return (date - self.date_start) // self.timedelta
+    def _commit_index_since(self, index):
+        """
+        Re-fetch from `commit_index_overlap` before the newest indexed commit -
+        a commit pushed later can carry an older committer date (rebases, skewed clocks)
+
+        >>> gg = GitHubForkData(None, {'date_start': '2023-09-25', 'date_end': '2023-12-11', 'timedelta_days': '7'})
+        >>> gg._commit_index_since({}), gg._commit_index_since({'a': {'date': '2023-11-01T10:00:00'}})
+        (datetime.datetime(2023, 9, 25, 0, 0), datetime.datetime(2023, 10, 18, 10, 0))
+        """
+        since = max((commit['date'] for commit in index.values()), default=None)
+        return max(datetime.datetime.fromisoformat(since) - self.commit_index_overlap, self.date_start) if since else self.date_start
+    def _sync_commit_index(self, repo):
+        """
+        Only commits since `_commit_index_since` (up to `date_end`) are fetched - the overlap is skipped by sha
+        """
+        index = self._commit_index(repo)
+        for commit in repo.get_commits(
+            since=self._commit_index_since(index),
+            until=self.date_end,
+            author=repo.owner,
+        ):
+            if commit.sha in index:
+                continue
+            date = _naive_utc(commit.commit.committer.date)
+            index[commit.sha] = {
+                'date': date.isoformat(),
+                'url': commit.url,
+            }
+        index.save()
+        return index
 
     @cache
     def _commits_grouped_by_week(self, repo):
+        week_end = (self.date_end - self.date_start) // self.timedelta
         commits = defaultdict(list)
-        def _commit_week_number(commit):
-            return (commit.commit.committer.date - self.date_start) // self.timedelta
-        for commit in repo.get_commits(since=self.date_start, author=repo.owner):
-            commits[_commit_week_number(commit)].append(_add_methods(commit,
+        with metrics.stage('commit_paging'):
+            commit_index = self._sync_commit_index(repo)
+        for sha, commit in sorted(commit_index.items(), key=lambda item: item[1]['date'], reverse=True):
+            date = datetime.datetime.fromisoformat(commit['date'])
+            if not 0 <= self._week(date) <= week_end:
+                continue
+            commits[self._week(date)].append(_add_methods(IndexedCommit(sha, commit['url'], date),
                 self._get_workflow_artifacts_junit,
                 self._get_repo_from_commit,
             ))
         return harden(commits)
 
+    def _bind_fork(self, fork):
+        """The per-fork methods every data source's `forks` exposes (`fork._tests_grouped_by_week()` etc)"""
+        return _add_methods(fork,
+            self._get_workflow_by_name,
+            self._commits_grouped_by_week,
+            self._suites_grouped_by_week,
+            self._tests_grouped_by_week,
+            self._get_markdown_json,
+        )
     @cached_property
+    @metrics.timed('fork_listing')
     def forks(self):
         return tuple(
-            _add_methods(fork, 
-                self._get_workflow_by_name,
-                self._commits_grouped_by_week,
-                self._tests_grouped_by_week,
-                self._get_markdown_json,  # Coupling overlap with Mixin?
-            )
+            self._bind_fork(fork)
             #for fork in (self.repo, )  # self.repo.get_forks()  # TEMP: HACK for development
             for fork in self.repo.get_forks()
-            if fork.updated_at > self.date_start    # DEBUG and fork.owner.login == 'test_username_for_debug'
+            if _naive_utc(fork.updated_at) > self.date_start    # DEBUG and fork.owner.login == 'test_username_for_debug'
         )
 
 
     @cached_property
-    @cache_disk(
-        args_to_bytes_func=lambda self: self.repo.full_name.encode('utf8'),
-        ttl=datetime.timedelta(days=1),
-    )
+    def workflow_run_index(self):
+        """
+        `{fork.full_name: {workflow_name: {'created': newest_run_created_at, 'runs': {run_id: (head_sha, artifacts_url)}}}}`
+        """
+        return JsonIndex(self.index_path.joinpath(f'workflow_runs__{self.settings["repo"].replace("/", "__")}.json'))
+
+    @cached_property
     def workflow_run_artifacts_url_lookup(self):
+        log.info("refreshing workflow_run_index")
+        index = self.workflow_run_index
+        for fork, workflow_runs in self._map_forks(metrics.timed('run_listing')(lambda fork: self._workflow_runs(fork, index.get(fork.full_name)))):
+            index[fork.full_name] = workflow_runs
+        index.save()
+
         log.info("generating workflow_run_artifacts_url_lookup")
         runs = defaultdict(list)
-        for repo in tqdm(self.forks):
-            for workflow in repo.get_workflows():
-                if workflow.name in self.settings['workflows']:
-                    for run in workflow.get_runs():
-                        runs[run.head_sha].append(run.artifacts_url)
+        for fork in self.forks:
+            for workflow_name, workflow_runs in index.get(fork.full_name, {}).items():
+                if workflow_name not in self.settings['workflows']:
+                    continue
+                for run_id, (head_sha, artifacts_url) in sorted(workflow_runs['runs'].items(), key=lambda item: int(item[0]), reverse=True):
+                    runs[head_sha].append(artifacts_url)
         return dict(runs)  # TODO: harden lists to tuples?
+    def _workflow_runs(self, repo, known=None):
+        """
+        Incrementally refresh the workflow runs for a fork from the `known` index entry.
+        Only runs created since the newest known run are requested (high-water mark),
+        and paging stops at the first run already in the index (runs are listed newest first).
+        """
+        known = known or {}
+        workflows = {}
+        for workflow in repo.get_workflows():
+            if workflow.name not in self.settings['workflows']:
+                continue
+            created = known.get(workflow.name, {}).get('created')
+            runs = dict(known.get(workflow.name, {}).get('runs', {}))
+            for run in workflow.get_runs(created=f'>={created}') if created else workflow.get_runs():
+                if str(run.id) in runs:
+                    break
+                runs[str(run.id)] = (run.head_sha, run.artifacts_url)
+                created = max(created or '', _naive_utc(run.created_at).isoformat())
+            workflows[workflow.name] = {'created': created, 'runs': runs}
+        return workflows
 
     @cache_disk(
-        args_to_bytes_func=lambda self, commit: commit.sha.encode('utf8')+b'artifact',
+        args_to_bytes_func=lambda self, commit: commit.sha.encode('utf8')+b'artifact_suite',
         ttl=datetime.timedelta(days=150),
+        memory_size=4096,
     )
+    @metrics.timed('artifact_downloads')
     def _get_workflow_artifacts_junit(self, commit):
         artifact_urls = self.workflow_run_artifacts_url_lookup.get(commit.sha)
         if not artifact_urls:
             raise DoNotPersistCacheException()
         def get_junit(artifacts_url):
             try:
-                github_artifact = GithubArtifactsJUnit(artifacts_url)
-                junit_json = github_artifact.junit_json
-                # HACK 
-                # Normalise junit output to single dict (sometimes we get lists of suites ... investigate why this is inconsistent)
-                # We want the item that actually has some tests (sometimes the RootElement has no tests ... )
-                if isinstance(junit_json, Sequence):
-                    for _junit_json in junit_json:
-                        if _junit_json.get('@tests') > 0:
-                            junit_json = _junit_json
-                            break
-                # HACK
-                # Overlay url property - post xml - because the XML was generated on CI without knowledge of it's context/where it was run. TODO: Add this to GithubArtifactsJUnit and remove this json nonsense/hack
-                junit_json.setdefault('properties',{}).setdefault('property',[]).append({"@name": "url", "@value": github_artifact.html_url_run})
-                return junit_json
+                github_artifact = GithubArtifactsJUnit(artifacts_url, max_artifact_bytes=self.settings.get('max_artifact_bytes'), session=self.session)
+                suite = github_artifact.junit_suite
+                # The XML was generated on CI without knowledge of where it was run - overlay the url
+                return suite.with_property('url', github_artifact.html_url_run) if suite else None
             except FileNotFoundInZipfileException as ex:
                 log.warning(f'Run contains no JUnitXML file - {github_artifact.html_url_run=}')
+            except ArtifactTooLargeException as ex:
+                log.warning(f'Skipping oversized artifact {ex} - {github_artifact.html_url_run=}')
             except:
                 log.exception(f'Unable to get junit_json!? {artifacts_url=}')
                 #breakpoint()
@@ -157,38 +410,112 @@ class GitHubForkData(GitHubForkData_MarkdownTemplateMixin):
             get_junit(artifacts_url) for artifacts_url in artifact_urls
         )))
 
+    def prefetch_workflow_artifacts_junit(self, commits):
+        """
+        Fetch the junit artifacts for all `commits` concurrently (asyncio pipeline)
+        and fill the per-SHA cache entries that `_get_workflow_artifacts_junit` reads
+        """
+        def _is_cached(commit):
+            try:
+                self._get_workflow_artifacts_junit.cache_get(self, commit)
+                return True
+            except KeyError:
+                return False
+        commits = {
+            commit.sha: commit
+            for commit in commits
+            if self.workflow_run_artifacts_url_lookup.get(commit.sha) and not _is_cached(commit)
+        }
+        log.info(f'prefetching workflow artifacts for {len(commits)} commits')
+        with metrics.stage('artifact_downloads'):
+            results = fetch_artifacts_junit(
+                frozenset(chain.from_iterable(self.workflow_run_artifacts_url_lookup[sha] for sha in commits)),
+                concurrency=int(self.settings['artifacts_concurrency']),
+                max_artifact_bytes=self.settings.get('max_artifact_bytes'),
+                session=self.session,
+            )
+        for sha, commit in commits.items():
+            self._get_workflow_artifacts_junit.cache_set(tuple(
+                suite.with_property('url', html_url_run)
+                for html_url_run, suite in filter(None, map(results.get, self.workflow_run_artifacts_url_lookup[sha]))
+            ), self, commit)
+
 
-    def _tests_grouped_by_week(self, repo):
-        return harden({
+    @cache
+    def _suites_grouped_by_week(self, repo):
+        return {
             week_num: self._tests_from_commits(commits)
             for week_num, commits in self._commits_grouped_by_week(repo).items()
-        })
+        }
+    def _tests_grouped_by_week(self, repo):
+        return {
+            week_num: {name: suite.to_badgerfish() for name, (sha, suite) in suites.items()}
+            for week_num, suites in self._suites_grouped_by_week(repo).items()
+        }
     def _tests_from_commits(self, commits):
+        """
+        `{suite_name: (commit_sha, junit_records.TestSuite)}` - the latest result for each suite
+        """
         _return = {}
         if commits:  # HACK: Generate the JUnitXml for markdown manually here in python
             # HACK - this is mad coupling with the MarkdownMixin, in future markdown marking will be done as a github action and export junit.xml file
-            junit_json = self.markdown_grade_json(commits[0])  # commits are in 'latest first' order
-            _return.setdefault(junit_json['@name'], junit_json)
+            suite = self.markdown_grade_suite(commits[0])  # commits are in 'latest first' order
+            _return.setdefault(suite.name, (commits[0].sha, suite))
         for commit in commits:
-            for junit_json in self._get_workflow_artifacts_junit(commit) or ():
-                _return.setdefault(junit_json['@name'], junit_json)
+            for suite in self._get_workflow_artifacts_junit(commit) or ():
+                _return.setdefault(suite.name, (commit.sha, suite))
         return _return
 
 
     @cached_property
     def fork_test_data(self):
+        self.workflow_run_artifacts_url_lookup  # shared by every fork - populate before fanning out to workers
+        self.markdown_template_compiled
+        if self.settings.get('artifacts_concurrency'):
+            self.prefetch_workflow_artifacts_junit(chain.from_iterable(
+                chain.from_iterable(commits_grouped_by_week.values())
+                for fork, commits_grouped_by_week in self._map_forks(lambda fork: fork._commits_grouped_by_week())
+            ))
         log.info("iterating over forks")
         return {
-            fork.owner.login: fork._tests_grouped_by_week()
-            for fork in tqdm(self.forks)
+            fork.owner.login: tests_grouped_by_week
+            for fork, tests_grouped_by_week in self._map_forks(lambda fork: fork._tests_grouped_by_week())
         }
+    @cached_property
+    def fork_test_summary(self):
+        return summary_matrix(self.fork_test_data)
+    def write_results_store(self, store=None):
+        """
+        Upsert every fork's testcase results into a `ResultsStore` (the suites are cached from building `fork_test_data`)
+        """
+        store = store or ResultsStore(Path(self.settings.get('results_path', 'results.sqlite')))
+        rows = sum(
+            store.add(fork.owner.login, suites_grouped_by_week)
+            for fork, suites_grouped_by_week in self._map_forks(lambda fork: fork._suites_grouped_by_week())
+        )
+        log.info(f'{rows} testcase results written to {store.path}')
+        return store
+
+
+
+class GitHubForkDataGraphQL(GitHubForkData_GraphQLMixin, GitHubForkData):
+    pass
+
+class GitHubForkDataGitLocal(GitHubForkData_GitLocalMixin, GitHubForkData):
+    pass
 
+DATA_SOURCES = {
+    'rest': GitHubForkData,
+    'graphql': GitHubForkDataGraphQL,
+    'local': GitHubForkDataGitLocal,
+}
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
 
     from os import environ
+    github_requests.use_github_session()
     g = github.Github(environ['GITHUB_TOKEN'])
 
     from pprint import pprint as pp
@@ -198,7 +525,7 @@ if __name__ == "__main__":
         settings = json.load(filehandle)
 
 
-    gg = GitHubForkData(g, settings)
+    gg = DATA_SOURCES[settings.get('data_source', 'rest')](g, settings)
     #runs = gg.workflow_run_artifacts_url_lookup
     #cc = gg._commits_grouped_by_week(gg.repo)
     #ccc = cc[30][0]
@@ -210,8 +537,9 @@ if __name__ == "__main__":
 
     #breakpoint()
 
-    with open('data.json', 'w') as filehandle:
-        json.dump(gg.fork_test_data, filehandle, cls=JSONObjectEncoder)
+    write_json_atomic(Path('data.json'), gg.fork_test_data)
+    write_data_shards(gg.fork_test_data, Path('data'), summary=gg.fork_test_summary)
+    gg.write_results_store()
 
-    with open('markdown_templates.json', 'w') as filehandle:
-        json.dump(gg.fork_markdown_templates, filehandle, cls=JSONObjectEncoder)
+    write_json_atomic(Path('markdown_templates.json'), gg.fork_markdown_templates)
+    metrics.write_report(Path('run_report.json'))  # last - the markdown fetch/grading stages are part of the run
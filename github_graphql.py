@@ -0,0 +1,339 @@
+"""
+Batched GraphQL data source for `GitHubForkData`
+
+PyGithub's lazy objects make every `fork.owner.login`, `commit.commit.committer.date` and `get_contents(ref=sha)` a REST round trip.
+Here forks, their commit history in the date window (with the blob oid of the markdown file at each commit)
+and the distinct blobs are fetched with a handful of aliased GraphQL queries.
+
+https://docs.github.com/en/graphql/reference/objects#commit
+"""
+import datetime
+from functools import cached_property
+from types import SimpleNamespace
+from os import environ
+
+import github
+
+from metrics import metrics
+import github_requests
+
+import logging
+log = logging.getLogger(__name__)
+
+
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+PAGE_SIZE = 100
+BATCH_SIZE = 20  # repositories per aliased query - keeps each query well inside GitHub's node limits
+
+
+class GraphQLException(Exception):
+    pass
+
+
+class GithubGraphQL():
+    def __init__(self, url=GITHUB_GRAPHQL_URL, session=None, token=None):
+        self.url = url
+        self.session = session or github_requests.session
+        self.headers = {'Authorization': f'bearer {token or environ["GITHUB_TOKEN"]}'}
+    def query(self, query, **variables):
+        response = self.session.post(self.url, json={'query': query, 'variables': variables}, headers=self.headers)
+        response.raise_for_status()
+        data = response.json()
+        if data.get('errors'):
+            raise GraphQLException(data['errors'])
+        return data['data']
+
+
+def _parse_datetime(value):
+    """
+    Naive UTC - to match the `date_start`/`date_end` settings
+
+    >>> _parse_datetime('2023-10-02T09:30:00Z')
+    datetime.datetime(2023, 10, 2, 9, 30)
+    """
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).astimezone(datetime.timezone.utc).replace(tzinfo=None) if value else None
+
+def _batches(items, size=BATCH_SIZE):
+    items = tuple(items)
+    for index in range(0, len(items), size):
+        yield items[index:index+size]
+
+
+QUERY_FORKS = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    forks(first: %(PAGE_SIZE)s, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes { nameWithOwner updatedAt pushedAt owner { login ... on User { id } } }
+    }
+  }
+}
+''' % {'PAGE_SIZE': PAGE_SIZE}
+
+def graphql_forks(graphql, full_name):
+    """
+    >>> from github_stub import RecordedGraphQL
+    >>> def _page(names, cursor=None):
+    ...     return {'repository': {'forks': {
+    ...         'pageInfo': {'hasNextPage': bool(cursor), 'endCursor': cursor},
+    ...         'nodes': [{'nameWithOwner': f'{name}/repo', 'updatedAt': '2023-10-02T09:30:00Z', 'pushedAt': None, 'owner': {'login': name, 'id': f'U_{name}'}} for name in names],
+    ...     }}}
+    >>> graphql = RecordedGraphQL((_page(('a', 'b'), cursor='c1'), _page(('c', ))))
+    >>> tuple(fork['nameWithOwner'] for fork in graphql_forks(graphql, 'upstream/repo'))
+    ('a/repo', 'b/repo', 'c/repo')
+    >>> graphql.queries[1][1]
+    {'owner': 'upstream', 'name': 'repo', 'cursor': 'c1'}
+    """
+    owner, name = full_name.split('/')
+    cursor = None
+    while True:
+        forks = graphql.query(QUERY_FORKS, owner=owner, name=name, cursor=cursor)['repository']['forks']
+        yield from forks['nodes']
+        if not forks['pageInfo']['hasNextPage']:
+            break
+        cursor = forks['pageInfo']['endCursor']
+
+
+QUERY_HISTORY_REPOSITORY = '''
+  r%(i)s: repository(owner: $o%(i)s, name: $n%(i)s) {
+    defaultBranchRef { target { ... on Commit {
+      history(first: %(PAGE_SIZE)s, after: $c%(i)s, since: $s%(i)s, until: $until, author: $a%(i)s) {
+        pageInfo { hasNextPage endCursor }
+        nodes { oid committedDate file(path: $path) { oid } }
+      }
+    } } }
+  }'''
+
+def graphql_commit_history(graphql, repositories, until, path):
+    """
+    Commit history for many repositories, batched into aliased queries and paginated per repository
+
+    `repositories` is `((full_name, author_id_or_None, since), ...)`
+    Returns `{full_name: [{'sha':, 'date':, 'blob': oid_of_path_or_None}, ...]}` latest first
+
+    >>> from github_stub import RecordedGraphQL
+    >>> def _history(shas, cursor=None):
+    ...     return {'defaultBranchRef': {'target': {'history': {
+    ...         'pageInfo': {'hasNextPage': bool(cursor), 'endCursor': cursor},
+    ...         'nodes': [{'oid': sha, 'committedDate': '2023-10-02T09:30:00Z', 'file': {'oid': f'blob_{sha}'} if sha != 'c' else None} for sha in shas],
+    ...     }}}}
+    >>> graphql = RecordedGraphQL((
+    ...     {'r0': _history(('a', ), cursor='c1'), 'r1': _history(('x', ))},
+    ...     {'r0': _history(('b', 'c'))},
+    ... ))
+    >>> since = datetime.datetime(2023, 9, 25)
+    >>> history = graphql_commit_history(graphql, (('u1/repo', 'U_1', since), ('u2/repo', None, since)), until=datetime.datetime(2023, 12, 11), path='technical_report.md')
+    >>> {full_name: tuple((commit['sha'], commit['blob']) for commit in commits) for full_name, commits in history.items()}
+    {'u1/repo': (('a', 'blob_a'), ('b', 'blob_b'), ('c', None)), 'u2/repo': (('x', 'blob_x'),)}
+    >>> graphql.queries[1][1]['c0'], graphql.queries[0][1]['a0'], graphql.queries[0][1]['a1']
+    ('c1', {'id': 'U_1'}, None)
+    """
+    history = {full_name: [] for full_name, author_id, since in repositories}
+    pending = tuple((full_name, author_id, since, None) for full_name, author_id, since in repositories)
+    while pending:
+        next_pending = []
+        for batch in _batches(pending):
+            query = 'query($until: GitTimestamp!, $path: String!, %s) {%s\n}' % (
+                ', '.join(f'$o{i}: String!, $n{i}: String!, $s{i}: GitTimestamp!, $a{i}: CommitAuthor, $c{i}: String' for i in range(len(batch))),
+                ''.join(QUERY_HISTORY_REPOSITORY % {'i': i, 'PAGE_SIZE': PAGE_SIZE} for i in range(len(batch))),
+            )
+            variables = {'until': until.isoformat(), 'path': path}
+            for i, (full_name, author_id, since, cursor) in enumerate(batch):
+                owner, name = full_name.split('/')
+                variables.update({
+                    f'o{i}': owner, f'n{i}': name, f's{i}': since.isoformat(),
+                    f'a{i}': {'id': author_id} if author_id else None,
+                    f'c{i}': cursor,
+                })
+            data = graphql.query(query, **variables)
+            for i, (full_name, author_id, since, cursor) in enumerate(batch):
+                try:
+                    commits = data[f'r{i}']['defaultBranchRef']['target']['history']
+                except (KeyError, TypeError):
+                    log.warning(f'no history for {full_name}')  # empty repo / no default branch
+                    continue
+                history[full_name] += (
+                    {'sha': node['oid'], 'date': _parse_datetime(node['committedDate']), 'blob': (node['file'] or {}).get('oid')}
+                    for node in commits['nodes']
+                )
+                if commits['pageInfo']['hasNextPage']:
+                    next_pending.append((full_name, author_id, since, commits['pageInfo']['endCursor']))
+        pending = tuple(next_pending)
+    return history
+
+
+def graphql_blobs(graphql, blobs):
+    """
+    Text of blobs, batched into aliased queries - `blobs` is `{oid: full_name_of_a_repository_containing_it}`
+
+    >>> from github_stub import RecordedGraphQL
+    >>> graphql = RecordedGraphQL(({'r0': {'b0': {'text': '# A'}}, 'r1': {'b0': {'text': '# B'}, 'b1': None}}, ))
+    >>> graphql_blobs(graphql, {'oid_a': 'u1/repo', 'oid_b': 'u2/repo', 'oid_missing': 'u2/repo'})
+    {'oid_a': '# A', 'oid_b': '# B', 'oid_missing': ''}
+    """
+    by_repository = {}
+    for oid, full_name in blobs.items():
+        by_repository.setdefault(full_name, []).append(oid)
+    texts = {}
+    for batch in _batches(by_repository.items()):
+        variables = {}
+        fragments = []
+        for i, (full_name, oids) in enumerate(batch):
+            variables[f'o{i}'], variables[f'n{i}'] = full_name.split('/')
+            for j, oid in enumerate(oids):
+                variables[f'b{i}_{j}'] = oid
+            fragments.append('r%s: repository(owner: $o%s, name: $n%s) {%s}' % (i, i, i, ' '.join(
+                f'b{j}: object(oid: $b{i}_{j}) {{ ... on Blob {{ text }} }}' for j in range(len(oids))
+            )))
+        query = 'query(%s) {\n%s\n}' % (
+            ', '.join(f'${k}: {"GitObjectID!" if k.startswith("b") else "String!"}' for k in variables),
+            '\n'.join(fragments),
+        )
+        data = graphql.query(query, **variables)
+        for i, (full_name, oids) in enumerate(batch):
+            for j, oid in enumerate(oids):
+                texts[oid] = ((data[f'r{i}'] or {}).get(f'b{j}') or {}).get('text') or ''
+    return texts
+
+
+class GraphQLFork():
+    """
+    Fork from the GraphQL listing - the attributes the crawl reads are plain values,
+    anything else (e.g. `get_workflows` for the REST actions API) is delegated to a lazy PyGithub Repository
+    """
+    def __init__(self, node, repository):
+        self.full_name = node['nameWithOwner']
+        self.owner = SimpleNamespace(login=node['owner']['login'], id=node['owner'].get('id'))
+        self.updated_at = _parse_datetime(node['updatedAt'])
+        self.pushed_at = _parse_datetime(node['pushedAt'])
+        self._repository = repository
+    def __getattr__(self, name):
+        if name == '_repository':
+            raise AttributeError(name)
+        return getattr(self._repository, name)
+    def __repr__(self):
+        return f'GraphQLFork(full_name="{self.full_name}")'
+
+
+class GitHubForkData_GraphQLMixin():
+    r"""
+    Replaces the REST fork listing, commit listing and `get_contents(ref=sha)` of `GitHubForkData` with batched GraphQL.
+    Workflow runs and artifacts still come from the REST actions API.
+
+    >>> import tempfile, hashlib
+    >>> from pathlib import Path
+    >>> from github_stub import StubGithub, RecordedGraphQL, synthetic_cohort, cache_path
+    >>> from github_fork_data import DATA_SOURCES
+    >>> path = Path(tempfile.mkdtemp())
+    >>> sha1 = lambda text: hashlib.sha1(text.encode('utf8')).hexdigest()  # `synthetic_cohort` commit shas
+    >>> def _fork(login):
+    ...     return {'nameWithOwner': f'{login}/module', 'updatedAt': '2023-10-02T00:00:00Z', 'pushedAt': None, 'owner': {'login': login, 'id': f'U_{login}'}}
+    >>> def _history(login):
+    ...     return {'defaultBranchRef': {'target': {'history': {'pageInfo': {'hasNextPage': False, 'endCursor': None}, 'nodes': [
+    ...         {'oid': sha1(f'{login}/module:{i}'), 'committedDate': f'2023-09-25T0{1 + i}:00:00Z', 'file': {'oid': f'blob_{login}'}} for i in (1, 0)
+    ...     ]}}}}
+    >>> with StubGithub() as stub, cache_path(path.joinpath('cache')):
+    ...     settings = synthetic_cohort(stub, forks=2, weeks=1, commits_per_week=2)
+    ...     settings.update(index_path=str(path.joinpath('index')))
+    ...     session = github_requests.github_session(etag_store=github_requests.ETagStore(path.joinpath('etag')))
+    ...     data = DATA_SOURCES['graphql'](github.Github(base_url=stub.url, retry=None, seconds_between_requests=0), settings, session=session)
+    ...     data.graphql = RecordedGraphQL((
+    ...         {'repository': {'forks': {'pageInfo': {'hasNextPage': False, 'endCursor': None}, 'nodes': [_fork('student0'), _fork('student1')]}}},
+    ...         {'r0': _history('student0'), 'r1': _history('student1')},
+    ...         {'r0': {'b0': {'text': '# Technical Report\n\nstudent0'}}, 'r1': {'b0': {'text': '# Technical Report\n\nstudent1'}}},
+    ...     ))
+    ...     {login: tuple(weeks) for login, weeks in data.fork_test_data.items()}
+    ...     data._get_markdown_template(data.forks[1], ref=sha1('student1/module:0'))
+    ...     len(data.graphql.queries), [path for path in stub.requests if path.endswith(('/module', '/commits')) or '/git/' in path]
+    {'student0': (0,), 'student1': (0,)}
+    '# Technical Report\n\nstudent1'
+    (3, ['/repos/tutor/module'])
+    """
+    @cached_property
+    def graphql(self):
+        return GithubGraphQL(session=self.session)
+    @cached_property
+    def github_lazy(self):
+        """The same client, but repositories are not fetched until an attribute the listing lacks is read"""
+        return self.github.withLazy(True)
+
+    @cached_property
+    @metrics.timed('fork_listing')
+    def forks(self):
+        log.info('listing forks (graphql)')
+        return tuple(
+            self._bind_fork(GraphQLFork(node, self.github_lazy.get_repo(node['nameWithOwner'])))
+            for node in graphql_forks(self.graphql, self.settings['repo'])
+            if _parse_datetime(node['updatedAt']) > self.date_start
+        )
+
+    def get_repo(self, name):
+        return next((fork for fork in self.forks if fork.full_name == name), None) or super().get_repo(name)
+
+    @cached_property
+    def graphql_commit_history(self):
+        """
+        One batched pass for every fork - each fork's history starts from `_commit_index_since` (just before the newest indexed commit)
+        """
+        log.info('fetching commit history (graphql)')
+        return graphql_commit_history(
+            self.graphql,
+            tuple((fork.full_name, fork.owner.id, self._commit_index_since(self._commit_index(fork))) for fork in self.forks),
+            until=self.date_end,
+            path=self.settings["markdown_template_filename"],
+        )
+
+    def _sync_commit_index(self, repo):
+        index = self._commit_index(repo)
+        for commit in self.graphql_commit_history.get(repo.full_name, ()):
+            index.setdefault(commit['sha'], {
+                'date': commit['date'].isoformat(),
+                'url': f'https://api.github.com/repos/{repo.full_name}/commits/{commit["sha"]}',
+                'blob': commit['blob'],
+            })
+        index.save()
+        return index
+
+    @cached_property
+    def graphql_blobs(self):
+        """
+        Text of the report blobs that are neither graded (for the current template) nor in the blob cache -
+        fetched texts are written to the blob cache, so a blob is fetched once
+        """
+        blob_cache = super()._get_markdown_blob  # `cache_disk` - keyed by blob sha only
+        def _is_cached(blob_sha):
+            for function in (self._markdown_grade_blob_suite, blob_cache):
+                try:
+                    function.cache_get(self, None, blob_sha)
+                    return True
+                except KeyError:
+                    pass
+            return False
+        blobs = {}
+        for fork in self.forks:
+            fork._commits_grouped_by_week()  # ensure every fork's commit index is synced before collecting blob oids
+            for commit in self._commit_index(fork).values():
+                if commit.get('blob') and commit['blob'] not in blobs and not _is_cached(commit['blob']):
+                    blobs[commit['blob']] = fork.full_name
+        log.info(f'fetching {len(blobs)} markdown blobs (graphql)')
+        texts = graphql_blobs(self.graphql, blobs)
+        for blob_sha, text in texts.items():
+            if text:
+                blob_cache.cache_set(text, self, None, blob_sha)
+        return texts
+
+    def _get_markdown_blob_sha(self, repo, ref):
+        commit = self._commit_index(repo).get(ref)
+        if commit and 'blob' in commit:
+            return commit['blob']
+        return super()._get_markdown_blob_sha(repo, ref)
+    def _get_markdown_blob(self, repo, blob_sha):
+        if blob_sha in self.graphql_blobs:
+            return self.graphql_blobs[blob_sha]
+        return super()._get_markdown_blob(repo, blob_sha)
+
+    def _get_markdown_template(self, repo, ref=github.GithubObject.NotSet):
+        commit = self._commit_index(repo).get(ref) if isinstance(ref, str) else None
+        if commit and 'blob' in commit:
+            return self._get_markdown_blob(repo, commit['blob']) if commit['blob'] else ''
+        return super()._get_markdown_template(repo, ref=ref)
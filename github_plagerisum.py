@@ -1,5 +1,209 @@
-# Placeholder for plagiarism detection
+"""
+Near-duplicate detection for technical reports - local, and near linear in the number of reports
 
-# https://codequiry.com/
-# https://codequiry.com/usage/api
+Each report is parsed into its heading tree (`markdown_parse.load_markdown`), lines that come from the template are removed
+and every section is shingled into overlapping runs of `SHINGLE_WORDS` words.
+Each section gets a MinHash signature (one permutation hashing - one hash per shingle into `NUM_PERM` bins),
+signatures are cut into `BANDS` bands and sections that share a band become candidate pairs (LSH).
+Only candidates are scored (exact Jaccard similarity of their shingles) - the cohort is never diffed pairwise,
+so past years can be included by just adding their reports.
 
+Previously a placeholder for https://codequiry.com/ (paid API)
+
+    python3 github_plagerisum.py --template technical_report.md clone2023 clone2022
+"""
+import re
+import hashlib
+from pathlib import Path
+from itertools import combinations
+from collections import defaultdict
+from typing import NamedTuple
+
+from markdown_parse import load_markdown
+
+import logging
+log = logging.getLogger(__name__)
+
+
+SHINGLE_WORDS = 5
+NUM_PERM = 128
+BANDS = 32  # 4 rows per band - sections above ~0.42 similarity are likely to become candidates
+MAX_BUCKET = 64  # a band shared by more sections than this is boilerplate (e.g. an unremoved template paragraph), not copying
+THRESHOLD = 0.5
+
+REGEX_WORDS = re.compile(r'\w+')
+REGEX_CODE_MARKER = re.compile(r'^FencedCode:')  # `load_markdown` reduces code blocks to a marker line
+
+
+class Match(NamedTuple):
+    similarity: float
+    a: str
+    section_a: tuple
+    b: str
+    section_b: tuple
+
+
+def sections(markdown_json, path=()):
+    """
+    Flatten the heading tree to `(heading_path, text)`
+
+    >>> tuple(sections(load_markdown('# A\\n\\nintro\\n\\n## B\\n\\nbody\\n')))
+    ((('A',), 'intro'), (('A', 'B'), 'body'))
+    """
+    for key, value in markdown_json.items():
+        if isinstance(value, dict):
+            yield from sections(value, path + (key, ))
+        elif value:
+            yield path, value
+
+def _normalise_line(line):
+    return ' '.join(REGEX_WORDS.findall(line.lower()))
+
+def template_lines(template):
+    return frozenset(filter(None, (
+        _normalise_line(line)
+        for _, text in sections(load_markdown(template or ''))
+        for line in text.split('\n')
+    )))
+
+def report_sections(text, _template_lines=frozenset()):
+    """
+    `{heading_path: text}` with the template's lines (and code block markers) removed
+
+    >>> report_sections('# A\\n\\nWrite 100 words here\\n\\nMy own words\\n', template_lines('# A\\n\\nWrite 100 words here\\n'))
+    {('A',): 'My own words'}
+    """
+    _return = {}
+    for path, section_text in sections(load_markdown(text or '')):
+        lines = tuple(
+            line for line in section_text.split('\n')
+            if line.strip() and not REGEX_CODE_MARKER.match(line) and _normalise_line(line) not in _template_lines
+        )
+        if lines:
+            _return[path] = '\n'.join(lines)
+    return _return
+
+
+def shingles(text, size=SHINGLE_WORDS):
+    """
+    64 bit hashes of every run of `size` words - empty when the text is too short to judge
+
+    >>> len(shingles('one two three four five six')), len(shingles('one two three'))
+    (2, 0)
+    """
+    words = REGEX_WORDS.findall(text.lower())
+    return frozenset(
+        int.from_bytes(hashlib.blake2b(' '.join(words[i:i+size]).encode('utf8'), digest_size=8).digest(), 'big')
+        for i in range(len(words) - size + 1)
+    )
+
+def minhash(_shingles, num_perm=NUM_PERM):
+    """
+    One permutation hashing: each shingle lands in one of `num_perm` bins (by its hash) and each bin keeps its minimum.
+    Empty bins borrow from the next non-empty bin (rotation densification) so short sections still get comparable signatures.
+
+    >>> a, b = shingles(' '.join(map(str, range(300)))), shingles(' '.join(map(str, range(30, 330))))
+    >>> estimate = sum(x == y for x, y in zip(minhash(a), minhash(b))) / NUM_PERM
+    >>> round(len(a & b) / len(a | b), 2), 0.7 < estimate < 0.95
+    (0.82, True)
+    """
+    bins = [None] * num_perm
+    for _hash in _shingles:
+        index, value = _hash % num_perm, _hash // num_perm
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    if all(value is None for value in bins):
+        return ()
+    offset = 2 ** 64 // num_perm  # above any real bin value - a borrowed value never equals an original one
+    def _densify(index):
+        distance = 0
+        while bins[(index + distance) % num_perm] is None:
+            distance += 1
+        return bins[(index + distance) % num_perm] + distance * offset
+    return tuple(map(_densify, range(num_perm)))
+
+def lsh_candidates(signatures, bands=BANDS, max_bucket=MAX_BUCKET):
+    """
+    Pairs of keys whose signatures are identical in at least one band
+    """
+    buckets = defaultdict(list)
+    for key, signature in signatures.items():
+        if not signature:
+            continue
+        rows = len(signature) // bands
+        for band in range(bands):
+            buckets[(band, signature[band*rows:(band+1)*rows])].append(key)
+    candidates = set()
+    for keys in buckets.values():
+        if len(keys) > max_bucket:
+            log.debug(f'ignoring band shared by {len(keys)} sections')
+            continue
+        candidates.update(combinations(sorted(keys), 2))
+    return candidates
+
+
+def near_duplicates(reports, template='', threshold=THRESHOLD):
+    """
+    `Match`es between sections of different `reports` ({name: markdown_text}) - most similar first
+
+    >>> template = '# Report\\n\\n## Server\\n\\nDescribe your server in 100 words\\n\\n## Client\\n\\nDescribe your client\\n'
+    >>> server = 'My server uses asyncio with a small router that maps each path and method to a handler and returns json for every route we defined'
+    >>> reports = {
+    ...     'alice': template.replace('in 100 words', f'in 100 words\\n\\n{server}'),
+    ...     'bob': template.replace('in 100 words', f'in 100 words\\n\\n{server.replace("small", "tiny")}'),
+    ...     'carol': template.replace('in 100 words', '\\n\\nI wrote a blocking socket server that parses http headers by hand and then closes the connection'),
+    ... }
+    >>> near_duplicates(reports, template)
+    (Match(similarity=0.62, a='alice', section_a=('Report', 'Server'), b='bob', section_b=('Report', 'Server')),)
+    """
+    _template_lines = template_lines(template)
+    section_shingles = {
+        (name, path): _shingles
+        for name, text in reports.items()
+        for path, section_text in report_sections(text, _template_lines).items()
+        for _shingles in (shingles(section_text), )
+        if _shingles
+    }
+    candidates = lsh_candidates({key: minhash(_shingles) for key, _shingles in section_shingles.items()})
+    log.info(f'{len(section_shingles)} sections from {len(reports)} reports - {len(candidates)} candidate pairs')
+    matches = []
+    for key_a, key_b in candidates:
+        if key_a[0] == key_b[0]:
+            continue  # sections of the same report
+        a, b = section_shingles[key_a], section_shingles[key_b]
+        similarity = len(a & b) / len(a | b)
+        if similarity >= threshold:
+            matches.append(Match(round(similarity, 2), *key_a, *key_b))
+    return tuple(sorted(matches, key=lambda match: (-match.similarity, match.a, match.b, match.section_a)))
+
+def near_duplicate_reports(matches):
+    """
+    `{(a, b): (max_similarity, number_of_matching_sections)}` - one line per pair of reports
+    """
+    pairs = defaultdict(list)
+    for match in matches:
+        pairs[(match.a, match.b)].append(match.similarity)
+    return {pair: (max(similarities), len(similarities)) for pair, similarities in pairs.items()}
+
+
+if __name__ == "__main__":
+    import argparse
+    from markdown_grade import report_paths
+    parser = argparse.ArgumentParser(description='Find near-duplicate sections between technical reports')
+    parser.add_argument('paths', nargs='+', type=Path, help='report files or clone folders (e.g. one per year)')
+    parser.add_argument('--template', type=Path, help='template report - its lines are ignored')
+    parser.add_argument('--filename', default='technical_report.md', help='report filename within each clone of a folder')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--sections', action='store_true', help='list every matching section rather than one line per pair of reports')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    paths = tuple(path for _path in args.paths for path in (report_paths(_path, args.filename) if _path.is_dir() else (_path, )))
+    reports = {str(path.parent): path.read_text(errors='replace') for path in paths}
+    matches = near_duplicates(reports, args.template.read_text() if args.template else '', args.threshold)
+    if args.sections:
+        for match in matches:
+            print(f'{match.similarity:.2f}\t{match.a}\t{"/".join(match.section_a)}\t{match.b}\t{"/".join(match.section_b)}')
+    else:
+        for (a, b), (similarity, count) in sorted(near_duplicate_reports(matches).items(), key=lambda item: -item[1][0]):
+            print(f'{similarity:.2f}\t{count}\t{a}\t{b}')
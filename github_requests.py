@@ -0,0 +1,252 @@
+"""
+Shared request layer for talking to GitHub
+
+Used directly by `github_artifacts` and by PyGithub (see `use_github_session`), so every call
+* is paced by the `X-RateLimit-*` headers and backs off on primary/secondary rate limits
+* is sent as a conditional request (`If-None-Match`/`If-Modified-Since`) when we have seen it before.
+  GitHub does not count `304 Not Modified` against the quota, and the stored body is returned in its place.
+* reuses pooled keep-alive connections, has default timeouts and retries 5xx/connection errors with jittered backoff
+
+https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+"""
+import time
+import hashlib
+import datetime
+import threading
+from pathlib import Path
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+import github
+
+from cache_tools import cache_backend, default_cache_backend
+from metrics import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+
+ETAG_TTL = datetime.timedelta(days=30)  # older stored responses are dropped - the request is then sent unconditionally
+
+
+class ETagStore():
+    """
+    Stored `(headers, body)` per request, kept in the `cache_tools` backend for `path` (`CACHE_PATH` by default) -
+    so it is written atomically and bounded/evicted along with the rest of the cache
+
+    >>> import tempfile
+    >>> store = ETagStore(Path(tempfile.mkdtemp()))
+    >>> store.get('key')
+    >>> store.set('key', {'ETag': '"abc"'}, b'{}')
+    >>> store.get('key')
+    ({'ETag': '"abc"'}, b'{}')
+    """
+    def __init__(self, path=None, ttl=ETAG_TTL):
+        assert path is None or isinstance(path, Path)
+        self.path = path
+        self.ttl = ttl
+    @property
+    def backend(self):
+        return cache_backend(self.path) if self.path else default_cache_backend()
+    def get(self, key):
+        try:
+            return self.backend.get(f'etag_{key}', self.ttl)
+        except KeyError:
+            return None
+    def set(self, key, headers, content):
+        self.backend.set(f'etag_{key}', (headers, content), self.ttl)
+
+
+class RateLimitETagAdapter(HTTPAdapter):
+    RATE_LIMIT_RESERVE = 200  # Spread the remaining requests until reset once fewer than this remain
+    MAX_RATE_LIMIT_RETRIES = 5
+    SECONDARY_RATE_LIMIT_SECONDS = 60
+    STORE_CONTENT_TYPES = ('application/json',)
+    DROP_STORED_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding')
+
+    def __init__(self, *args, etag_store=None, timeout=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.etag_store = etag_store
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.rate_limits = {}  # resource -> (remaining, reset_timestamp)
+        self.blocked_until = 0
+
+    @staticmethod
+    def _resource(url):
+        return 'graphql' if url.rstrip('/').endswith('/graphql') else 'core'
+    @staticmethod
+    def _etag_key(request):
+        return hashlib.sha1('\n'.join((
+            request.url,
+            request.headers.get('Accept', ''),
+            request.headers.get('Authorization', ''),
+        )).encode('utf8')).hexdigest()
+
+    def _wait(self, resource):
+        with self._lock:
+            now = time.time()
+            delay = self.blocked_until - now
+            remaining, reset = self.rate_limits.get(resource, (None, None))
+            if delay <= 0 and remaining is not None and remaining < self.RATE_LIMIT_RESERVE and reset > now:
+                delay = (reset - now) / max(remaining, 1)
+        if delay > 0:
+            log.debug(f'pacing {resource} requests - sleeping {delay:.1f}s')
+            time.sleep(delay)
+
+    def _update_rate_limit(self, response):
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        with self._lock:
+            self.rate_limits[headers.get('X-RateLimit-Resource', self._resource(response.url))] = (
+                int(headers['X-RateLimit-Remaining']),
+                int(headers.get('X-RateLimit-Reset', 0)),
+            )
+
+    def _backoff_seconds(self, response, attempt=0):
+        """
+        Seconds to wait before retrying a rate limited response (None if not rate limited)
+
+        >>> adapter = RateLimitETagAdapter()
+        >>> def _response(status_code, headers={}, text=''):
+        ...     response = requests.Response()
+        ...     response.status_code, response._content = status_code, text.encode('utf8')
+        ...     response.headers.update(headers)
+        ...     return response
+        >>> adapter._backoff_seconds(_response(200))
+        >>> adapter._backoff_seconds(_response(403, text='Resource not accessible by integration'))
+        >>> adapter._backoff_seconds(_response(429, {'Retry-After': '30'}))
+        30
+        >>> adapter._backoff_seconds(_response(403, text='You have exceeded a secondary rate limit'), attempt=1)
+        120
+        >>> adapter._backoff_seconds(_response(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 9)})) in (9, 10)
+        True
+        """
+        if response.status_code not in (403, 429):
+            return None
+        if 'Retry-After' in response.headers:
+            return int(response.headers['Retry-After'])
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return max(int(response.headers.get('X-RateLimit-Reset', 0)) - int(time.time()), 0) + 1
+        if response.status_code == 429 or 'secondary rate limit' in response.text.lower():
+            return self.SECONDARY_RATE_LIMIT_SECONDS * (2 ** attempt)
+        return None
+
+    def _stored_response(self, request, response_not_modified, stored):
+        headers, content = stored
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers.update({
+            k: v for k, v in response_not_modified.headers.items()
+            if k.lower().startswith('x-ratelimit')
+        })
+        response._content = content
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_etag_store = True
+        return response
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        key = None
+        stored = None
+        if self.etag_store and request.method == 'GET' and not kwargs.get('stream'):
+            key = self._etag_key(request)
+            stored = self.etag_store.get(key)
+        if stored:
+            headers, _ = stored
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        resource = self._resource(request.url)
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES + 1):
+            self._wait(resource)
+            response = super().send(request, **kwargs)
+            self._update_rate_limit(response)
+            delay = self._backoff_seconds(response, attempt)
+            if delay is None or attempt == self.MAX_RATE_LIMIT_RETRIES:
+                break
+            log.warning(f'rate limited ({response.status_code}) - backing off {delay}s - {request.url}')
+            with self._lock:
+                self.blocked_until = max(self.blocked_until, time.time() + delay)
+            response.close()
+
+        if stored and response.status_code == 304:
+            return self._stored_response(request, response, stored)
+        if (
+            key and response.status_code == 200
+            and ('ETag' in response.headers or 'Last-Modified' in response.headers)
+            and response.headers.get('Content-Type', '').startswith(self.STORE_CONTENT_TYPES)
+        ):
+            self.etag_store.set(key, {
+                k: v for k, v in response.headers.items()
+                if k not in self.DROP_STORED_HEADERS
+            }, response.content)
+        return response
+
+
+DEFAULT_TIMEOUT = (10, 60)  # (connect, read) seconds
+DEFAULT_POOL_SIZE = 32
+DEFAULT_RETRY = Retry(
+    total=5,
+    status_forcelist=(500, 502, 503, 504),  # 403/429 rate limits are handled by RateLimitETagAdapter
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    raise_on_status=False,
+)
+
+def github_session(etag_store=None, pool_size=DEFAULT_POOL_SIZE, retry=DEFAULT_RETRY, timeout=DEFAULT_TIMEOUT):
+    session = requests.Session()
+    session.auth = github.Requester.Requester.noopAuth  # Disable .netrc fallback - Authorization is always explicit
+    adapter = RateLimitETagAdapter(
+        etag_store=etag_store or ETagStore(),
+        timeout=timeout,
+        max_retries=retry,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(metrics.record_response)
+    return session
+
+session = github_session()
+
+
+# PyGithub ---------------------------------------------------------------------
+
+class GithubSessionHTTPSConnection(github.Requester.HTTPSRequestsConnectionClass):
+    """
+    PyGithub connection that sends through a shared session (rather than creating a session per connection)
+    Retries and pooling come from the shared session - PyGithub's `retry`/`pool_size` are ignored
+    """
+    protocol = 'https'
+    default_port = 443
+    shared_session = None
+    def __init__(self, host, port=None, strict=False, timeout=None, retry=None, pool_size=None, **kwargs):
+        self.host = host
+        self.port = port if port else self.default_port
+        self.timeout = timeout
+        self.verify = kwargs.get('verify', True)
+        self.session = self.shared_session or session
+    def close(self):
+        pass  # The shared session outlives PyGithub's connections
+
+class GithubSessionHTTPConnection(GithubSessionHTTPSConnection):
+    protocol = 'http'
+    default_port = 80
+
+def use_github_session(shared_session=None):
+    GithubSessionHTTPSConnection.shared_session = shared_session
+    github.Requester.Requester.injectConnectionClasses(GithubSessionHTTPConnection, GithubSessionHTTPSConnection)
@@ -0,0 +1,344 @@
+"""
+Local stand-in for api.github.com - serves canned responses so the network stages can be exercised offline
+
+JSON listings honour the query parameters the crawl sends - `since`/`until` (commits), `created` (workflow runs)
+and `page`/`per_page` (with `Link` headers) - and every response has an `ETag` (`304` on a matching `If-None-Match`).
+"""
+import io
+import json
+import hashlib
+import datetime
+import threading
+from os import environ
+from contextlib import contextmanager
+from collections import Counter
+from zipfile import ZipFile
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+log = logging.getLogger(__name__)
+
+
+PER_PAGE = 30  # GitHub's default page size
+
+
+def _parse_date(text):
+    """
+    Naive UTC - GitHub timestamps (`Z` suffixed), naive isoformat or a plain date
+
+    >>> _parse_date('2023-10-02T01:00:00Z'), _parse_date('2023-10-02')
+    (datetime.datetime(2023, 10, 2, 1, 0), datetime.datetime(2023, 10, 2, 0, 0))
+    """
+    date = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    return date.astimezone(datetime.timezone.utc).replace(tzinfo=None) if date.tzinfo else date
+
+def _date_range(created):
+    """
+    GitHub's date search syntax (`>=date`, `<date`, `date..date`, `date`) as a predicate
+
+    >>> tuple(map(_date_range('>=2023-10-02T01:00:00'), (datetime.datetime(2023, 10, 2), datetime.datetime(2023, 10, 3))))
+    (False, True)
+    >>> tuple(map(_date_range('2023-10-01..2023-10-02'), (datetime.datetime(2023, 10, 2), datetime.datetime(2023, 10, 3))))
+    (True, False)
+    """
+    for operator, compare in (('>=', datetime.datetime.__ge__), ('<=', datetime.datetime.__le__), ('>', datetime.datetime.__gt__), ('<', datetime.datetime.__lt__)):
+        if created.startswith(operator):
+            bound = _parse_date(created[len(operator):])
+            return lambda date: compare(date, bound)
+    start, _, end = created.partition('..')
+    start, end = _parse_date(start), _parse_date(end) if end else None
+    return lambda date: start <= date <= end if end else start <= date < start + datetime.timedelta(days=1)
+
+def _filter_page(data, query):
+    """
+    Apply `query` to a JSON listing - a list, or an object holding one list (`workflow_runs`, `artifacts`, ...).
+    Returns `(data, last_page)` - `last_page` is `None` for responses that are not listings.
+    """
+    key = next((key for key, value in data.items() if isinstance(value, list)), None) if isinstance(data, dict) else None
+    items = data if isinstance(data, list) else data[key] if key else None
+    if items is None:
+        return data, None
+    if 'since' in query or 'until' in query:
+        since, until = (_parse_date(query[k]) if k in query else None for k in ('since', 'until'))
+        date = lambda item: _parse_date(item['commit']['committer']['date'])
+        items = [item for item in items if (not since or date(item) >= since) and (not until or date(item) <= until)]
+    if 'created' in query:
+        items = [item for item in items if _date_range(query['created'])(_parse_date(item['created_at']))]
+    per_page, page = min(int(query.get('per_page', PER_PAGE)), 100), int(query.get('page', 1))
+    last_page = max((len(items) - 1) // per_page + 1, 1)
+    page_items = items[(page - 1) * per_page:page * per_page]
+    if isinstance(data, list):
+        return page_items, last_page
+    return {**data, key: page_items, **({'total_count': len(items)} if 'total_count' in data else {})}, last_page
+
+
+class StubGithubRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path, query = url.path, dict(parse_qsl(url.query))
+        self.server.requests[path] += 1
+        if path not in self.server.routes:
+            return self._send(404, 'application/json', json.dumps({'message': 'Not Found'}).encode('utf8'))
+        content_type, body = self.server.routes[path]
+        headers = {}
+        if content_type.startswith('application/json'):
+            data, last_page = _filter_page(json.loads(body), query)
+            if last_page:
+                body = json.dumps(data).encode('utf8')
+                page = int(query.get('page', 1))
+                link = lambda page: f'<{self.server.url}{path}?{urlencode({**query, "page": page})}>'
+                headers['Link'] = ', '.join(
+                    f'{link(_page)}; rel="{rel}"'
+                    for rel, _page in (('prev', page - 1), ('next', page + 1), ('last', last_page), ('first', 1))
+                    if 1 <= _page <= last_page and (rel in ('last', 'first') or _page != page)
+                ) if last_page > 1 else None
+        headers['ETag'] = f'"{hashlib.sha1(body).hexdigest()}"'
+        if headers['ETag'] in (self.headers.get('If-None-Match') or ''):
+            return self._send(304, content_type, b'', headers)
+        self._send(200, content_type, body, headers)
+    def _send(self, status, content_type, body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.items():
+            if value:
+                self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class StubGithub(ThreadingHTTPServer):
+    """
+    >>> import requests
+    >>> with StubGithub() as stub:
+    ...     stub.add_json('/repos/user/repo', {'full_name': 'user/repo'})
+    ...     requests.get(f'{stub.url}/repos/user/repo').json(), requests.get(f'{stub.url}/nope').status_code
+    ({'full_name': 'user/repo'}, 404)
+
+    Listings are filtered and paged like GitHub's
+
+    >>> with StubGithub() as stub:
+    ...     stub.add_json('/repos/user/repo/commits', [{'sha': str(day), 'commit': {'committer': {'date': f'2023-10-{day:02}T12:00:00Z'}}} for day in range(9, 0, -1)])
+    ...     stub.add_json('/repos/user/repo/actions/runs', {'total_count': 3, 'workflow_runs': [{'id': day, 'created_at': f'2023-10-{day:02}T12:00:00Z'} for day in (3, 2, 1)]})
+    ...     response = requests.get(f'{stub.url}/repos/user/repo/commits', params={'since': '2023-10-02T00:00:00Z', 'until': '2023-10-07T00:00:00Z', 'per_page': 2, 'page': 2})
+    ...     [commit['sha'] for commit in response.json()], response.links['next']['url'].endswith('page=3'), response.links['last']['url'].endswith('page=3')
+    ...     requests.get(f'{stub.url}/repos/user/repo/actions/runs', params={'created': '>=2023-10-02T00:00:00'}).json()
+    ...     etag = requests.get(f'{stub.url}/repos/user/repo/commits').headers['ETag']
+    ...     requests.get(f'{stub.url}/repos/user/repo/commits', headers={'If-None-Match': etag}).status_code, stub.requests['/repos/user/repo/commits']
+    (['4', '3'], True, True)
+    {'total_count': 2, 'workflow_runs': [{'id': 3, 'created_at': '2023-10-03T12:00:00Z'}, {'id': 2, 'created_at': '2023-10-02T12:00:00Z'}]}
+    (304, 3)
+    """
+    daemon_threads = True
+
+    def __init__(self, routes=None, port=0):
+        super().__init__(('127.0.0.1', port), StubGithubRequestHandler)
+        self.routes = routes or {}  # path -> (content_type, body)
+        self.requests = Counter()  # path -> number of requests
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    def add_json(self, path, data):
+        self.routes[path] = ('application/json; charset=utf-8', json.dumps(data).encode('utf8'))
+    def add_bytes(self, path, data, content_type='application/zip'):
+        self.routes[path] = (content_type, data)
+
+    def add_artifacts(self, repo, run_id, files, name='junit'):
+        """
+        Serve a workflow run's artifact listing plus a zip download of `files` ({filename: bytes})
+        Returns the artifacts url (as found on `WorkflowRun.artifacts_url`)
+        """
+        zip_buffer = io.BytesIO()
+        with ZipFile(zip_buffer, 'w') as zipfile:
+            for filename, data in files.items():
+                zipfile.writestr(filename, data)
+        zip_path = f'/repos/{repo}/actions/artifacts/{run_id}/zip'
+        self.add_bytes(zip_path, zip_buffer.getvalue())
+        artifacts_path = f'/repos/{repo}/actions/runs/{run_id}/artifacts'
+        self.add_json(artifacts_path, {
+            'total_count': 1,
+            'artifacts': [{
+                'id': run_id,
+                'name': name,
+                'size_in_bytes': len(zip_buffer.getvalue()),
+                'archive_download_url': f'{self.url}{zip_path}',
+                'workflow_run': {'id': run_id, 'head_sha': ''},
+            }],
+        })
+        return f'{self.url}{artifacts_path}'
+
+
+def synthetic_cohort(stub, forks=4, weeks=4, commits_per_week=3, tests_per_suite=8, workflows=('test_server', 'test_client'), date_start='2023-09-25', upstream='tutor/module', template_filename='technical_report.md', seed=0):
+    """
+    Serve a whole cohort from `stub` - an upstream repo with `forks` student forks, each with `commits_per_week` commits for `weeks` weeks.
+    Every commit has a run per workflow (with a JUnit artifact zip) and a version of the markdown report (rewritten every other commit).
+    Deterministic for a given `seed`. Returns `GitHubForkData` settings for the cohort.
+
+    >>> import requests
+    >>> with StubGithub() as stub:
+    ...     settings = synthetic_cohort(stub, forks=2, weeks=1, commits_per_week=2)
+    ...     requests.get(f'{stub.url}/repos/tutor/module/forks').json()[1]['full_name'], len(requests.get(f'{stub.url}/repos/student1/module/commits').json())
+    ('student1/module', 2)
+    >>> settings['repo'], settings['date_end']
+    ('tutor/module', '2023-10-02')
+    """
+    import base64
+    import random
+    import hashlib
+    import datetime
+    rng = random.Random(seed)
+    sha1 = lambda text: hashlib.sha1(text.encode('utf8')).hexdigest()
+    timestamp = lambda date: date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    date_start = datetime.datetime.fromisoformat(date_start)
+    date_end = date_start + datetime.timedelta(days=7 * weeks)
+    template = '# Technical Report\n\n## Server\n\n100 words 5 marks\n\n## Client\n\n100 words 5 marks\n\n## Code\n\n```python\n```\n'
+
+    def add_repo(full_name, fork=False):
+        login, name = full_name.split('/')
+        url = f'{stub.url}/repos/{full_name}'
+        data = {
+            'id': int(sha1(full_name)[:8], 16), 'name': name, 'full_name': full_name, 'fork': fork, 'default_branch': 'main',
+            'owner': {'login': login, 'id': int(sha1(login)[:8], 16), 'type': 'User', 'url': f'{stub.url}/users/{login}'},
+            'url': url, 'html_url': f'https://github.com/{full_name}',
+            'created_at': timestamp(date_start), 'updated_at': timestamp(date_end), 'pushed_at': timestamp(date_end),
+        }
+        stub.add_json(f'/repos/{full_name}', data)
+        return data
+    def add_contents(full_name, text):
+        content = text.encode('utf8')
+        stub.add_json(f'/repos/{full_name}/contents/{template_filename}', {
+            'type': 'file', 'encoding': 'base64', 'name': template_filename, 'path': template_filename,
+            'sha': sha1(text), 'size': len(content), 'content': base64.b64encode(content).decode('ascii'),
+        })
+
+    add_repo(upstream)
+    add_contents(upstream, template)
+    forks_data = []
+    run_id = 0
+    for fork_index in range(forks):
+        full_name = f'student{fork_index}/{upstream.split("/")[1]}'
+        url = f'{stub.url}/repos/{full_name}'
+        forks_data.append(add_repo(full_name, fork=True))
+        stub.add_json(f'/repos/{full_name}/actions/workflows', {'total_count': len(workflows), 'workflows': [
+            {'id': workflow_id, 'name': workflow, 'path': f'.github/workflows/{workflow}.yml', 'state': 'active', 'url': f'{url}/actions/workflows/{workflow_id}'}
+            for workflow_id, workflow in enumerate(workflows, 1)
+        ]})
+        commits, runs, report = [], {workflow: [] for workflow in workflows}, template
+        for commit_index in range(weeks * commits_per_week):
+            date = date_start + datetime.timedelta(days=7 * (commit_index // commits_per_week), hours=1 + commit_index % commits_per_week)
+            sha = sha1(f'{full_name}:{commit_index}')
+            if commit_index % 2 == 0:
+                report += ' '.join(rng.choice(('http', 'server', 'client', 'framework', 'language')) for _ in range(rng.randint(5, 40))) + '\n'
+            blob_sha = sha1(report)
+            stub.add_json(f'/repos/{full_name}/git/trees/{sha}', {'sha': sha, 'url': f'{url}/git/trees/{sha}', 'truncated': False, 'tree': [
+                {'path': template_filename, 'mode': '100644', 'type': 'blob', 'sha': blob_sha, 'size': len(report), 'url': f'{url}/git/blobs/{blob_sha}'},
+            ]})
+            stub.add_json(f'/repos/{full_name}/git/blobs/{blob_sha}', {
+                'sha': blob_sha, 'encoding': 'base64', 'size': len(report), 'url': f'{url}/git/blobs/{blob_sha}',
+                'content': base64.b64encode(report.encode('utf8')).decode('ascii'),
+            })
+            person = {'name': full_name.split('/')[0], 'email': 'student@example.com', 'date': timestamp(date)}
+            commits.insert(0, {'sha': sha, 'url': f'{url}/commits/{sha}', 'commit': {'message': f'commit {commit_index}', 'author': person, 'committer': person}})
+            for workflow in workflows:
+                run_id += 1
+                testcases = ''.join(
+                    f'<testcase classname="{workflow}" name="test_{test}" time="0.01"/>' if rng.random() < 0.7 else
+                    f'<testcase classname="{workflow}" name="test_{test}" time="0.01"><failure message="assert False">trace</failure></testcase>'
+                    for test in range(tests_per_suite)
+                )
+                artifacts_url = stub.add_artifacts(full_name, run_id, {'junit.xml': f'<testsuites><testsuite name="{workflow}" tests="{tests_per_suite}">{testcases}</testsuite></testsuites>'})
+                runs[workflow].insert(0, {
+                    'id': run_id, 'name': workflow, 'head_sha': sha, 'status': 'completed', 'conclusion': 'success',
+                    'url': f'{url}/actions/runs/{run_id}', 'artifacts_url': artifacts_url,
+                    'created_at': timestamp(date + datetime.timedelta(minutes=5)), 'updated_at': timestamp(date + datetime.timedelta(minutes=10)),
+                })
+        stub.add_json(f'/repos/{full_name}/commits', commits)
+        for workflow_id, workflow in enumerate(workflows, 1):
+            stub.add_json(f'/repos/{full_name}/actions/workflows/{workflow_id}/runs', {'total_count': len(runs[workflow]), 'workflow_runs': runs[workflow]})
+        add_contents(full_name, report)
+    stub.add_json(f'/repos/{upstream}/forks', forks_data)
+
+    return {
+        'repo': upstream,
+        'date_start': date_start.date().isoformat(),
+        'date_end': date_end.date().isoformat(),
+        'timedelta_days': '7',
+        'workflows': list(workflows),
+        'markdown_template_filename': template_filename,
+    }
+
+
+@contextmanager
+def cache_path(path):
+    """
+    Point `CACHE_PATH` (the `cache_disk`/ETag default backend) at `path` for the duration - keeps a test run out of the real cache
+
+    >>> import tempfile
+    >>> from pathlib import Path
+    >>> from cache_tools import default_cache_backend
+    >>> path = Path(tempfile.mkdtemp()).joinpath('cache')
+    >>> with cache_path(path):
+    ...     default_cache_backend().path == path
+    True
+    >>> default_cache_backend().path == path
+    False
+    """
+    previous = environ.get('CACHE_PATH')
+    environ['CACHE_PATH'] = str(path)
+    try:
+        yield path
+    finally:
+        if previous is None:
+            del environ['CACHE_PATH']
+        else:
+            environ['CACHE_PATH'] = previous
+
+
+class RecordedGraphQL():
+    """
+    Stand-in for `github_graphql.GithubGraphQL` - replays recorded `data` responses in order and records the queries asked
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.queries = []  # (query, variables)
+    def query(self, query, **variables):
+        self.queries.append((query, variables))
+        return self.responses.pop(0)
+
+
+def git_test_repo(path, commits, name='student'):
+    """
+    Create a local git repository at `path` - `commits` are `(committer_date, {filename: text})` applied in order
+    Returns the commit shas (oldest first)
+    """
+    import os
+    import subprocess
+    from pathlib import Path
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    git = lambda *args, **env: subprocess.run(('git', '-C', str(path)) + args, check=True, capture_output=True, env={**os.environ, **env}).stdout.decode('utf8').strip()
+    git('init', '--quiet', '--initial-branch=main')
+    shas = []
+    for date, files in commits:
+        for filename, text in files.items():
+            path.joinpath(filename).write_text(text)
+        git('add', '--all')
+        date = date.isoformat()
+        git(
+            '-c', f'user.name={name}', '-c', f'user.email={name}@example.com', 'commit', '--quiet', '--allow-empty', '--message', f'commit {date}',
+            GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date,
+        )
+        shas.append(git('rev-parse', 'HEAD'))
+    return shas
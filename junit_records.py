@@ -0,0 +1,193 @@
+"""
+Streaming JUnit XML reader
+
+`iterparse` over the xml (a file handle straight out of the artifact zip is fine) -
+each `<testcase>` is reduced to a `TestCase` record and cleared as soon as it closes,
+so a large suite is never held as an element tree plus a dict tree at the same time.
+Records are plain tuples - immutable, small and cheap to pickle into `cache_disk`.
+
+`TestSuite.to_badgerfish()` emits the json shape the viewers have always consumed
+(`xmljson.BadgerFish` style `@attribute`/`$` keys), except that `testcase` and `property`
+are always lists.
+"""
+from io import BytesIO
+from typing import NamedTuple, Optional
+from xml.etree import ElementTree
+
+
+STATUSES = ('failure', 'error', 'skipped')  # first matching child element of a `<testcase>` - otherwise 'passed'
+
+
+def _badgerfish_value(value):
+    """
+    The value conversion `xmljson` applies to attributes/text
+
+    >>> tuple(map(_badgerfish_value, ('true', 'False', '3', '0.5', 'a', '')))
+    (True, False, 3, 0.5, 'a', '')
+    """
+    lower = value.strip().lower()
+    if lower in ('true', 'false'):
+        return lower == 'true'
+    for _type in (int, float):
+        try:
+            return _type(value)
+        except ValueError:
+            pass
+    return value
+
+def _int(value, fallback):
+    return int(value) if value not in (None, '') else fallback
+def _float(value):
+    return float(value) if value not in (None, '') else None
+
+
+class TestCase(NamedTuple):
+    name: str
+    classname: str = ''
+    time: Optional[float] = None
+    status: str = 'passed'
+    message: str = ''
+    detail: str = ''
+    system_out: str = ''
+    system_err: str = ''
+
+    @classmethod
+    def from_element(cls, element):
+        result = next((child for child in element if child.tag in STATUSES), None)
+        return cls(
+            name=element.get('name', ''),
+            classname=element.get('classname', ''),
+            time=_float(element.get('time')),
+            status=result.tag if result is not None else 'passed',
+            message=result.get('message', '') if result is not None else '',
+            detail=(result.text or '') if result is not None else '',
+            system_out=element.findtext('system-out') or '',
+            system_err=element.findtext('system-err') or '',
+        )
+
+    def to_badgerfish(self):
+        _return = {'@name': _badgerfish_value(self.name)}
+        if self.classname:
+            _return = {'@classname': _badgerfish_value(self.classname), **_return}
+        if self.time is not None:
+            _return['@time'] = self.time
+        if self.status != 'passed':
+            result = {'@message': _badgerfish_value(self.message)} if self.message else {}
+            if self.detail:
+                result['$'] = _badgerfish_value(self.detail)
+            _return[self.status] = result
+        for key, text in (('system-out', self.system_out), ('system-err', self.system_err)):
+            if text:
+                _return[key] = {'$': _badgerfish_value(text)}
+        return _return
+
+
+class TestSuite(NamedTuple):
+    name: str
+    tests: int = 0
+    failures: int = 0
+    errors: int = 0
+    skipped: int = 0
+    time: Optional[float] = None
+    properties: tuple = ()  # ((name, value), ...)
+    testcases: tuple = ()
+
+    @classmethod
+    def from_attrib(cls, attrib, properties=(), testcases=()):
+        testcases = tuple(testcases)
+        count = lambda status: sum(1 for testcase in testcases if testcase.status == status)
+        return cls(
+            name=attrib.get('name', ''),
+            tests=_int(attrib.get('tests'), len(testcases)),
+            failures=_int(attrib.get('failures'), count('failure')),
+            errors=_int(attrib.get('errors'), count('error')),
+            skipped=_int(attrib.get('skipped'), count('skipped')),
+            time=_float(attrib.get('time')),
+            properties=tuple(properties),
+            testcases=testcases,
+        )
+
+    def property(self, name, fallback=''):
+        return next((value for _name, value in self.properties if _name == name), fallback)
+    def with_property(self, name, value):
+        return self._replace(properties=self.properties + ((name, value), ))
+
+    def to_badgerfish(self):
+        """
+        >>> suite = junit_suite(b'<testsuites><testsuite name="s" tests="2" failures="1" time="0.5"><testcase classname="c" name="t1" time="0.1"><failure message="boom">trace</failure></testcase><testcase name="t2"/></testsuite></testsuites>')
+        >>> suite.with_property('url', 'http://example.com/').to_badgerfish()
+        {'@name': 's', '@tests': 2, '@errors': 0, '@failures': 1, '@skipped': 0, '@time': 0.5, 'properties': {'property': [{'@name': 'url', '@value': 'http://example.com/'}]}, 'testcase': [{'@classname': 'c', '@name': 't1', '@time': 0.1, 'failure': {'@message': 'boom', '$': 'trace'}}, {'@name': 't2'}]}
+        """
+        _return = {
+            '@name': _badgerfish_value(self.name),
+            '@tests': self.tests,
+            '@errors': self.errors,
+            '@failures': self.failures,
+            '@skipped': self.skipped,
+        }
+        if self.time is not None:
+            _return['@time'] = self.time
+        if self.properties:
+            _return['properties'] = {'property': [{'@name': name, '@value': _badgerfish_value(value)} for name, value in self.properties]}
+        _return['testcase'] = [testcase.to_badgerfish() for testcase in self.testcases]
+        return _return
+
+
+def iterparse_suites(source):
+    """
+    Yield a `TestSuite` for every `<testsuite>` in `source` (bytes, a path or a binary file handle) - nested suites before their parent
+
+    >>> xml = b'''<testsuites>
+    ...   <testsuite name="empty" tests="0"/>
+    ...   <testsuite name="s1"><properties><property name="a" value="1"/></properties>
+    ...     <testcase name="t1" time="0.25"><skipped message="later"/><system-out>out</system-out></testcase>
+    ...     <testcase name="t2"><properties><property name="ignored" value="x"/></properties><error message="oops"/></testcase>
+    ...   </testsuite>
+    ... </testsuites>'''
+    >>> empty, s1 = iterparse_suites(xml)
+    >>> empty
+    TestSuite(name='empty', tests=0, failures=0, errors=0, skipped=0, time=None, properties=(), testcases=())
+    >>> s1.tests, s1.errors, s1.skipped, s1.properties
+    (2, 1, 1, (('a', '1'),))
+    >>> s1.testcases[0]
+    TestCase(name='t1', classname='', time=0.25, status='skipped', message='later', detail='', system_out='out', system_err='')
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    stack = []  # `(properties, testcases)` per open `<testsuite>`
+    testcase_depth = 0  # `<property>` inside a `<testcase>` belongs to the testcase, not the suite
+    for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'testsuite':
+                stack.append(([], []))
+            elif element.tag == 'testcase':
+                testcase_depth += 1
+            continue
+        if element.tag == 'property' and stack and not testcase_depth:
+            stack[-1][0].append((element.get('name', ''), element.get('value', '')))
+        elif element.tag == 'testcase':
+            testcase_depth -= 1
+            if stack:
+                stack[-1][1].append(TestCase.from_element(element))
+            element.clear()
+        elif element.tag == 'testsuite':
+            properties, testcases = stack.pop()
+            yield TestSuite.from_attrib(element.attrib, properties, testcases)
+            element.clear()
+
+def junit_suite(source):
+    """
+    The suite that actually has some tests (CI sometimes reports an empty root suite alongside the real one)
+
+    >>> junit_suite(b'<testsuites><testsuite name="root" tests="0"/><testsuite name="real" tests="1"><testcase name="a"/></testsuite></testsuites>').name
+    'real'
+    >>> junit_suite(b'<testsuite name="only" tests="0"/>').name
+    'only'
+    >>> junit_suite(b'<testsuites/>')
+    """
+    _return = None
+    for suite in iterparse_suites(source):
+        if suite.tests > 0:
+            return suite
+        _return = _return or suite
+    return _return
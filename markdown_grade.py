@@ -1,5 +1,7 @@
 from functools import cached_property
 from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 import re
 from typing import NamedTuple
 
@@ -7,6 +9,9 @@ from markdown_parse import load_markdown
 
 import junitparser  # https://pypi.org/project/junitparser/
 
+import logging
+log = logging.getLogger(__name__)
+
 REGEX_NUMBER_IN_BRACKETS = re.compile(r'\(.*(?P<number>\d+).*\)')
 
 
@@ -60,6 +65,11 @@ def get_text_at_headings(data, headings):
 class MarkTemplate(NamedTuple):
     headings: tuple[str]
     template_text: str
+    COMPILED_PROPERTIES = ()  # cached regex extractions from `template_text` - computed once by `compile`
+    def compile(self):
+        for name in self.COMPILED_PROPERTIES:
+            getattr(self, name)
+        return self
     def _testcase(self, target_text, index=0) -> junitparser.TestCase:
         testcase = junitparser.TestCase()
         testcase.name = f'{self.headings[-1]}.{index}'
@@ -71,6 +81,7 @@ class MarkTemplate(NamedTuple):
 class MarkTemplateWordCount(MarkTemplate):
     REGEX_WORDS_MARKS = re.compile(r'(?P<words>\d+)(?:ish)?\s+word.*?(?P<marks>\d+)\s+mark')
     REGEX_WORD_COUNT = re.compile(r'\w+')
+    COMPILED_PROPERTIES = ('_words_marks', )
 
     @cached_property
     def _words_marks(self):
@@ -92,6 +103,7 @@ class MarkTemplateWordCount(MarkTemplate):
 class MarkTemplateUrls(MarkTemplate):
     REGEX_URL_MARK = re.compile(r'\(.*?(url|link).*?\)')
     REGEX_URL_COUNT = re.compile(r'https?://')
+    COMPILED_PROPERTIES = ('urls', )
     @cached_property
     def urls(self):
         return self.REGEX_URL_MARK.findall(self.template_text or '')
@@ -108,15 +120,18 @@ class MarkTemplateCodeBlockSimple(MarkTemplate):
     # Incomplete - this is awful
     REGEX_CODEBLOCK_MARK = re.compile(r'\(.*?code.*?(?P<marks>\d+)\s+mark')
     REGEX_CODEBLOCK = re.compile(r'FencedCode:(\w+):(\d+)')
+    COMPILED_PROPERTIES = ('_required_number_of_code_blocks', )
     def _lang_lines(self, text):
         return tuple(
             (match.group(1), int(match.group(2)))
             for match in self.REGEX_CODEBLOCK.finditer(text or '')
         )
+    @cached_property
+    def _required_number_of_code_blocks(self):
+        return len(self.REGEX_CODEBLOCK_MARK.findall(self.template_text or ''))
     def testcases(self, target_text):
         actual_number_of_code_blocks = len(self._lang_lines(target_text))
-        required_number_of_code_blocks = len(self.REGEX_CODEBLOCK_MARK.findall(self.template_text or ''))
-        for index in range(required_number_of_code_blocks):
+        for index in range(self._required_number_of_code_blocks):
             testcase = super()._testcase(target_text, index)
             if (actual_number_of_code_blocks - index) <= 0:
                 testcase.result = [junitparser.Error(f'Code block count failed: expected {index}', 'code_block')]
@@ -126,6 +141,7 @@ class MarkTemplateCodeBlockSimple(MarkTemplate):
 class MarkTemplateCodeBlock(MarkTemplate):
     # Incomplete - this is awful
     REGEX_CODEBLOCK = re.compile(r'FencedCode:(\w+):(\d+)')
+    COMPILED_PROPERTIES = ('_code_blocks', )
     def _lang_lines(self, text):
         return tuple(
             (match.group(1), int(match.group(2)))
@@ -145,6 +161,31 @@ class MarkTemplateCodeBlock(MarkTemplate):
 
 _mark_templates=(MarkTemplateWordCount, MarkTemplateUrls, MarkTemplateCodeBlockSimple)
 
+
+class CompiledTemplate(tuple):
+    """
+    `((headings, (MarkTemplate, ...)), ...)` - the template parsed and its regex extractions done once, reusable for any number of targets
+    """
+
+def compile_template(template):
+    r"""
+    `template` can be markdown (text/path/filehandle), `load_markdown` output or an already `CompiledTemplate`
+
+    >>> compiled = compile_template('# Heading\n(10 words - 1 mark)')
+    >>> compiled[0][0], compiled[0][1][0]._words_marks
+    (('Heading',), ((10, 1),))
+    >>> compile_template(compiled) is compiled
+    True
+    """
+    if isinstance(template, CompiledTemplate):
+        return template
+    if not isinstance(template, dict):
+        template = load_markdown(template)
+    return CompiledTemplate(
+        (headings, tuple(MarkTemplate(headings, template_text).compile() for MarkTemplate in _mark_templates))
+        for template_text, headings in nested_headings_iterator(template)
+    )
+
 def mark_template(template, target):
     r"""
     >>> template = {
@@ -174,26 +215,90 @@ def mark_template(template, target):
     >>> tuple(testcase.is_passed for testcase in mark_template(template, {}))
     (False, False, False, False)
     """
-    for template_text, headings in nested_headings_iterator(template):
+    for headings, mark_templates in compile_template(template):
         target_text = get_text_at_headings(target, headings)
         yield from chain.from_iterable(
-            MarkTemplate(headings, template_text).testcases(target_text)
-            for MarkTemplate in _mark_templates
+            mark_template.testcases(target_text)
+            for mark_template in mark_templates
         )
 
 
 # Top Level Exports ------------------------------------------------------------
 
-def markdown_grade(template, target, junit_filename=None, **kwargs):
-    suite = junitparser.TestSuite('markdown')
+def markdown_grade_suite(template, target, name='markdown', **kwargs):
+    suite = junitparser.TestSuite(name)
     for k, v in kwargs.items():
         suite.add_property(k, v)
     suite.add_testcases(mark_template(
-        template=load_markdown(template),
+        template=compile_template(template),
         target=load_markdown(target),
     ))
+    return suite
+
+def markdown_grade(template, target, junit_filename=None, **kwargs):
     xml = junitparser.JUnitXml()
-    xml.add_testsuite(suite)
+    xml.add_testsuite(markdown_grade_suite(template, target, **kwargs))
+    if junit_filename:
+        xml.write(junit_filename)
+    return xml
+
+
+# Batch ------------------------------------------------------------------------
+# Grade every student's report in a folder of clones (see `clone.py`) against one template.
+# The template is compiled once per worker process (by the pool initializer) rather than once per report.
+
+_batch_template = None
+def _init_batch_worker(template):
+    global _batch_template
+    _batch_template = compile_template(template)
+
+def _grade_path(path):
+    """
+    Returns the suite as xml bytes - junitparser elements can't be sent between processes
+    """
+    path = Path(path)
+    return markdown_grade_suite(_batch_template, path, name=path.parent.name, path=str(path)).tostring()
+
+def markdown_grade_batch(template, paths, workers=None):
+    r"""
+    Yield a `TestSuite` per path (named after the containing folder - the student login) in `paths` order
+    A report that fails to grade is logged and omitted
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as tempdir:
+    ...     for login, text in (('student1', '# Heading\nOne two three'), ('student2', '# Heading\n' + 'word '*10)):
+    ...         _ = Path(tempdir, login).mkdir()
+    ...         _ = Path(tempdir, login, 'technical_report.md').write_text(text)
+    ...     suites = tuple(markdown_grade_batch('# Heading\n(10 words - 1 mark)', report_paths(tempdir), workers=2))
+    >>> tuple((suite.name, suite.tests, suite.errors) for suite in suites)
+    (('student1', 1, 1), ('student2', 1, 0))
+    """
+    if not isinstance(template, (dict, CompiledTemplate)):
+        template = load_markdown(template)  # parse once here - workers only compile
+    paths = tuple(paths)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker, initargs=(template, )) as executor:
+        futures = tuple(executor.submit(_grade_path, path) for path in paths)
+        for path, future in zip(paths, futures):
+            try:
+                yield junitparser.TestSuite.fromstring(future.result())
+            except Exception:
+                log.exception(f'failed to grade {path}')
+
+def report_paths(clone_path, filename='technical_report.md'):
+    return tuple(sorted(Path(clone_path).glob(f'*/{filename}')))
+
+def write_junit_batch(suites, junit_filename=None, junit_folder=None):
+    """
+    Write all suites to one combined `junit_filename` and/or one `<suite.name>.xml` per student in `junit_folder`
+    """
+    xml = junitparser.JUnitXml()
+    for suite in suites:
+        xml.add_testsuite(suite)
+        if junit_folder:
+            Path(junit_folder).mkdir(parents=True, exist_ok=True)
+            _xml = junitparser.JUnitXml()
+            _xml.add_testsuite(suite)
+            _xml.write(str(Path(junit_folder, f'{suite.name}.xml')))
     if junit_filename:
         xml.write(junit_filename)
     return xml
@@ -202,10 +307,22 @@ def markdown_grade(template, target, junit_filename=None, **kwargs):
 # Main -------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    markdown_grade(
-        template='../frameworks_and_languages_module/technical_report.md',
-        #target='README.md',
-        #target='./technical_report_target.md',
-        target='../frameworks_and_languages_module/technical_report.md',
-        junit_filename='junit.xml',
+    import argparse
+    parser = argparse.ArgumentParser(description='Grade markdown reports against a template')
+    parser.add_argument('template', nargs='?', default='../frameworks_and_languages_module/technical_report.md')
+    parser.add_argument('targets', nargs='*', help='reports to grade (default: every `filename` in `clone_path`)')
+    parser.add_argument('--clone_path', default='./clone2023', help='folder of clones produced by clone.py')
+    parser.add_argument('--filename', default='technical_report.md')
+    parser.add_argument('--junit_filename', default='junit.xml', help='combined junit output')
+    parser.add_argument('--junit_folder', help='also write one junit file per student to this folder')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    paths = args.targets or report_paths(args.clone_path, args.filename)
+    log.info(f'grading {len(paths)} reports')
+    write_junit_batch(
+        markdown_grade_batch(args.template, paths, workers=args.workers),
+        junit_filename=args.junit_filename,
+        junit_folder=args.junit_folder,
     )
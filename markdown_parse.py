@@ -1,9 +1,15 @@
 from collections import defaultdict
 tree = lambda: defaultdict(tree)
 from pathlib import Path
+from os import environ
+import re
+import unicodedata
 
 import marko
 
+import logging
+log = logging.getLogger(__name__)
+
 # parse markdown for automated marking/stats
 
 md_test = """
@@ -38,7 +44,7 @@ def parse(data):
     return marko.Markdown().parse(data)
 
 def _children_text(block):
-    if not hasattr(block, 'children'):
+    if not hasattr(block, 'children') or block.get_type() == 'LineBreak':
         return
     if isinstance(block.children, str):
         yield block.children
@@ -51,11 +57,19 @@ def _block_code_summary(block):
     line_count = block.children[0].children.count('\n')
     return f'FencedCode:{block.lang}:{line_count}'
 
-def markdown_text_dicts(blocks):
-    r'''
-    >>> markdown_text_dicts(parse(md_test).children)
-    {'': 'before', 'Test1': {'': 'This is a test.\nthing1\nthing1.5\nthing2\n a link\nEnd of test', 'code': {'': 'Some code\nFencedCode:javascript:1'}, 'code2': {'': 'some code again'}}, 'Test2': {'': 'Another test.'}}
-    '''
+def _marko_blocks(blocks):
+    for block in blocks:
+        if hasattr(block, 'level'):
+            yield ('heading', block.level, _block_text(block))
+        if block.get_type() in ('Paragraph', 'List'):
+            yield ('text', None, _block_text(block))
+        if block.get_type() == 'FencedCode':
+            yield ('text', None, _block_code_summary(block))
+
+def _text_dicts(blocks):
+    """
+    `blocks` are `(kind, level, text)` - kind is 'heading' or 'text'
+    """
     data = tree()
     heading_stack = []
     def get_data():
@@ -64,22 +78,19 @@ def markdown_text_dicts(blocks):
             _d = _d[k]
         return _d.setdefault('', [])
 
-    for block in blocks:
-        _level = getattr(block, 'level', len(heading_stack))
-        if _level != len(heading_stack):
-            if _level > len(heading_stack):
-                heading_stack[:] = heading_stack + ['(unknown)']*(_level-1 - len(heading_stack))
-            if _level < len(heading_stack):
-                heading_stack[:] = heading_stack[:_level-1]
-            heading_stack.append(_block_text(block))
-            get_data()
-        if block.get_type() in ('SetextHeading'):
-            heading_stack[-1] = _block_text(block)
+    for kind, level, text in blocks:
+        if kind == 'heading':
+            if level != len(heading_stack):
+                if level > len(heading_stack):
+                    heading_stack[:] = heading_stack + ['(unknown)']*(level-1 - len(heading_stack))
+                if level < len(heading_stack):
+                    heading_stack[:] = heading_stack[:level-1]
+                heading_stack.append(text)
+                get_data()
+            heading_stack[-1] = text
             get_data()
-        if block.get_type() in ('Paragraph', 'List'):
-            get_data().append(_block_text(block))
-        if block.get_type() == 'FencedCode':
-            get_data().append(_block_code_summary(block))
+        if kind == 'text':
+            get_data().append(text)
 
     def normalise_data(data):
         for k, v in data.items():
@@ -90,6 +101,541 @@ def markdown_text_dicts(blocks):
         return dict(data)
     return normalise_data(data)
 
+def markdown_text_dicts(blocks):
+    r'''
+    >>> markdown_text_dicts(parse(md_test).children)
+    {'': 'before', 'Test1': {'': 'This is a test.\nthing1\nthing1.5\nthing2\n a link\nEnd of test', 'code': {'': 'Some code\nFencedCode:javascript:1'}, 'code2': {'': 'some code again'}}, 'Test2': {'': 'Another test.'}}
+    '''
+    return _text_dicts(_marko_blocks(blocks))
+
+
+# Fast engine ------------------------------------------------------------------
+# A single pass over the lines producing the same heading->text tree as the marko engine, without building an AST.
+# Implements the subset of CommonMark that affects the extracted text.
+# Blocks: ATX/Setext headings, paragraphs, lists (nested), fenced/indented code, quotes, html blocks, link reference definitions
+# Inlines: emphasis, links/images, code spans, autolinks, inline html, escapes and line breaks only split the text into segments
+
+RE_BLANK = re.compile(r'^[ \t]*$')
+RE_LEADING_WHITESPACE = re.compile(r'^[ \t]+')
+RE_ATX = re.compile(r'^ {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+RE_SETEXT = re.compile(r'^ {0,3}(=+|-+)[ \t]*$')
+RE_THEMATIC = re.compile(r'^ {0,3}(?:(?:\*[ \t]*){3,}|(?:-[ \t]*){3,}|(?:_[ \t]*){3,})$')
+RE_FENCE = re.compile(r'^( {0,3})(`{3,}|~{3,})(.*)$')
+RE_QUOTE = re.compile(r'^ {0,3}> ?(.*)$')
+RE_LIST = re.compile(r'^( {0,3})([-+*]|\d{1,9}[.)])(?:([ \t]+)(.*))?$')
+RE_LINK_REF_DEF = re.compile(r'''^ {0,3}\[((?:[^\\\[\]]|\\.){1,999})\]:[ \t]*(?:<[^<>\n]*>|\S+)(?:[ \t]+(?:"[^"]*"|'[^']*'|\([^)]*\)))?[ \t]*$''')
+RE_LINK_TITLE_LINE = re.compile(r'''^[ \t]*(?:"[^"]*"|'[^']*'|\([^)]*\))[ \t]*$''')
+RE_HTML_BLOCKS = (  # (start, end) - `None` ends at a blank line
+    (re.compile(r'^ {0,3}<(?:script|pre|style|textarea)(?:\s|>|$)', re.I), re.compile(r'</(?:script|pre|style|textarea)>', re.I)),
+    (re.compile(r'^ {0,3}<!--'), re.compile(r'-->')),
+    (re.compile(r'^ {0,3}<\?'), re.compile(r'\?>')),
+    (re.compile(r'^ {0,3}<![A-Za-z]'), re.compile(r'>')),
+    (re.compile(r'^ {0,3}<!\[CDATA\['), re.compile(r'\]\]>')),
+    (re.compile(r'^ {0,3}</?(?:address|article|aside|base|basefont|blockquote|body|caption|center|col|colgroup|dd|details|dialog|dir|div|dl|dt|fieldset|figcaption|figure|footer|form|frame|frameset|h1|h2|h3|h4|h5|h6|head|header|hr|html|iframe|legend|li|link|main|menu|menuitem|nav|noframes|ol|optgroup|option|p|param|search|section|summary|table|tbody|td|tfoot|th|thead|title|tr|track|ul)(?:\s|/?>|$)', re.I), None),
+)
+_HTML_TAG = r'''(?:<[A-Za-z][A-Za-z0-9-]*(?:\s+[A-Za-z_:][\w.:-]*(?:\s*=\s*(?:[^\s"'=<>`]+|'[^']*'|"[^"]*"))?)*\s*/?>|</[A-Za-z][A-Za-z0-9-]*\s*>)'''
+RE_HTML_BLOCK_7 = re.compile(r'^ {0,3}' + _HTML_TAG + r'[ \t]*$')  # can't interrupt a paragraph
+RE_INLINE_HTML = re.compile(_HTML_TAG + r'''|<!--(?:.|\n)*?-->|<\?(?:.|\n)*?\?>|<![A-Za-z][^>]*>|<!\[CDATA\[(?:.|\n)*?\]\]>''')
+RE_AUTOLINK = re.compile(r'''<([A-Za-z][A-Za-z0-9.+-]{1,31}:[^<>\x00-\x20]*|[a-zA-Z0-9.!#$%&'*+/=?^_`{|}~-]+@[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(?:\.[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*)>''')
+RE_LINK_INLINE = re.compile(r'''\([ \t\n]*(?:<[^<>\n]*>|[^\s()]*(?:\([^\s()]*\)[^\s()]*)*)(?:[ \t\n]+(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|\((?:[^()\\]|\\.)*\)))?[ \t\n]*\)''')
+RE_LINK_LABEL = re.compile(r'\[((?:[^\\\[\]]|\\.){0,999})\]')
+RE_BACKSLASH_ESCAPE = re.compile(r'\\([!-/:-@\[-`{-~])')
+RE_TEXT = re.compile(r'[^\\`*_\[\]!<\n]+')
+ASCII_PUNCTUATION = frozenset('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
+
+
+class _LazyLine(str):
+    """A lazy continuation line - it can only ever continue the open paragraph (never a Setext underline, list item or code)"""
+
+def _normalize_label(label):
+    return ' '.join(label.split()).casefold()
+
+def _expand_leading_tabs(line):
+    return RE_LEADING_WHITESPACE.sub(lambda match: match.group().expandtabs(4), line)
+
+def _is_fence(match):
+    return match and not (match.group(2)[0] == '`' and '`' in match.group(3))
+
+def _interrupts_paragraph(line):
+    if RE_ATX.match(line) or _is_fence(RE_FENCE.match(line)) or RE_THEMATIC.match(line) or RE_QUOTE.match(line):
+        return True
+    if any(start.match(line) for start, end in RE_HTML_BLOCKS):
+        return True
+    match = RE_LIST.match(line)
+    return bool(match and (match.group(4) or '').strip() and (not match.group(2)[0].isdigit() or int(match.group(2)[:-1]) == 1))
+
+
+def _open_paragraph(line, paragraph=False):
+    """
+    Is a paragraph open after `line` (can a lazy continuation line follow it) - `paragraph` is whether one was open before it
+
+    >>> _open_paragraph('====='), _open_paragraph('=====', paragraph=True), _open_paragraph('    code'), _open_paragraph('    more', paragraph=True)
+    (True, False, False, True)
+    """
+    if isinstance(line, _LazyLine):
+        return True
+    if paragraph and RE_SETEXT.match(line):
+        return False  # underline - the paragraph became a heading
+    if not paragraph and line.startswith('    '):
+        return False  # indented code
+    match = RE_LIST.match(line)
+    return bool(line.strip()) and not (RE_ATX.match(line) or RE_THEMATIC.match(line) or _is_fence(RE_FENCE.match(line)) or (match and not (match.group(4) or '').strip()))
+
+def _paragraph_state(line, state):
+    """
+    `(paragraph_open, nested_indent)` after `line` - `nested_indent` is the content indent of the innermost list item opened within this container.
+    A less indented line is a lazy continuation of that item's paragraph, so even `=====` is text there.
+
+    >>> _paragraph_state('=====', _paragraph_state('* nested', (False, None)))
+    (True, 2)
+    >>> _paragraph_state('  =====', _paragraph_state('* nested', (False, None)))
+    (False, 2)
+    """
+    paragraph, nested = state
+    if isinstance(line, _LazyLine):
+        return True, nested
+    indent = len(line) - len(line.lstrip(' '))
+    if nested is not None and indent >= nested:
+        inner_paragraph, inner_nested = _paragraph_state(line[nested:], (paragraph, None))
+        return inner_paragraph, nested if inner_nested is None else nested + inner_nested
+    if paragraph and nested is not None and line.strip() and not _interrupts_paragraph(line):
+        return True, nested
+    match = RE_LIST.match(line)
+    if match and (match.group(4) or '').strip() and len(match.group(3)) <= 4:
+        return True, len(match.group(1)) + len(match.group(2)) + len(match.group(3))
+    return _open_paragraph(line, paragraph), None
+
+def _list_match(lines, i, final_newline):
+    match = RE_LIST.match(lines[i])
+    if match and match.group(3) is None and i == len(lines) - 1 and not final_newline:
+        return None  # marko: a bare marker needs a newline to start an item
+    return match
+
+
+def _parse_blocks(lines, labels, final_newline=True):
+    """
+    Yields `(kind, level, content)` - `content` is text for leaf blocks or child blocks for containers
+    Link reference definition labels are collected into `labels`
+    `final_newline` is False when the last line is the unterminated end of the document
+    """
+    i = 0
+    n = len(lines)
+    while i < n:
+        line = lines[i]
+        if RE_BLANK.match(line):
+            i += 1
+            continue
+        if line.startswith('    '):
+            code = []
+            while i < n and (lines[i].startswith('    ') or RE_BLANK.match(lines[i])):
+                code.append(lines[i][4:])
+                i += 1
+            while code and RE_BLANK.match(code[-1]):
+                code.pop()
+            yield ('code', None, ''.join(f'{line}\n' for line in code))
+            continue
+        match = RE_FENCE.match(line)
+        if _is_fence(match):
+            indent, fence, info = len(match.group(1)), match.group(2), match.group(3).strip()
+            close = re.compile(r'^ {0,3}%s{%d,}[ \t]*$' % (re.escape(fence[0]), len(fence)))
+            dedent = re.compile(r'^ {0,%d}' % indent)
+            code = []
+            i += 1
+            while i < n and not close.match(lines[i]):
+                code.append(dedent.sub('', lines[i]))
+                i += 1
+            code = ''.join(f'{line}\n' for line in code)
+            if i >= n and code and not final_newline:
+                code = code[:-1]
+            i += 1
+            yield ('fenced', RE_BACKSLASH_ESCAPE.sub(r'\1', info.split()[0]) if info else '', code)
+            continue
+        match = RE_ATX.match(line)
+        if match:
+            yield ('heading', len(match.group(1)), (match.group(2) or '').strip())
+            i += 1
+            continue
+        if RE_THEMATIC.match(line):
+            yield ('thematic', None, None)
+            i += 1
+            continue
+        if RE_QUOTE.match(line):
+            quote = []
+            fence = None
+            paragraph = False
+            while i < n:
+                match = RE_QUOTE.match(lines[i])
+                if match:
+                    quote.append(match.group(1))
+                    if fence:
+                        fence = None if re.match(r'^ {0,3}%s{%d,}[ \t]*$' % (re.escape(fence.group(2)[0]), len(fence.group(2))), quote[-1]) else fence
+                    elif _is_fence(RE_FENCE.match(quote[-1])):
+                        fence = RE_FENCE.match(quote[-1])
+                    paragraph = not fence and _open_paragraph(quote[-1], paragraph)
+                elif isinstance(lines[i], _LazyLine) or (paragraph and not RE_BLANK.match(lines[i]) and not _interrupts_paragraph(lines[i]) and not _list_match(lines, i, final_newline)):
+                    quote.append(_LazyLine(lines[i].lstrip()))
+                    paragraph = True
+                else:
+                    break
+                i += 1
+            yield ('quote', None, tuple(_parse_blocks(quote, labels, final_newline or i < n)))
+            continue
+        if _list_match(lines, i, final_newline):
+            i, items = _parse_list(lines, i, final_newline)
+            yield ('list', None, tuple(
+                tuple(_parse_blocks(item, labels, final_newline or i < n or index < len(items) - 1))
+                for index, item in enumerate(items)
+            ))
+            continue
+        html_end = next((end for start, end in RE_HTML_BLOCKS if start.match(line)), False) if line.lstrip().startswith('<') else False
+        if html_end is False and RE_HTML_BLOCK_7.match(line):
+            html_end = None
+        if html_end is not False:
+            while i < n:
+                if html_end is None and RE_BLANK.match(lines[i]):
+                    break
+                i += 1
+                if html_end and html_end.search(lines[i-1]):
+                    break
+            yield ('html', None, None)
+            continue
+        match = RE_LINK_REF_DEF.match(line)
+        if not match and line.rstrip().endswith(']:') and i + 1 < n and not RE_BLANK.match(lines[i+1]):
+            match = RE_LINK_REF_DEF.match(f'{line.rstrip()} {lines[i+1].strip()}')  # destination on the following line
+            i += bool(match)
+        if match:
+            labels.add(_normalize_label(match.group(1)))
+            i += 1
+            if i < n and RE_LINK_TITLE_LINE.match(lines[i]):
+                i += 1
+            continue
+        paragraph = [line.lstrip()]
+        i += 1
+        while i < n:
+            line = lines[i]
+            if isinstance(line, _LazyLine):
+                paragraph.append(line)
+                i += 1
+                continue
+            if RE_BLANK.match(line):
+                break
+            match = RE_SETEXT.match(line)
+            if match:
+                i += 1
+                yield ('heading', 1 if match.group(1)[0] == '=' else 2, '\n'.join(paragraph).strip())
+                paragraph = None
+                break
+            if _interrupts_paragraph(line):
+                break
+            paragraph.append(line.lstrip())
+            i += 1
+        if paragraph:
+            yield ('paragraph', None, '\n'.join(paragraph))
+
+
+def _parse_list(lines, i, final_newline=True):
+    """
+    Returns `(next_line_index, items)` - each item is its (de-indented) lines
+    """
+    n = len(lines)
+    items = []
+    list_type = RE_LIST.match(lines[i]).group(2)[-1]  # bullet char or ordered delimiter
+    while i < n and not RE_THEMATIC.match(lines[i]):
+        match = _list_match(lines, i, final_newline)
+        if not match or match.group(2)[-1] != list_type:
+            break
+        indent, marker, spaces, rest = len(match.group(1)), match.group(2), match.group(3) or '', match.group(4) or ''
+        if not rest.strip():
+            content_indent, first = indent + len(marker) + 1, ''
+        elif len(spaces) > 4:
+            content_indent, first = indent + len(marker) + 1, spaces[1:] + rest  # indented code as the first block
+        else:
+            content_indent, first = indent + len(marker) + len(spaces), rest
+        item = [first]
+        fence = RE_FENCE.match(first) if _is_fence(RE_FENCE.match(first)) else None
+        paragraph, nested = _paragraph_state(first, (False, None))
+        i += 1
+        while i < n:
+            line = lines[i]
+            if isinstance(line, _LazyLine):
+                item.append(line)  # already a lazy continuation of an enclosing container - it stays one
+                paragraph = True
+            elif RE_BLANK.match(line):
+                if len(item) == 1 and not first.strip():
+                    break  # an item can begin with at most one blank line
+                item.append('')
+                paragraph, nested = False, None
+            elif len(line) - len(line.lstrip(' ')) >= content_indent:
+                line = line[content_indent:]
+                if fence:
+                    if re.match(r'^ {0,3}%s{%d,}[ \t]*$' % (re.escape(fence.group(2)[0]), len(fence.group(2))), line):
+                        fence = None
+                elif _is_fence(RE_FENCE.match(line)):
+                    fence = RE_FENCE.match(line)
+                item.append(line)
+                paragraph, nested = _paragraph_state(line, (paragraph, nested)) if not fence else (False, None)
+            elif paragraph and not _interrupts_paragraph(line) and not _list_match(lines, i, final_newline):
+                item.append(_LazyLine(line.lstrip()))
+            else:
+                break
+            i += 1
+        items.append(item)
+        j = i
+        while j < n and RE_BLANK.match(lines[j]):
+            j += 1  # only an empty item stops at a blank line - the list carries on if another item follows
+        if i < j < n and _list_match(lines, j, final_newline) and _list_match(lines, j, final_newline).group(2)[-1] == list_type:
+            i = j
+    return i, items
+
+
+class _Leaf(str):
+    """Inline element text - always its own segment"""
+
+class _Delimiter():
+    def __init__(self, char, count, can_open, can_close):
+        self.char = char
+        self.count = self.length = count
+        self.can_open = can_open
+        self.can_close = can_close
+        self.opened = self.closed = False
+    def nodes(self):
+        remaining = self.char * self.count or None
+        if self.opened and self.closed:
+            return (None, remaining, None)
+        if self.opened:
+            return (remaining, None)
+        if self.closed:
+            return (None, remaining)
+        return (remaining, )
+
+class _Bracket():
+    def __init__(self, position, image):
+        self.position = position
+        self.image = image
+        self.active = True
+    def nodes(self):
+        return ('![' if self.image else '[', )
+
+
+def _is_punctuation(char):
+    return char in ASCII_PUNCTUATION or unicodedata.category(char)[0] in 'PS'
+
+def _process_emphasis(nodes, bottom):
+    delimiters = [node for node in nodes[bottom:] if isinstance(node, _Delimiter)]
+    closer_index = 0
+    while closer_index < len(delimiters):
+        closer = delimiters[closer_index]
+        if not closer.can_close or not closer.count:
+            closer_index += 1
+            continue
+        opener_index = closer_index - 1
+        while opener_index >= 0:
+            opener = delimiters[opener_index]
+            if opener.char == closer.char and opener.can_open and opener.count and not (
+                (opener.can_close or closer.can_open)
+                and (opener.length + closer.length) % 3 == 0
+                and not (opener.length % 3 == 0 and closer.length % 3 == 0)
+            ):
+                break
+            opener_index -= 1
+        if opener_index < 0:
+            closer_index += 1
+            continue
+        used = 2 if opener.count >= 2 and closer.count >= 2 else 1
+        opener.count -= used
+        closer.count -= used
+        opener.opened = closer.closed = True
+        for delimiter in delimiters[opener_index+1:closer_index]:
+            delimiter.can_open = delimiter.can_close = False
+        del delimiters[opener_index+1:closer_index]
+        closer_index = opener_index + 1
+    for delimiter in delimiters:
+        delimiter.can_open = delimiter.can_close = False  # processed - remaining delimiters are just text
+
+def _inline_segments(text, labels):
+    r"""
+    Split inline markdown into the text segments marko yields (each inline element is its own segment)
+
+    >>> _inline_segments('a *b* [c](http://example.com/ "t") `d`\\* e\nf', set())
+    ['a ', 'b', ' ', 'c', ' ', 'd', '*', ' e', 'f']
+    >>> _inline_segments('x **a* [ref] [no]', {'ref'})
+    ['x *', 'a', ' ', 'ref', ' [no]']
+    """
+    nodes = []
+    brackets = []
+    i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+        if char == '\\':
+            if text[i+1:i+2] == '\n':
+                nodes.append(None)
+                i += 2
+            elif text[i+1:i+2] and text[i+1] in ASCII_PUNCTUATION:
+                nodes.append(_Leaf(text[i+1]))
+                i += 2
+            else:
+                nodes.append(char)
+                i += 1
+        elif char == '\n':
+            if text[i-2:i] == '\\\\' and nodes[-1] == '\\':  # marko: an escaped backslash swallows the line break
+                nodes.append(char)
+                i += 1
+                continue
+            if nodes and isinstance(nodes[-1], str) and not isinstance(nodes[-1], _Leaf):
+                nodes[-1] = nodes[-1].rstrip(' ')
+                if not nodes[-1]:
+                    nodes.pop()
+            nodes.append(None)
+            i += 1
+            while i < n and text[i] == ' ':
+                i += 1
+        elif char == '`':
+            run = re.match(r'`+', text[i:]).group()
+            close = re.compile(r'(?<!`)%s(?!`)' % run).search(text, i + len(run))
+            if close:
+                code = text[i+len(run):close.start()].replace('\n', ' ')
+                if len(code) >= 2 and code[0] == ' ' and code[-1] == ' ' and code.strip(' '):
+                    code = code[1:-1]
+                nodes.append(_Leaf(code))
+                i = close.end()
+            else:
+                nodes.append(run)
+                i += len(run)
+        elif char == '<':
+            match = RE_AUTOLINK.match(text, i)
+            if match:
+                nodes += (None, _Leaf(match.group(1)), None)
+                i = match.end()
+                continue
+            match = RE_INLINE_HTML.match(text, i)
+            if match:
+                nodes.append(_Leaf(match.group()))
+                i = match.end()
+                continue
+            nodes.append(char)
+            i += 1
+        elif char in '*_':
+            run = re.match(r'\%s+' % char, text[i:]).group()
+            before = text[i-1] if i else ' '
+            after = text[i+len(run)] if i + len(run) < n else ' '
+            left_flanking = not after.isspace() and (not _is_punctuation(after) or before.isspace() or _is_punctuation(before))
+            right_flanking = not before.isspace() and (not _is_punctuation(before) or after.isspace() or _is_punctuation(after))
+            if char == '*':
+                can_open, can_close = left_flanking, right_flanking
+            else:
+                can_open = left_flanking and (not right_flanking or _is_punctuation(before))
+                can_close = right_flanking and (not left_flanking or _is_punctuation(after))
+            nodes.append(_Delimiter(char, len(run), can_open, can_close))
+            i += len(run)
+        elif char == '[' or (char == '!' and text[i+1:i+2] == '['):
+            image = char == '!'
+            i += 2 if image else 1
+            brackets.append(len(nodes))
+            nodes.append(_Bracket(i, image))
+        elif char == ']':
+            i += 1
+            if not brackets:
+                nodes.append(char)
+                continue
+            opener = nodes[brackets[-1]]
+            end = None
+            if opener.active:
+                match = RE_LINK_INLINE.match(text, i)
+                if match:
+                    end = match.end()
+                else:
+                    match = RE_LINK_LABEL.match(text, i)
+                    label = match.group(1) if match and match.group(1) else text[opener.position:i-1]
+                    if _normalize_label(label) in labels:
+                        end = match.end() if match else i
+            if end is None:
+                nodes[brackets.pop()] = opener.nodes()[0]
+                nodes.append(char)
+                continue
+            index = brackets.pop()
+            _process_emphasis(nodes, index + 1)
+            nodes[index] = None
+            nodes.append(None)
+            if not opener.image:
+                for bracket_index in brackets:
+                    if not nodes[bracket_index].image:
+                        nodes[bracket_index].active = False  # no links in links
+            i = end
+        else:
+            match = RE_TEXT.match(text, i)
+            nodes.append(match.group() if match else char)
+            i = match.end() if match else i + 1
+    _process_emphasis(nodes, 0)
+
+    segments = []
+    buffer = []
+    def flush():
+        if buffer:
+            segments.append(''.join(buffer))
+            buffer.clear()
+    def flatten(node):
+        if node is None:
+            flush()
+        elif isinstance(node, _Leaf):
+            flush()
+            segments.append(str(node))
+        elif isinstance(node, str):
+            buffer.append(node)
+        else:
+            for _node in node.nodes():
+                flatten(_node)
+    for node in nodes:
+        flatten(node)
+    flush()
+    return segments
+
+def _leaf_texts(blocks, labels):
+    for kind, level, content in blocks:
+        if kind in ('paragraph', 'heading'):
+            yield from _inline_segments(content, labels)
+        if kind in ('fenced', 'code'):
+            yield content
+        if kind == 'quote':
+            yield from _leaf_texts(content, labels)
+        if kind == 'list':
+            for item in content:
+                yield from _leaf_texts(item, labels)
+
+def _fast_blocks(data):
+    labels = set()
+    lines = tuple(map(_expand_leading_tabs, data.splitlines()))
+    blocks = tuple(_parse_blocks(lines, labels, data.endswith(('\n', '\r'))))  # labels must all be known before inlines
+    for kind, level, content in blocks:
+        if kind == 'heading':
+            yield ('heading', level, '\n'.join(_inline_segments(content, labels)))
+        if kind == 'paragraph':
+            yield ('text', None, '\n'.join(_inline_segments(content, labels)))
+        if kind == 'list':
+            yield ('text', None, '\n'.join(_leaf_texts(((kind, level, content), ), labels)))
+        if kind == 'fenced':
+            yield ('text', None, f'FencedCode:{level}:{content.count(chr(10))}')
+
+def markdown_text_dicts_fast(data):
+    r'''
+    >>> markdown_text_dicts_fast(md_test) == markdown_text_dicts(parse(md_test).children)
+    True
+    >>> markdown_text_dicts_fast('Title\n=====\n## Sub *heading* ##\n1. one\n2. two\n\n   ```python\n   code\n   ```\n> quoted\n\n```\na\nb\n```')
+    {'Title': {'': '', 'Sub \nheading': {'': 'one\ntwo\ncode\n\nFencedCode::2'}}}
+    >>> markdown_text_dicts_fast('* item\n  * nested\nTitle\n=====\n')  # a lazy line is never a Setext underline
+    {'': 'item\nnested\nTitle\n====='}
+    >>> markdown_text_dicts_fast('-\n\n- dash')  # an empty item and a blank line don't end the list
+    {'': 'dash'}
+    '''
+    return _text_dicts(_fast_blocks(data))
+
+
+ENGINES = {
+    'fast': markdown_text_dicts_fast,
+    'marko': lambda data: markdown_text_dicts(parse(data).children),
+}
+DEFAULT_ENGINE = environ.get('MARKDOWN_ENGINE', 'fast')  # `marko` is the fallback (and the oracle for `fuzz_engines`/`compare_engines`)
+
 
 def markdown_codeblock_languages(block):
     r'''
@@ -104,7 +650,7 @@ def markdown_codeblock_languages(block):
 #    markdown_text_dicts(bb.children)
 #)
 
-def load_markdown(data):
+def load_markdown(data, engine=None):
     r"""
     >>> load_markdown('# Test')
     {'Test': {'': ''}}
@@ -113,6 +659,8 @@ def load_markdown(data):
     >>> import io
     >>> load_markdown(io.StringIO('# Test'))
     {'Test': {'': ''}}
+    >>> load_markdown('# Test', engine='marko')
+    {'Test': {'': ''}}
     """
     try:
         if isinstance(data, str) and Path(data).is_file():
@@ -123,4 +671,67 @@ def load_markdown(data):
         data = data.open('rt')
     if hasattr(data, 'read') and callable(data.read):
         data = data.read()
-    return markdown_text_dicts(parse(data).children)
+    engine = engine or DEFAULT_ENGINE
+    if engine != 'marko':
+        try:
+            return ENGINES[engine](data)
+        except Exception:
+            log.exception(f'{engine} markdown engine failed - falling back to marko')
+    return ENGINES['marko'](data)
+
+
+def compare_engines(*paths):
+    """
+    Paths where the engines disagree
+    """
+    return tuple(
+        path for path in paths
+        if ENGINES['fast'](Path(path).read_text()) != ENGINES['marko'](Path(path).read_text())
+    )
+
+FUZZ_LINES = (
+    '', '* item', '  * nested', '    * deep', '- dash', '+ plus', '-', '1.', '1. one', '2) two', '  1. sub', '   - three', '10. ten',
+    'Title', '  Title', 'lazy line', '  continued', '=====', '  =====', '---', '   ---', '***', '# Head', '## Sub',
+    '> quote', '>', ' > q', '>> deeper', '> * in quote', '>   nested quote item', '    indented', '\ttab', '```', '```python', '~~~',
+    '[a]: http://x', 'see [a] and [b](u)', 'text *em* and `code`', '**bold**', '_u_', '\\* escaped', 'a  ', 'b\\', '<div>', '</div>', '<!-- c -->',
+)
+def fuzz_engines(number=1000, seed=0, max_lines=16):
+    """
+    Random documents (from `FUZZ_LINES`) where the engines disagree
+
+    >>> fuzz_engines(200)
+    ()
+    """
+    import random
+    rng = random.Random(seed)
+    documents = (
+        '\n'.join(rng.choice(FUZZ_LINES) for _ in range(rng.randint(1, max_lines))) + rng.choice(('\n', ''))
+        for _ in range(number)
+    )
+    return tuple(data for data in documents if ENGINES['fast'](data) != ENGINES['marko'](data))
+
+def benchmark(*paths, number=10):
+    """
+    Seconds per engine to parse all `paths` `number` times
+    """
+    from timeit import timeit
+    texts = tuple(Path(path).read_text() for path in paths)
+    return {
+        name: timeit(lambda: tuple(map(engine, texts)), number=number)
+        for name, engine in ENGINES.items()
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare/benchmark the markdown engines')
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--number', type=int, default=10)
+    parser.add_argument('--fuzz', type=int, default=0, help='also compare the engines on this many random documents')
+    args = parser.parse_args()
+    for data in fuzz_engines(args.fuzz):
+        print(f'engines differ: {data!r}')
+    for path in compare_engines(*args.paths):
+        print(f'engines differ: {path}')
+    for name, seconds in (benchmark(*args.paths, number=args.number) if args.paths else {}).items():
+        print(f'{name}: {seconds:.3f}s')
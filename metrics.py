@@ -0,0 +1,152 @@
+"""
+Run instrumentation - where the time, the requests and the bytes went
+
+* `metrics.stage(name)` (context manager) / `metrics.timed(name)` (decorator) accumulate calls and seconds per stage.
+  Stages run concurrently in worker threads, so their seconds are summed across threads (they can exceed the wall time).
+* `metrics.record_response` is a `requests` response hook (installed by `github_requests.github_session`) counting requests and bytes per endpoint
+* `cache_tools.cache_infos()` (hits/misses/expired per `cache_disk` function) is included in `report()`
+* `metrics.profile_stage = name` (or `PROFILE_STAGE=name`) runs every call of that one stage under cProfile -
+  profiled calls are serialised, so only profile the stage you are looking at
+"""
+import re
+import json
+import time
+import cProfile
+import pstats
+import datetime
+import threading
+from os import environ
+from pathlib import Path
+from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import logging
+log = logging.getLogger(__name__)
+
+
+ENDPOINTS = (  # request path -> endpoint name (first match)
+    ('artifact_zip', re.compile(r'/actions/artifacts/\d+/zip$')),
+    ('artifact_list', re.compile(r'/actions/runs/\d+/artifacts$')),
+    ('workflow_runs', re.compile(r'/actions/workflows/\d+/runs$')),
+    ('workflows', re.compile(r'/actions/workflows$')),
+    ('commits', re.compile(r'/commits$')),
+    ('git_trees', re.compile(r'/git/trees/')),
+    ('git_blobs', re.compile(r'/git/blobs/')),
+    ('contents', re.compile(r'/contents/')),
+    ('forks', re.compile(r'/forks$')),
+    ('graphql', re.compile(r'/graphql$')),
+    ('repos', re.compile(r'/repos/[^/]+/[^/]+$')),
+)
+
+def endpoint(url):
+    """
+    >>> endpoint('/repos/student0/module/actions/artifacts/12/zip'), endpoint('https://api.github.com/repos/student0/module?a=1'), endpoint('/nope')
+    ('artifact_zip', 'repos', 'other')
+    """
+    path = urlsplit(url).path
+    return next((name for name, regex in ENDPOINTS if regex.search(path)), 'other')
+
+
+class Metrics():
+    """
+    >>> metrics = Metrics()
+    >>> with metrics.stage('grading'):
+    ...     pass
+    >>> @metrics.timed('grading')
+    ... def grade(a):
+    ...     return a
+    >>> grade(1), grade(2)
+    (1, 2)
+    >>> metrics.stages['grading']['calls']
+    3
+    >>> metrics.record_request('/repos/user/repo/git/blobs/abc', 100)
+    >>> metrics.record_request('/repos/user/repo/git/blobs/def', 50, not_modified=True)
+    >>> dict(metrics.requests['git_blobs'])
+    {'count': 2, 'bytes': 150, 'not_modified': 1}
+    """
+    def __init__(self, profile_stage=None):
+        self.profile_stage = profile_stage
+        self._lock = threading.Lock()
+        self._profile_lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = datetime.datetime.now()
+            self._time_start = time.perf_counter()
+            self.stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+            self.requests = defaultdict(lambda: {'count': 0, 'bytes': 0, 'not_modified': 0})
+            self.profiles = []
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        if name == self.profile_stage:
+            self._profile_lock.acquire()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        time_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - time_start
+            if profiler:
+                profiler.disable()
+                self._profile_lock.release()
+            with self._lock:
+                self.stages[name]['calls'] += 1
+                self.stages[name]['seconds'] += seconds
+                if profiler:
+                    self.profiles.append(profiler)
+    def timed(self, name):
+        def _decorate(function):
+            @wraps(function)
+            def wrapped_function(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapped_function
+        return _decorate
+
+    def record_request(self, url, size_bytes, not_modified=False):
+        with self._lock:
+            request = self.requests[endpoint(url)]
+            request['count'] += 1
+            request['bytes'] += size_bytes
+            request['not_modified'] += int(not_modified)
+    def record_response(self, response, *args, **kwargs):
+        """
+        `requests` response hook - streamed bodies (artifact zips) are counted by `Content-Length` rather than read here
+        """
+        not_modified = getattr(response, 'from_etag_store', False)  # body replayed from the ETag store - nothing downloaded
+        if not_modified:
+            size_bytes = 0
+        elif kwargs.get('stream'):
+            size_bytes = int(response.headers.get('Content-Length') or 0)
+        else:
+            size_bytes = len(response.content or b'')
+        self.record_request(response.url, size_bytes, not_modified=not_modified)
+
+    def report(self):
+        from cache_tools import cache_infos
+        with self._lock:
+            return {
+                'started': self.started.isoformat(),
+                'seconds': round(time.perf_counter() - self._time_start, 3),
+                'stages': {name: {**stage, 'seconds': round(stage['seconds'], 3)} for name, stage in sorted(self.stages.items())},
+                'requests': dict(sorted(self.requests.items())),
+                'caches': cache_infos(),
+                'profile_stage': self.profile_stage,
+            }
+    def write_report(self, path=Path('run_report.json')):
+        """
+        The report as json - plus `<path>.pstats` (`python -m pstats`) when a stage was profiled
+        """
+        with path.open('wt') as filehandle:
+            json.dump(self.report(), filehandle, indent=2)
+        if self.profiles:
+            pstats.Stats(*self.profiles).dump_stats(path.with_suffix('.pstats'))
+        log.info(f'run report written to {path}')
+
+metrics = Metrics(profile_stage=environ.get('PROFILE_STAGE'))
@@ -0,0 +1,153 @@
+"""
+Flat, indexed table of every testcase result - one row per (user, week, suite, classname, testcase)
+
+Cohort-wide questions ("which tests are failing for most students in week 6")
+become a `GROUP BY` rather than a walk of the nested `data.json`.
+Rows are upserted, so results accumulate across runs (a re-run only refreshes what it saw).
+"""
+import datetime
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import NamedTuple
+
+log = logging.getLogger(__name__)
+
+STATUSES = ('passed', 'failure', 'error', 'skipped')
+GROUP_BY = {
+    'testcase': ('suite', 'classname', 'testcase'),
+    'suite': ('suite', ),
+    'week': ('week', ),
+    'user': ('user', ),
+}
+
+
+class Aggregate(NamedTuple):
+    key: tuple
+    users: int
+    passed: int
+    failure: int
+    error: int
+    skipped: int
+
+
+class ResultsStore():
+    """
+    >>> import tempfile
+    >>> from junit_records import junit_suite
+    >>> store = ResultsStore(Path(tempfile.mkdtemp()).joinpath('results.sqlite'))
+    >>> suite = lambda *statuses, classname='': junit_suite(('<testsuite name="server">' + ''.join(
+    ...     f'<testcase classname="{classname}" name="t{i}"><{status}/></testcase>' if status != 'passed' else f'<testcase classname="{classname}" name="t{i}"/>'
+    ...     for i, status in enumerate(statuses)
+    ... ) + '</testsuite>').encode('utf8'))
+    >>> store.add('alice', {6: {'server': ('a1', suite('passed', 'failure'))}})
+    2
+    >>> store.add('bob', {6: {'server': ('b1', suite('error', 'failure'))}, 7: {'server': ('b2', suite('passed', 'passed'))}})
+    4
+    >>> store.aggregate('testcase', week=6)
+    (Aggregate(key=('server', '', 't1'), users=2, passed=0, failure=2, error=0, skipped=0), Aggregate(key=('server', '', 't0'), users=2, passed=1, failure=0, error=1, skipped=0))
+
+    The same testcase name in two classes is two rows - a testcase repeated within a class is written once
+
+    >>> store.add('carol', {6: {'server': ('c1', junit_suite(b'<testsuite name="server"><testcase classname="a" name="t"/><testcase classname="b" name="t"><failure/></testcase><testcase classname="b" name="t"/></testsuite>'))}})
+    2
+    >>> store.aggregate('testcase', user='carol')
+    (Aggregate(key=('server', 'a', 't'), users=1, passed=1, failure=0, error=0, skipped=0), Aggregate(key=('server', 'b', 't'), users=1, passed=1, failure=0, error=0, skipped=0))
+    >>> store.add('bob', {6: {'server': ('b3', suite('passed', 'passed'))}})  # a later run replaces bob's week 6
+    2
+    >>> store.aggregate('user')
+    (Aggregate(key=('alice',), users=1, passed=1, failure=1, error=0, skipped=0), Aggregate(key=('bob',), users=1, passed=4, failure=0, error=0, skipped=0), Aggregate(key=('carol',), users=1, passed=2, failure=0, error=0, skipped=0))
+    >>> store.failing_users(week=6, suite='server', testcase='t1')
+    ('alice',)
+    """
+    def __init__(self, path):
+        assert isinstance(path, Path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    @property
+    def db(self):
+        if not self._db:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            columns = tuple(row[1] for row in self._db.execute('PRAGMA table_info(results)'))
+            if columns and 'classname' not in columns:
+                log.warning(f'{self.path}: results table predates the classname column - dropped (it is rebuilt by the next run)')
+                with self._db:
+                    self._db.execute('DROP TABLE results')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS results (
+                user TEXT, week INTEGER, suite TEXT, classname TEXT, testcase TEXT, status TEXT, sha TEXT, updated REAL,
+                PRIMARY KEY (user, week, suite, classname, testcase)
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_week_suite_testcase ON results (week, suite, testcase)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_suite_testcase ON results (suite, testcase)')
+        return self._db
+
+    def add(self, user, suites_grouped_by_week):
+        """
+        `suites_grouped_by_week` is `{week: {suite_name: (sha, junit_records.TestSuite)}}`.
+        A (user, week, suite) that is seen again has all its rows replaced - testcases that have since been removed don't linger.
+        A testcase repeated within a suite (same classname and name) keeps its last result.
+        Returns the number of rows written.
+        """
+        now = datetime.datetime.now().timestamp()
+        rows = {
+            (week, suite_name, testcase.classname, testcase.name): (user, week, suite_name, testcase.classname, testcase.name, testcase.status, sha, now)
+            for week, suites in suites_grouped_by_week.items()
+            for suite_name, (sha, suite) in suites.items()
+            for testcase in suite.testcases
+        }
+        with self._lock, self.db:
+            self.db.executemany('DELETE FROM results WHERE user=? AND week=? AND suite=?', (
+                (user, week, suite_name)
+                for week, suites in suites_grouped_by_week.items()
+                for suite_name in suites
+            ))
+            self.db.executemany('INSERT INTO results VALUES (?,?,?,?,?,?,?,?)', rows.values())
+        return len(rows)
+
+    @staticmethod
+    def _where(filters):
+        filters = {k: v for k, v in filters.items() if v is not None}
+        assert set(filters) <= {'user', 'week', 'suite', 'classname', 'testcase', 'status'}, filters
+        return (' WHERE ' + ' AND '.join(f'{k}=?' for k in filters) if filters else ''), tuple(filters.values())
+
+    def aggregate(self, by='testcase', **filters):
+        """
+        Status counts grouped `by` 'testcase', 'suite', 'week' or 'user' - the most failing/erroring first.
+        `filters` are equality matches on user/week/suite/classname/testcase/status.
+        """
+        columns = ', '.join(GROUP_BY[by])
+        where, params = self._where(filters)
+        with self._lock:
+            rows = self.db.execute(f'''
+                SELECT {columns}, COUNT(DISTINCT user), {', '.join(f"SUM(status='{status}')" for status in STATUSES)}
+                FROM results{where} GROUP BY {columns}
+                ORDER BY SUM(status IN ('failure', 'error')) DESC, {columns}
+            ''', params).fetchall()
+        return tuple(Aggregate(row[:-5], *row[-5:]) for row in rows)
+
+    def failing_users(self, **filters):
+        where, params = self._where(filters)
+        with self._lock:
+            rows = self.db.execute(f"SELECT DISTINCT user FROM results{where}{' AND' if where else ' WHERE'} status IN ('failure', 'error') ORDER BY user", params).fetchall()
+        return tuple(user for user, in rows)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Aggregate test results across the cohort (written by github_fork_data.py)')
+    parser.add_argument('by', nargs='?', default='testcase', choices=GROUP_BY)
+    parser.add_argument('--path', type=Path, default=Path('results.sqlite'))
+    parser.add_argument('--limit', type=int, default=20)
+    for column in ('user', 'suite', 'classname', 'testcase', 'status'):
+        parser.add_argument(f'--{column}')
+    parser.add_argument('--week', type=int, help='0 based (as in data.json)')
+    args = parser.parse_args()
+
+    store = ResultsStore(args.path)
+    for aggregate in store.aggregate(args.by, **{k: getattr(args, k) for k in ('user', 'week', 'suite', 'classname', 'testcase', 'status')})[:args.limit]:
+        print('\t'.join(map(str, (*aggregate.key, *aggregate[1:]))))
@@ -0,0 +1,229 @@
+"""
+Watch mode - keep `data.json`, `data/` and `markdown_templates.json` fresh without re-evaluating the whole cohort
+
+Every `--interval` seconds the fork listing is polled (conditional requests - an unchanged page is a `304` from the ETag store).
+Only forks whose `pushed_at` moved (or were pushed within `--settle` minutes - CI artifacts arrive after the push)
+are run through `GitHubForkData`, and their entries are merged into the existing outputs, each rewritten atomically.
+
+`--webhook_port` also accepts GitHub `push`/`workflow_run` webhooks (signed with `WEBHOOK_SECRET`) to wake the loop early for that fork.
+
+    python3 watch.py --interval 300 --webhook_port 8042
+"""
+import json
+import hmac
+import hashlib
+import datetime
+import threading
+from contextlib import nullcontext
+from os import environ
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _utils import write_json_atomic
+from cache_tools import JsonIndex
+from github_fork_data import DATA_SOURCES, write_data_shards, summary_matrix, _naive_utc
+from metrics import metrics
+import github_requests
+
+import logging
+log = logging.getLogger(__name__)
+
+
+INTERVAL = datetime.timedelta(minutes=5)
+SETTLE = datetime.timedelta(minutes=30)  # keep re-checking a fork this long after a push - its workflow runs finish later
+WEBHOOK_EVENTS = frozenset(('push', 'workflow_run'))
+
+
+def _load_fork_test_data(path):
+    """`data.json` with the week keys back as ints (as `GitHubForkData.fork_test_data` has them)"""
+    if not path.is_file():
+        return {}
+    with path.open('rt') as filehandle:
+        return {
+            username: {int(week): suites for week, suites in tests_grouped_by_week.items()}
+            for username, tests_grouped_by_week in json.load(filehandle).items()
+        }
+
+def _load_json(path):
+    if not path.is_file():
+        return {}
+    with path.open('rt') as filehandle:
+        return json.load(filehandle)
+
+
+class Watcher():
+    """
+    >>> import tempfile, github
+    >>> from github_stub import StubGithub, synthetic_cohort, cache_path
+    >>> path = Path(tempfile.mkdtemp())
+    >>> with StubGithub() as stub, cache_path(path.joinpath('cache')):
+    ...     settings = synthetic_cohort(stub, forks=3, weeks=2)
+    ...     settings.update(index_path=str(path.joinpath('index')), results_path=str(path.joinpath('results.sqlite')))
+    ...     session = github_requests.github_session(etag_store=github_requests.ETagStore(path.joinpath('etag')))
+    ...     watcher = Watcher(github.Github(base_url=stub.url, retry=None, seconds_between_requests=0), settings, session=session, path=path)
+    ...     first = watcher.cycle()
+    ...     second = watcher.cycle()
+    ...     forks = json.loads(stub.routes['/repos/tutor/module/forks'][1])
+    ...     forks[1]['pushed_at'] = '2023-10-09T12:00:00Z'
+    ...     stub.add_json('/repos/tutor/module/forks', forks)
+    ...     watcher.notify('student2')
+    ...     third = watcher.cycle()
+    >>> first, second, third
+    (('student0', 'student1', 'student2'), (), ('student1', 'student2'))
+    >>> sorted(json.loads(path.joinpath('data.json').read_text())), sorted(json.loads(path.joinpath('markdown_templates.json').read_text()))
+    (['student0', 'student1', 'student2'], ['', 'student0', 'student1', 'student2'])
+    """
+    def __init__(self, github, settings, session=None, path=Path('.'), settle=SETTLE):
+        self.github = github
+        self.settings = settings
+        self.session = session or github_requests.session
+        self.path = path
+        self.settle = settle
+        self.state = JsonIndex(Path(settings.get('index_path', '__index')).joinpath(f'watch__{settings["repo"].replace("/", "__")}.json'))  # {username: {'pushed_at': iso, 'processed': iso}}
+        self._lock = threading.Lock()
+        self._notified = set()
+        self._wake = threading.Event()
+
+    def notify(self, username):
+        """Process `username`'s fork on the next cycle, whatever its `pushed_at` says - and wake the loop now"""
+        with self._lock:
+            self._notified.add(username)
+        self._wake.set()
+
+    def _is_due(self, fork, now):
+        state = self.state.get(fork.owner.login)
+        if not state or not fork.pushed_at:
+            return True
+        pushed_at = _naive_utc(fork.pushed_at)
+        return state['pushed_at'] != pushed_at.isoformat() or now - pushed_at < self.settle
+
+    def cycle(self):
+        """
+        Process the forks that changed - returns their usernames
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        gg = DATA_SOURCES[self.settings.get('data_source', 'rest')](self.github, self.settings, session=self.session)
+        for cls in type(gg).__mro__:  # `functools.cache` methods would hold every previous cycle's forks
+            for attribute in vars(cls).values():
+                if hasattr(attribute, 'cache_clear'):
+                    attribute.cache_clear()
+        forks = gg.forks
+        with self._lock:
+            notified, self._notified = self._notified, set()
+        due = tuple(fork for fork in forks if fork.owner.login in notified or self._is_due(fork, now))
+        if not due:
+            return ()
+        log.info(f'processing {len(due)} of {len(forks)} forks: {" ".join(fork.owner.login for fork in due)}')
+        metrics.reset()
+        gg.forks = due  # overrides the cached listing - every stage below only crawls these forks
+        usernames = frozenset(fork.owner.login for fork in forks)
+
+        fork_test_data = _load_fork_test_data(self.path.joinpath('data.json'))
+        fork_test_data.update(gg.fork_test_data)
+        fork_test_data = {username: data for username, data in fork_test_data.items() if username in usernames}
+        write_json_atomic(self.path.joinpath('data.json'), fork_test_data)
+        write_data_shards(fork_test_data, self.path.joinpath('data'), summary=summary_matrix(fork_test_data), usernames=frozenset(gg.fork_test_data))
+        gg.write_results_store()
+
+        markdown_templates = _load_json(self.path.joinpath('markdown_templates.json'))
+        markdown_templates.update(gg.fork_markdown_templates)
+        write_json_atomic(self.path.joinpath('markdown_templates.json'), {
+            username: markdown_json for username, markdown_json in markdown_templates.items()
+            if username in usernames or username == ''
+        })
+        metrics.write_report(self.path.joinpath('run_report.json'))
+
+        for fork in due:
+            if fork.owner.login in gg.fork_test_data:  # a fork that failed stays due
+                self.state[fork.owner.login] = {
+                    'pushed_at': _naive_utc(fork.pushed_at).isoformat() if fork.pushed_at else None,
+                    'processed': now.isoformat(),
+                }
+        self.state.save()
+        return tuple(sorted(gg.fork_test_data))
+
+    def run(self, interval=INTERVAL):
+        while True:
+            self._wake.clear()  # before the cycle - a webhook arriving mid cycle wakes the next one
+            try:
+                self.cycle()
+            except Exception:
+                log.exception('watch cycle failed')
+            self._wake.wait(interval.total_seconds())
+
+
+def verify_signature(secret, body, signature):
+    """
+    GitHub's `X-Hub-Signature-256` - anything is accepted when no secret is configured (`WebhookServer` then only listens on localhost)
+
+    >>> verify_signature('secret', b'{}', 'sha256=' + hmac.new(b'secret', b'{}', hashlib.sha256).hexdigest()), verify_signature('secret', b'{}', 'sha256=0')
+    (True, False)
+    """
+    if not secret:
+        return True
+    return hmac.compare_digest('sha256=' + hmac.new(secret.encode('utf8'), body, hashlib.sha256).hexdigest(), signature or '')
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not verify_signature(self.server.secret, body, self.headers.get('X-Hub-Signature-256')):
+            return self._send(401)
+        if self.headers.get('X-GitHub-Event') in WEBHOOK_EVENTS:
+            try:
+                self.server.watcher.notify(json.loads(body)['repository']['owner']['login'])
+            except (ValueError, KeyError, TypeError):
+                return self._send(400)
+        self._send(204)
+    def _send(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Listens on every interface only when `secret` (default `WEBHOOK_SECRET`) is set - unsigned webhooks are local only
+
+    >>> import requests
+    >>> watcher = Watcher(None, {'repo': 'tutor/module'})
+    >>> with WebhookServer(watcher, secret='') as server:
+    ...     server.server_address[0], requests.post(f'http://127.0.0.1:{server.server_port}/', json={'repository': {'owner': {'login': 'student1'}}}, headers={'X-GitHub-Event': 'push'}).status_code
+    ('127.0.0.1', 204)
+    >>> watcher._notified, watcher._wake.is_set()
+    ({'student1'}, True)
+    """
+    daemon_threads = True
+
+    def __init__(self, watcher, port=0, secret=None):
+        self.secret = environ.get('WEBHOOK_SECRET') if secret is None else secret
+        super().__init__(('' if self.secret else '127.0.0.1', port), WebhookRequestHandler)
+        self.watcher = watcher
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import github
+    parser = argparse.ArgumentParser(description='Regenerate the outputs for forks as they change')
+    parser.add_argument('--settings', type=Path, default=Path('frameworks_and_languages.json'))
+    parser.add_argument('--interval', type=int, default=int(INTERVAL.total_seconds()), help='seconds between polls of the fork listing')
+    parser.add_argument('--settle', type=int, default=int(SETTLE.total_seconds() // 60), help='minutes to keep re-checking a fork after a push')
+    parser.add_argument('--webhook_port', type=int, help='also accept GitHub push/workflow_run webhooks on this port (verified with WEBHOOK_SECRET)')
+    args = parser.parse_args()
+    if args.webhook_port and not environ.get('WEBHOOK_SECRET'):
+        parser.error('--webhook_port needs WEBHOOK_SECRET (the secret configured on the GitHub webhook) - unsigned webhooks would let anyone trigger crawls')
+    logging.basicConfig(level=logging.INFO)
+
+    github_requests.use_github_session()
+    with args.settings.open('rt') as filehandle:
+        settings = json.load(filehandle)
+    watcher = Watcher(github.Github(environ['GITHUB_TOKEN']), settings, settle=datetime.timedelta(minutes=args.settle))
+    with WebhookServer(watcher, port=args.webhook_port) if args.webhook_port else nullcontext():
+        watcher.run(datetime.timedelta(seconds=args.interval))